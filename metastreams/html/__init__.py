@@ -24,18 +24,49 @@
 ## end license ##
 
 
+import os
+import importlib
+
 from .paths import *
-from .stdsflib import * # trigger tests
+from ._tag import *
 
-from .sessionstore import SessionStore
-from .cookie import Cookie
-from .dynamichtml import DynamicHtml, Dict
-from .static_handler import static_handler
-from .dynamic_handler import dynamic_handler
-from .testsupport import *
 
-from .server import *
-from .passwordfile2 import *
-from ._tag import *
+# Subsystems are imported on first access, so that tools needing only the template
+# engine do not pay for aiohttp, aionotify and argon2. See importtime.py.
+_lazy = {
+    'builtins': '.stdsflib',
+    'SessionStore': '.sessionstore',
+    'SqliteSessionStore': '.sqlitesessionstore',
+    'CookieSessionStore': '.cookiesessionstore',
+    'PersistentSessionStore': '.persistentsessionstore',
+    'LoginThrottle': '.loginthrottle',
+    'Cookie': '.cookie',
+    'DynamicHtml': '.dynamichtml',
+    'Dict': '.dynamichtml',
+    'static_handler': '.static_handler',
+    'dynamic_handler': '.dynamic_handler',
+    'MockStream': '.testsupport',
+    'CopyTag': '.testsupport',
+    'NoopTag': '.testsupport',
+    'create_server_app': '.server',
+    'PasswordFile2': '.passwordfile2',
+}
+
+__all__ = ['usr_share_path', 'tagable', *_lazy]
+
+
+def __getattr__(name):
+    if (modname := _lazy.get(name)) is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(modname, __name__), name)
+    globals()[name] = value
+    return value
 
 
+# import everything for the side effect of testing, only when asked to by the test run:
+#   METASTREAMS_HTML_TESTS=1 python -c 'import metastreams.html'
+if __debug__ and os.environ.get('METASTREAMS_HTML_TESTS'):
+    for name in _lazy:
+        __getattr__(name)
+    for modname in ('.export', '.precompress', '.importtime', '.argon2calibration'):   # commands
+        importlib.import_module(modname, __name__)
@@ -0,0 +1,123 @@
+## begin license ##
+#
+# "Metastreams Html" is a template engine based on generators, and a sequel to Slowfoot.
+# It is also known as "DynamicHtml" or "Seecr Html".
+#
+# Copyright (C) 2023 Seecr (Seek You Too B.V.) https://seecr.nl
+#
+# This file is part of "Metastreams Html"
+#
+# "Metastreams Html" is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# "Metastreams Html" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "Metastreams Html"; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+## end license ##
+
+""" Finds argon2 parameters that verify a password within a latency budget on this host
+    and stores them in a password file; users are rehashed on their next login:
+
+        python -m metastreams.html.argon2calibration --target 50 --percentile 95 /path/to/passwd
+
+    Memory cost is halved from --memory-cost until time cost 1 fits the budget, then
+    time cost is raised as far as the budget allows.
+"""
+
+import sys
+from math import ceil
+from time import perf_counter
+
+from argon2 import PasswordHasher
+
+__all__ = ['calibrate']
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, ceil(p / 100 * len(ordered)) - 1)]
+
+
+def verify_latency(time_cost, memory_cost, parallelism, samples=20, p=95):
+    hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+    hashed = hasher.hash('calibration')
+    times = []
+    for _ in range(samples):
+        t0 = perf_counter()
+        hasher.verify(hashed, 'calibration')
+        times.append(perf_counter() - t0)
+    return percentile(times, p)
+
+
+def calibrate(target=.05, p=95, memory_cost=65536, min_memory_cost=19456, parallelism=4,
+        max_time_cost=20, samples=20):
+    """ Returns (parameters, latency): the most expensive parameters with a p-th percentile
+        verify latency within target seconds, or the cheapest ones tried if none is. """
+    measure = lambda time_cost, memory_cost: verify_latency(time_cost, memory_cost, parallelism, samples, p)
+    while (latency := measure(1, memory_cost)) > target and memory_cost > min_memory_cost:
+        memory_cost = max(min_memory_cost, memory_cost // 2)
+    time_cost = 1
+    if latency <= target:
+        estimate = min(max_time_cost, int(target / latency))    # cost is about linear in time_cost
+        while estimate > 1 and (estimated_latency := measure(estimate, memory_cost)) > target:
+            estimate -= 1
+        if estimate > 1:
+            time_cost, latency = estimate, estimated_latency
+    return dict(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism), latency
+
+
+import autotest
+test = autotest.get_tester(__name__)
+
+
+@test
+def percentiles():
+    test.eq(95, percentile(range(1, 101), 95))
+    test.eq(3, percentile([3, 1, 2], 95))
+    test.eq(1, percentile([3, 1, 2], 0))
+
+
+@test
+def calibrate_within_budget():
+    parameters, latency = calibrate(target=10, memory_cost=64, min_memory_cost=64, parallelism=1, max_time_cost=3, samples=1)
+    test.eq(dict(time_cost=3, memory_cost=64, parallelism=1), parameters)
+    test.truth(0 < latency < 10)
+
+
+@test
+def calibrate_lowers_memory_first():
+    parameters, latency = calibrate(target=0, memory_cost=256, min_memory_cost=64, parallelism=1, samples=1)
+    test.eq(dict(time_cost=1, memory_cost=64, parallelism=1), parameters)
+    test.truth(latency > 0)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('passwd', help='Password file (or directory containing passwd) to configure', nargs='?')
+    parser.add_argument('--target', help='Verify latency budget in milliseconds', type=float, default=50)
+    parser.add_argument('--percentile', help='Percentile of verify latency that must be within target', type=float, default=95)
+    parser.add_argument('--memory-cost', help='Maximum memory cost in KiB', type=int, default=65536)
+    parser.add_argument('--min-memory-cost', help='Minimum memory cost in KiB', type=int, default=19456)
+    parser.add_argument('--parallelism', help='Number of lanes', type=int, default=4)
+    parser.add_argument('--samples', help='Verifications measured per candidate', type=int, default=20)
+    args = parser.parse_args()
+
+    parameters, latency = calibrate(args.target / 1000, args.percentile, args.memory_cost,
+            args.min_memory_cost, args.parallelism, samples=args.samples)
+    print(f"time_cost={parameters['time_cost']} memory_cost={parameters['memory_cost']} "
+            f"parallelism={parameters['parallelism']}: p{args.percentile:g} {latency*1000:.1f} ms")
+    if latency * 1000 > args.target:
+        print("no parameters within target, using the cheapest tried", file=sys.stderr)
+    if args.passwd:
+        from .passwordfile2 import PasswordFile2
+        PasswordFile2(args.passwd).setHashParameters(**parameters)
+        print(f"stored in {args.passwd}")
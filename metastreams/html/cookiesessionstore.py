@@ -0,0 +1,262 @@
+## begin license ##
+#
+# "Metastreams Html" is a template engine based on generators, and a sequel to Slowfoot.
+# It is also known as "DynamicHtml" or "Seecr Html".
+#
+# Copyright (C) 2023 Seecr (Seek You Too B.V.) https://seecr.nl
+#
+# This file is part of "Metastreams Html"
+#
+# "Metastreams Html" is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# "Metastreams Html" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "Metastreams Html"; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+## end license ##
+
+import json
+import hmac
+import base64
+import hashlib
+import logging
+
+from .sessionstore import Session, SessionStore, timestamp
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+logger = logging.getLogger(__name__)
+
+
+class CookieSession(Session):
+    """ A Session whose identifier is its own signed content, encoded when asked for """
+    __slots__ = ('_encode',)
+
+    def __init__(self, identifier, ttl, encode, on_change):
+        super().__init__(identifier, ttl, on_change=on_change)
+        self._encode = encode
+
+    @property
+    def identifier(self):
+        if self._identifier is None:
+            self._identifier = self._encode(self)
+        return self._identifier
+
+    def __setitem__(self, key, value):
+        """ Refuses what would not come back the same from the cookie, when it is written """
+        try:
+            same = isinstance(key, str) and json.loads(json.dumps(value)) == value
+        except (TypeError, ValueError):
+            same = False
+        if not same:
+            raise TypeError(f"Cannot store {key!r} in a cookie session: only str keys and JSON values "
+                    f"(dict, list, str, int, float, bool, None), not {type(value).__name__}")
+        super().__setitem__(key, value)
+
+
+class CookieSessionStore(SessionStore):
+    """ Stores sessions in the cookie itself, so no state is kept on the server. The
+        session data (JSON only, checked when set) is signed with HMAC-SHA256 using secret,
+        or encrypted and signed when encrypt=True (requires 'cryptography'). Cookies larger
+        than max_size are ignored on read; a session growing larger is logged and sends no
+        cookie, so the client keeps the one it has.
+    """
+    def __init__(self, secret, ttl=2 * 60 * 60, max_size=4000, encrypt=False):
+        super().__init__(ttl=ttl)
+        if isinstance(secret, str):
+            secret = secret.encode()
+        self._key = hashlib.sha256(b'metastreams-session-sign' + secret).digest()
+        self._max_size = max_size
+        self._fernet = None
+        if encrypt:
+            from cryptography.fernet import Fernet
+            self._fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(b'metastreams-session-encrypt' + secret).digest()))
+
+    def get_session(self, identifier):
+        """ A session without a (valid) cookie gets identifier '', until it is changed """
+        session = CookieSession('', self._ttl, self._encode, on_change=self._changed)
+        if identifier and (decoded := self._decode(identifier)) is not None:
+            last_access, data = decoded
+            if last_access + self._ttl >= timestamp():
+                session._restore(last_access, data)
+                session._identifier = identifier
+        return session
+
+    def new_session(self):
+        return CookieSession(None, self._ttl, self._encode, on_change=self._changed)
+
+    def _changed(self, session):
+        session._identifier = None
+
+    def _encode(self, session):
+        payload = json.dumps([session.last_access, session._data], separators=(',', ':')).encode()
+        if self._fernet is not None:
+            value = self._fernet.encrypt(payload).decode().rstrip('=')
+        else:
+            value = f"{_b64encode(payload)}.{_b64encode(hmac.digest(self._key, payload, 'sha256'))}"
+        if len(value) > self._max_size:
+            logger.error(f"Session too large for a cookie, not sent: {len(value)} > {self._max_size} bytes "
+                    f"(keys {', '.join(session)})")
+            return ''   # as a session without cookie
+        return value
+
+    def _decode(self, value):
+        if len(value) > self._max_size:
+            return None
+        try:
+            if self._fernet is not None:
+                payload = self._fernet.decrypt((value + '=' * (-len(value) % 4)).encode())
+            else:
+                payload, signature = value.split('.')
+                payload = _b64decode(payload)
+                if not hmac.compare_digest(_b64decode(signature), hmac.digest(self._key, payload, 'sha256')):
+                    return None
+            last_access, data = json.loads(payload)
+            return last_access, data
+        except Exception:
+            return None
+
+    def __contains__(self, session):
+        return session.identifier != ''
+
+
+import autotest
+test = autotest.get_tester(__name__)
+
+
+@test
+def cookie_session_roundtrip():
+    store = CookieSessionStore('secret')
+    session = store.get_session(None)
+    test.eq('', session.identifier)
+    test.truth(session not in store)
+    session['user'] = {'username': 'aap', 'admin': False}
+    test.truth(session in store)
+    value = session.identifier
+    test.truth('aap' not in value)  # base64
+
+    session = CookieSessionStore('secret').get_session(value)
+    test.eq(value, session.identifier)
+    test.eq({'username': 'aap', 'admin': False}, session['user'])
+    session.pop('user')
+    test.ne(value, session.identifier)
+    test.truth(session in store)
+
+
+@test
+def cookie_session_tampered_or_wrong_secret():
+    store = CookieSessionStore('secret')
+    session = store.new_session()
+    session['user'] = 'aap'
+    value = session.identifier
+    payload, signature = value.split('.')
+    forged = _b64encode(_b64decode(payload).replace(b'aap', b'god')) + '.' + signature
+    test.eq(None, store.get_session(forged).get('user'))
+    test.eq(None, CookieSessionStore('other secret').get_session(value).get('user'))
+    test.eq(None, store.get_session('garbage').get('user'))
+    test.eq('aap', store.get_session(value).get('user'))
+
+
+@test
+def cookie_session_expires():
+    store = CookieSessionStore('secret', ttl=.1)
+    session = store.new_session()
+    session['user'] = 'aap'
+    value = session.identifier
+    import time
+    time.sleep(.11)
+    test.eq(None, store.get_session(value).get('user'))
+
+
+@test
+def cookie_session_size_limit():
+    store = CookieSessionStore('secret', max_size=100)
+    session = store.new_session()
+    session['data'] = 'x' * 100
+    with test.stderr as err:
+        test.eq('', session.identifier)
+    test.startswith(err.getvalue(), "Session too large for a cookie, not sent: ")
+    test.contains(err.getvalue(), "(keys data)")
+    test.truth(session not in store)
+    session['data'] = 'x'
+    test.truth(session in store)
+    test.eq('x', store.get_session(session.identifier)['data'])
+    test.eq('', store.get_session('x' * 101).identifier)
+
+
+@test
+def cookie_session_only_json():
+    session = CookieSessionStore('secret').new_session()
+    session['user'] = {'username': 'aap', 'roles': ['admin'], 'id': 1, 'active': True, 'name': None}
+    class User:
+        pass
+    for key, value in (('user', User()), ('user', ('aap', 'admin')), ('when', {1: 'one'}), (1, 'one')):
+        try:
+            session[key] = value
+            test.fail()
+        except TypeError as e:
+            test.startswith(str(e), f"Cannot store {key!r} in a cookie session: only str keys and JSON values")
+    test.eq(['user'], list(session))
+
+
+@test
+async def cookie_session_with_dynamic_handler():
+    from .dynamic_handler import dynamic_handler, MockRequest
+    class MockDynamicHtml:
+        def is_sessionless(self, request):
+            return False
+        async def handle_request(self, request, session, **kwargs):
+            async def _render():
+                if request.path == '/login':
+                    session['user'] = 'aap'
+                yield f"user: {session.get('user')}"
+            return _render()
+    handler = dynamic_handler(MockDynamicHtml(), session_store=CookieSessionStore('secret'))
+    response = await handler(MockRequest(path="/"))
+    test.eq({}, dict(response.cookies))
+    response = await handler(MockRequest(path="/login"))
+    value = response.cookies['METASTREAMS_SESSION'].value
+    request = MockRequest(path="/")
+    request.cookies['METASTREAMS_SESSION'] = value
+    response = await handler(request)
+    test.eq({}, dict(response.cookies))
+    test.eq(b"user: aap", request._payload_writer.content)
+
+    handler = dynamic_handler(MockDynamicHtml(), session_store=CookieSessionStore('secret', max_size=10))
+    request = MockRequest(path="/login")
+    with test.stderr as err:
+        response = await handler(request)
+    test.eq({}, dict(response.cookies))
+    test.eq(b"user: aap", request._payload_writer.content)
+    test.startswith(err.getvalue(), "Session too large for a cookie")
+
+
+try:
+    import cryptography
+except ImportError:
+    pass
+else:
+    @test
+    def encrypted_cookie_session():
+        store = CookieSessionStore('secret', encrypt=True)
+        session = store.new_session()
+        session['user'] = 'aap'
+        value = session.identifier
+        test.truth('=' not in value)
+        test.eq('aap', store.get_session(value)['user'])
+        test.eq(None, CookieSessionStore('secret').get_session(value).get('user'))
+        test.eq(None, CookieSessionStore('other', encrypt=True).get_session(value).get('user'))
@@ -23,7 +23,10 @@
 #
 ## end license ##
 
-from metastreams.html import SessionStore, DynamicHtml, Cookie
+from .sessionstore import SessionStore
+from .dynamichtml import DynamicHtml, split_path
+from .preload import preloads, early_hints as send_early_hints
+from .cookie import Cookie
 
 from aiohttp import web as aiohttp_web
 from aiohttp.web import HTTPInternalServerError
@@ -31,14 +34,14 @@ import traceback
 import json
 
 
-async def prepare(request, response, cookie, session, content_type=None):
-    if response.prepared is True:
-        return
-    if content_type is not None and 'Content-Type' not in response.headers:
-        response.headers['Content-Type'] = content_type
-    if session is not None:
-        cookie.write_to_response(response, session.identifier)
-    await response.prepare(request)
+async def prepare(request, response, set_cookie, content_type=None):
+    if response.prepared is False:
+        if content_type is not None and 'Content-Type' not in response.headers:
+            response.headers['Content-Type'] = content_type
+        if values := preloads(response):
+            response.headers['Link'] = ', '.join(filter(None, [response.headers.get('Link')] + values))
+        set_cookie(response)
+    return await response.prepare(request)
 
 def as_bytes(value):
     if isinstance(value, bytes):
@@ -47,42 +50,91 @@ def as_bytes(value):
         value = str(value)
     return bytes(value, encoding='utf-8')
 
-def dynamic_handler(dHtml, enable_sessions=True, session_cookie_name="METASTREAMS_SESSION"):
-    cookie, session_store = None, None
+async def write_body(request, response, set_cookie, result, hold=None):
+    """ Prepares the response once, on the first non-empty chunk, so templates can set
+        headers until then. The rest goes straight to the payload writer, which drains
+        only when the transport is above its high-water mark. While hold() is true, chunks
+        are kept back: a new session stored later on still needs its cookie in the headers. """
+    held = []
+    async for each in result:
+        if data := as_bytes(each):
+            held.append(data)
+            if hold is None or not hold():
+                break
+    if not held:
+        return
+    write = (await prepare(request, response, set_cookie, content_type='text/html; charset=utf-8')).write
+    await write(b''.join(held))
+    async for each in result:
+        await write(as_bytes(each))
+
+def dynamic_handler(dHtml, enable_sessions=True, session_cookie_name="METASTREAMS_SESSION", session_store=None,
+        early_hints=False):
+    """ With early_hints, the preloads of the previous render of a page are sent as
+        103 Early Hints before rendering it again. """
+    cookie = None
+    hints = {}  # module name -> preloads of its last render
     if enable_sessions is True:
         cookie = Cookie(session_cookie_name)
-        session_store = SessionStore()
+        if session_store is None:
+            session_store = SessionStore()
 
     async def _handler(request):
-        session = None
-        if enable_sessions:
-            session = session_store.get_session(cookie.read_from_request(request))
+        session = identifier = None
+        if enable_sessions and not dHtml.is_sessionless(request):
+            identifier = cookie.read_from_request(request)
+            session = session_store.get_session(identifier)
+
+        def new_session():
+            # a new session has no identifier until something is stored in it
+            return session is not None and (session.identifier is None or session.identifier != identifier)
+
+        def set_cookie(response):
+            # only when a new session got stored, so other responses stay cacheable
+            if new_session() and session in session_store:
+                cookie.write_to_response(response, session.identifier)
+
+        def hold():
+            return new_session() and session not in session_store
+
+        try:
+            return await _handle(request, session, set_cookie, hold)
+        finally:
+            if session is not None:
+                session_store.flush()
 
+    async def _handle(request, session, set_cookie, hold):
         response = aiohttp_web.StreamResponse(
             status=200,
             reason='OK',
         )
         if request.method == "POST":
             result = await dHtml.handle_post_request(request=request, session=session)
+            if session is not None:
+                session_store.flush()   # before the client sees the result
             if isinstance(result, str):
                 redirect = aiohttp_web.HTTPFound(result)
-                if session is not None:
-                    cookie.write_to_response(redirect, session.identifier)
+                set_cookie(redirect)
                 raise redirect
             elif isinstance(result, dict):
-                await prepare(request, response, cookie, session, content_type='application/json; charset=utf-8')
+                await prepare(request, response, set_cookie, content_type='application/json; charset=utf-8')
                 await response.write(as_bytes(json.dumps(result)))
         else:
             try:
                 result = await dHtml.handle_request(request=request, response=response, session=session)
-                async for each in result:
-                    await prepare(request, response, cookie, session, content_type='text/html; charset=utf-8')
-                    await response.write(as_bytes(each))
-            except aiohttp_web.HTTPException:
+                if early_hints:
+                    modname = split_path(request.path, 1)
+                    send_early_hints(request, list(dict.fromkeys(preloads(response) + hints.get(modname, []))))
+                await write_body(request, response, set_cookie, result, hold)
+                if early_hints:
+                    hints[modname] = preloads(response)
+            except aiohttp_web.HTTPException as e:
+                set_cookie(e)
                 raise
             except Exception as e:
                 traceback.print_exc(chain=False)
                 raise HTTPInternalServerError(text=str(e))
+        await prepare(request, response, set_cookie)
         await response.write_eof()
         return response
 
@@ -119,6 +171,8 @@ class MockRequest:
 
 class test_rendering:
     class MockDynamicHtml:
+        def is_sessionless(self, request):
+            return False
         def __init__(self, response):
             self._response = response
         async def handle_request(self, *args, **kwargs):
@@ -150,9 +204,107 @@ class test_rendering:
         response = await handler(request)
         test.eq(b"MakeItBytes: 42, {'key': 'value'}, ('tuple',)", request._payload_writer.content)
 
+@test
+async def test_prepare_once_on_first_content():
+    class MockDynamicHtml:
+        def is_sessionless(self, request):
+            return False
+        async def handle_request(self, response, **kwargs):
+            async def _render():
+                yield ""
+                response.headers['Content-Type'] = 'text/plain'
+                yield "content"
+                yield ""
+                yield b"more"
+            return _render()
+    handler = dynamic_handler(MockDynamicHtml())
+    request = MockRequest(path="/")
+    response = await handler(request)
+    test.eq('text/plain', response.headers['Content-Type'])
+    test.eq(1, len(request._payload_writer.headers))
+    test.eq(b"contentmore", request._payload_writer.content)
+
+@test
+async def test_render_empty_page():
+    class MockDynamicHtml:
+        def is_sessionless(self, request):
+            return False
+        async def handle_request(self, *args, **kwargs):
+            async def _render():
+                yield ""
+            return _render()
+    handler = dynamic_handler(MockDynamicHtml())
+    request = MockRequest(path="/")
+    response = await handler(request)
+    test.eq(1, len(request._payload_writer.headers))
+    test.eq(b"", request._payload_writer.content)
+
+@test
+async def test_cookie_only_when_session_stored():
+    class MockDynamicHtml:
+        def is_sessionless(self, request):
+            return request.path == '/sessionless'
+        async def handle_request(self, request, session, **kwargs):
+            async def _render():
+                if request.path == '/store':
+                    session['key'] = 'value'
+                yield f"session: {session is not None}"
+            return _render()
+    session_store = SessionStore()
+    handler = dynamic_handler(MockDynamicHtml(), session_store=session_store)
+
+    response = await handler(MockRequest(path="/"))
+    test.eq({}, dict(response.cookies))
+    test.eq(0, len(session_store))
+
+    request = MockRequest(path="/store")
+    response = await handler(request)
+    identifier = response.cookies['METASTREAMS_SESSION'].value
+    test.eq(1, len(session_store))
+    test.eq('value', session_store.get_session(identifier)['key'])
+
+    request = MockRequest(path="/store")
+    request.cookies['METASTREAMS_SESSION'] = identifier
+    response = await handler(request)
+    test.eq({}, dict(response.cookies))
+    test.eq(1, len(session_store))
+
+    request = MockRequest(path="/sessionless")
+    response = await handler(request)
+    test.eq(b"session: False", request._payload_writer.content)
+
+@test
+async def test_cookie_for_session_stored_after_output_started():
+    class MockDynamicHtml:
+        def is_sessionless(self, request):
+            return False
+        async def handle_request(self, request, session, **kwargs):
+            async def _render():
+                yield "before "
+                if request.path == '/store':
+                    session['key'] = 'value'
+                yield "after"
+            return _render()
+    session_store = SessionStore()
+    handler = dynamic_handler(MockDynamicHtml(), session_store=session_store)
+
+    request = MockRequest(path="/store")
+    response = await handler(request)
+    test.eq(b"before after", request._payload_writer.content)
+    identifier = response.cookies['METASTREAMS_SESSION'].value
+    test.eq('value', session_store.get_session(identifier)['key'])
+
+    request = MockRequest(path="/")
+    response = await handler(request)
+    test.eq(b"before after", request._payload_writer.content)
+    test.eq({}, dict(response.cookies))
+    test.eq(1, len(session_store))
+
 @test
 async def test_error_message_rendering(stderr):
     class MockDynamicHtml:
+        def is_sessionless(self, request):
+            return False
         def handle_request(self, *args, **kwargs):
             1/0
     handler = dynamic_handler(MockDynamicHtml())
@@ -202,6 +354,52 @@ async def test_post_request_dict_():
     test.eq("application/json; charset=utf-8", response.headers['Content-Type'])
     test.eq(b'{"success": true}', request._payload_writer.content)
 
+@test
+async def test_preloads_as_link_header_and_early_hints():
+    from .preload import preload
+    from aiohttp.http import HttpVersion11
+    class MockDynamicHtml:
+        def is_sessionless(self, request):
+            return True
+        async def handle_request(self, request, response, **kwargs):
+            preload(response, '/static/declared.css')
+            async def _render():
+                preload(response, '/static/main.js', rel='modulepreload')
+                yield "page"
+                preload(response, '/static/too-late.js')
+            return _render()
+    class Transport:
+        def __init__(self):
+            self.data = b''
+        def is_closing(self):
+            return False
+        def write(self, data):
+            self.data += data
+    def request11():
+        request = MockRequest(path="/page")
+        request.version = HttpVersion11
+        request.transport = Transport()
+        request._payload_writer.enable_chunking = lambda: None
+        return request
+
+    handler = dynamic_handler(MockDynamicHtml(), early_hints=True)
+    request = request11()
+    response = await handler(request)
+    test.eq('</static/declared.css>; rel=preload; as=style, </static/main.js>; rel=modulepreload', response.headers['Link'])
+    test.eq(b'HTTP/1.1 103 Early Hints\r\nLink: </static/declared.css>; rel=preload; as=style\r\n\r\n', request.transport.data)
+
+    request = request11()
+    await handler(request)
+    test.eq(b'HTTP/1.1 103 Early Hints\r\n'
+            b'Link: </static/declared.css>; rel=preload; as=style\r\n'
+            b'Link: </static/main.js>; rel=modulepreload\r\n'
+            b'Link: </static/too-late.js>; rel=preload; as=script\r\n\r\n', request.transport.data)
+
+    request = request11()
+    response = await dynamic_handler(MockDynamicHtml())(request)
+    test.eq(b'', request.transport.data)
+    test.contains(response.headers['Link'], '</static/main.js>; rel=modulepreload')
+
 # @test
 # async def handle_bytes_data():
 #     class MockDynamicHtml:
@@ -42,7 +42,8 @@ test = autotest.get_tester(__name__)
 from .utils import Dict
 from ._tag import TagFactory
 from .sfimporter import TemplateImporter, guarded_path, sfimporter
-from .stdsflib import builtins
+from .stdsflib import builtins, load as load_builtin
+from .preload import declare
 
 
 class DynamicHtml:
@@ -53,6 +54,7 @@ class DynamicHtml:
         else:
             self._rootmodule = None
         self._default = default
+        self._resolved = None   # (request, module, error) of the last is_sessionless
 
 
     async def render_page(self, mod, request, response, session=None):
@@ -114,7 +116,7 @@ class DynamicHtml:
         modname, method_name = split_path(request.path, 2)
         if method_name is None:
             raise HTTPNotFound()
-        mod = self._load_module(modname)
+        mod = self._request_module(request, modname)
 
         # TODO: check if allowed to use method, else 405
         try:
@@ -126,17 +128,38 @@ class DynamicHtml:
         return return_url
 
 
+    def is_sessionless(self, request):
+        """ Templates that never use the session declare 'sessionless = True'. The module, or
+            the error loading it, is kept for handling the same request. """
+        try:
+            mod = self._load_module(split_path(request.path, 1))
+        except Exception as e:
+            self._resolved = (request, None, e)
+            return False  # reported when handling the request
+        self._resolved = (request, mod, None)
+        return getattr(mod, 'sessionless', False) is True
+
+
     async def handle_request(self, request, response, session=None): #GET
-        modname = split_path(request.path, 1)
-        mod = self._load_module(modname)
+        mod = self._request_module(request, split_path(request.path, 1))
+        declare(response, getattr(mod, 'preloads', ()))
         return self.render_page(mod, request, response, session=session)
 
+    def _request_module(self, request, modname):
+        if (resolved := self._resolved) is not None and resolved[0] is request:
+            self._resolved = None
+            _, mod, error = resolved
+            if error is not None:
+                raise error
+            return mod
+        return self._load_module(modname)
+
     def _load_module(self, modname):
         if not modname:
             modname = self._default
         if modname in builtins:
-            fullname = 'metastreams.html.stdsflib.' + modname
-        elif self._rootmodule:
+            return load_builtin(modname)
+        if self._rootmodule:
             fullname = '.'.join((self._rootmodule, modname))
         else:
             fullname = modname
@@ -377,15 +400,57 @@ async def test_default_page(sfimporter, guarded_path):
 @test
 async def use_builtins(sfimporter):
     d = DynamicHtml(None)
+    result = await d.handle_request(request=MockRequest(path="/page"), response=None)
+    test.eq("", ''.join([i async for i in result]))
+    assert 'page' not in sys.modules
+    # loaded once, for testing, and kept
+    test.eq(id(sys.modules['metastreams.html.stdsflib.page']), id(d._load_module('page')))
+
+
+@test
+async def watch_builtins_loaded_before_install():
+    from .stdsflib import load
+    page = load('page')     # before any TemplateImporter of this test
+    im = await TemplateImporter.install()
     try:
-        result = await d.handle_request(request=MockRequest(path="/page"), response=None)
-        test.eq("", ''.join([i async for i in result]))
+        test.eq('metastreams.html.stdsflib.page', im._path2modname[page.__spec__.origin])
     finally:
-        assert 'page' not in sys.modules
-        sys.modules.pop('metastreams.html.stdsflib.page')
+        sys.meta_path.remove(im)
+        im.task.cancel()
+
 
 
 
+@test
+async def test_sessionless(sfimporter, guarded_path):
+    (dyn_dir := guarded_path / "pruts").mkdir(parents=True)
+    (dyn_dir / "with_session.sf").write_text("def main(**k): yield 1")
+    (dyn_dir / "without_session.sf").write_text("sessionless = True\ndef main(**k): yield 1")
+    d = DynamicHtml("pruts")
+    test.eq(False, d.is_sessionless(MockRequest(path="/with_session")))
+    test.eq(True, d.is_sessionless(MockRequest(path="/without_session/more")))
+    test.eq(False, d.is_sessionless(MockRequest(path="/does_not_exist")))
+
+    from aiohttp.web import StreamResponse
+    loaded = []
+    class CountingDynamicHtml(DynamicHtml):
+        def _load_module(self, modname):
+            loaded.append(modname)
+            return super()._load_module(modname)
+    d = CountingDynamicHtml("pruts")
+    request = MockRequest(path="/without_session")
+    test.eq(True, d.is_sessionless(request))
+    await d.handle_request(request, StreamResponse())
+    test.eq(['without_session'], loaded)
+    request = MockRequest(path="/does_not_exist")
+    test.eq(False, d.is_sessionless(request))
+    try:
+        await d.handle_request(request, StreamResponse())
+        test.fail()
+    except HTTPNotFound:
+        pass
+    test.eq(['without_session', 'does_not_exist'], loaded)
+
 
 @test
 async def test_handle_post_request(sfimporter, guarded_path):
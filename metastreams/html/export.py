@@ -0,0 +1,272 @@
+## begin license ##
+#
+# "Metastreams Html" is a template engine based on generators, and a sequel to Slowfoot.
+# It is also known as "DynamicHtml" or "Seecr Html".
+#
+# Copyright (C) 2023 Seecr (Seek You Too B.V.) https://seecr.nl
+#
+# This file is part of "Metastreams Html"
+#
+# "Metastreams Html" is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# "Metastreams Html" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "Metastreams Html"; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+## end license ##
+
+""" Renders pages that do not change between deploys (documentation, help, landing pages)
+    to files, to be served as static files by static_handler or a proxy:
+
+        python -m metastreams.html.export --rootmodule pages --output /var/www/site --crawl /index
+
+    Each path is rendered by DynamicHtml.handle_request with a stub GET request and no
+    session, in parallel processes. /help is written as help.html, /help/ as
+    help/index.html; .gz (and .br) variants are written by precompress. With --crawl, the
+    site's links (<a href="/...">) in rendered pages are exported too. Pages use the same
+    content-hashed static URLs as the server, given the same --static_dir.
+
+    A proxy can serve them with e.g. nginx 'try_files $uri.html $uri/index.html @app;'.
+"""
+
+import sys
+import asyncio
+import posixpath
+from pathlib import Path
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+__all__ = ['export']
+
+
+def output_name(path):
+    """ File name relative to the output directory for path """
+    if urlsplit(path).query or not path.startswith('/'):
+        raise ValueError(f"Cannot export {path!r}: only paths without a query")
+    name = posixpath.normpath(path).lstrip('/')     # stays below output, even for /../x
+    if not name:
+        return 'index.html'
+    return f'{name}/index.html' if path.endswith('/') else f'{name}.html'
+
+
+class _Links(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.hrefs = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a' and (href := dict(attrs).get('href')):
+            self.hrefs.append(href)
+
+
+def site_links(html, static_path='/static'):
+    """ Paths of the site that html links to, other than static files """
+    parser = _Links()
+    parser.feed(html)
+    links = []
+    for href in parser.hrefs:
+        parts = urlsplit(href)
+        if parts.scheme or parts.netloc or parts.query or not parts.path.startswith('/') \
+                or parts.path == static_path or parts.path.startswith(static_path + '/'):
+            continue
+        if parts.path not in links:
+            links.append(parts.path)
+    return links
+
+
+async def render(dHtml, path):
+    """ HTML of path as rendered by dHtml for a GET without session """
+    from aiohttp import web as aiohttp_web
+    from aiohttp.test_utils import make_mocked_request
+    from .dynamic_handler import as_bytes
+    request = make_mocked_request('GET', path, headers={'Host': 'localhost'})
+    response = aiohttp_web.StreamResponse()
+    result = await dHtml.handle_request(request=request, response=response, session=None)
+    body = b''.join([as_bytes(each) async for each in result])
+    if response.status != 200:
+        raise ValueError(f"status {response.status}")
+    return body
+
+
+_worker = None
+
+
+def _init_worker(rootmodule, index, context, static_dirs, static_path, output):
+    global _worker
+    from .sfimporter import TemplateImporter
+    from .dynamichtml import DynamicHtml
+    from .static_handler import StaticFiles, AssetManifest
+    from .paths import usr_share_path
+    if not any(isinstance(importer, TemplateImporter) for importer in sys.meta_path):
+        sys.meta_path.append(TemplateImporter())    # finds templates; no need to watch them
+    static_files = StaticFiles(tuple(static_dirs) + (usr_share_path,), watch=False)    # index built once
+    context = dict(context, asset_manifest=AssetManifest(static_files, static_path))
+    _worker = asyncio.new_event_loop(), DynamicHtml(rootmodule, default=index, context=context), Path(output), static_path
+
+
+def _export_one(path):
+    """ Renders and writes path; returns (links, None) or (None, error) """
+    loop, dHtml, output, static_path = _worker
+    try:
+        body = loop.run_until_complete(render(dHtml, path))
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+    target = output / output_name(path)
+    try:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(target.name + '~')
+        tmp.write_bytes(body)
+        tmp.rename(target)
+    except OSError as e:
+        return None, f"{type(e).__name__}: {e}"
+    return site_links(body.decode(errors='replace'), static_path), None
+
+
+def export(rootmodule, paths, output, index='index', context=None, static_dirs=(), static_path='/static',
+        crawl=False, processes=None, log=print):
+    """ Renders paths (and with crawl the pages they link to) into output; returns the paths
+        written and a dict of the paths that failed with their errors; a path whose file is
+        written for a different page (e.g. /index when / renders another index) fails too. """
+    from .precompress import precompress
+    names = {}  # output name -> path, one path per file
+    written, failed = [], {}
+
+    def claim(path):
+        """ Whether path gets its output file; a different page for the same file fails """
+        name = output_name(path)
+        if (other := names.setdefault(name, path)) == path:
+            return True
+        page = lambda p: f'/{index}' if p == '/' else p     # '/' renders the index page
+        if page(other) != page(path) and path not in failed:
+            failed[path] = f"{name} is written for {other}"
+            log(f"{path}: {failed[path]}")
+        return False
+
+    paths = [path for path in paths if claim(path)]
+    Path(output).mkdir(parents=True, exist_ok=True)
+    initargs = (rootmodule, index, context or {}, tuple(str(d) for d in static_dirs), static_path, str(output))
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=initargs) as pool:
+        pending = {pool.submit(_export_one, path): path for path in paths}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                links, error = future.result()
+                if error is not None:
+                    failed[path] = error
+                    log(f"{path}: {error}")
+                    continue
+                written.append(path)
+                for link in links if crawl else ():
+                    if link not in names.values() and claim(link):
+                        pending[pool.submit(_export_one, link)] = link
+    precompress(output)
+    return written, failed
+
+
+import autotest
+test = autotest.get_tester(__name__)
+
+from .dynamichtml import guarded_path
+test.fixture(guarded_path)
+
+
+@test
+def output_names():
+    test.eq('index.html', output_name('/'))
+    test.eq('index.html', output_name('/index'))
+    test.eq('help/index.html', output_name('/help/'))
+    test.eq('help/topic.html', output_name('/help/topic'))
+    test.eq('etc/passwd.html', output_name('/../etc/passwd'))
+    for path in ('/page?id=1', 'relative'):
+        try:
+            output_name(path)
+            test.fail()
+        except ValueError:
+            pass
+
+@test
+def links_of_the_site():
+    test.eq(['/help', '/help/topic', '/'], site_links('''
+        <a href="/help">help</a> <a href="/help#top">again</a> <a href="/help/topic">topic</a> <a href="/">home</a>
+        <a href="https://elsewhere/">other</a> <a href="//elsewhere/x">other</a> <a href="relative">?</a>
+        <a href="/static/doc.pdf">pdf</a> <a href="/search?q=x">search</a> <a>none</a>'''))
+
+@test
+def export_pages(guarded_path):
+    (guarded_path/'pages').mkdir()
+    (guarded_path/'pages'/'index.sf').write_text("""
+from metastreams.html.stdsflib import page
+def main(tag, **kwargs):
+    with page.render(tag, **kwargs):
+        with tag('a', href='/help'): yield 'help'
+        with tag('a', href='/missing'): yield 'missing'
+        yield "welcome " * 100
+""")
+    (guarded_path/'pages'/'help.sf').write_text("""
+def main(tag, request, session, context, **kwargs):
+    yield f"help for {request.path}, session {session}, {context.name}"
+    with tag('a', href='/'): yield 'home'
+""")
+    (guarded_path/'static').mkdir()
+    output = guarded_path/'out'
+    logged = []
+    written, failed = export('pages', ['/index'], output, context={'name': 'aap'}, static_dirs=[guarded_path/'static'],
+            crawl=True, processes=2, log=logged.append)
+    test.eq(['/help', '/index'], sorted(written))
+    test.eq(['/missing'], list(failed))
+    test.eq(1, len(logged))
+    test.eq('help for /help, session None, aap<a href="/">home</a>', (output/'help.html').read_text())
+    index = (output/'index.html').read_text()
+    test.contains(index, 'welcome')
+    test.contains(index, '<script src="/static/main.')
+    import gzip
+    test.eq(index, gzip.decompress((output/'index.html.gz').read_bytes()).decode())
+
+    written, failed = export('pages', ['/help'], output, context={'name': 'noot'}, processes=1)
+    test.eq(['/help'], written)
+    test.eq((['/'], {}), export('pages', ['/', '/index'], output, processes=1))
+    written, failed = export('pages', ['/', '/index'], output, index='help', context={'name': 'wim'}, processes=1,
+            log=logged.append)
+    test.eq(['/'], written)
+    test.eq({'/index': 'index.html is written for /'}, failed)
+    test.eq('/index: index.html is written for /', logged[-1])
+    test.contains((output/'index.html').read_text(), 'help for /, session None, wim')
+    test.contains((output/'help.html').read_text(), 'noot')
+
+    (output/'help.html').unlink()
+    (output/'help.html').mkdir()
+    written, failed = export('pages', ['/help', '/'], output, context={'name': 'mies'}, processes=1, log=logged.append)
+    test.eq(['/'], written)
+    test.eq(['/help'], list(failed))
+    test.truth(failed['/help'].startswith('IsADirectoryError: '))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('paths', help='Paths to render, e.g. /index /help/', nargs='+')
+    parser.add_argument('--rootmodule', help='Root module for resolving templates', default=None)
+    parser.add_argument('--index', help='Page shown when / is specified', default="index")
+    parser.add_argument('--output', help='Directory to write the pages in', required=True)
+    parser.add_argument('--static_path', help='path static files are served at.', default="/static")
+    parser.add_argument('--static_dir', help='directory containing static files', action='append', default=[])
+    parser.add_argument('--crawl', help='Also export the pages of the site that pages link to', action='store_true')
+    parser.add_argument('--processes', help='Number of rendering processes (default: number of CPUs)', type=int, default=None)
+    parser.add_argument('--inline-css', help='Inline stylesheets up to this many bytes in pages', type=int, default=None)
+    args = parser.parse_args()
+
+    context = {} if args.inline_css is None else {'inline_css': args.inline_css}
+    written, failed = export(args.rootmodule, args.paths, args.output, index=args.index, context=context,
+            static_dirs=args.static_dir, static_path=args.static_path, crawl=args.crawl, processes=args.processes)
+    print(f"{args.output}: {len(written)} pages written, {len(failed)} failed")
+    sys.exit(1 if failed else 0)
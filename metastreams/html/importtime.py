@@ -0,0 +1,116 @@
+## begin license ##
+#
+# "Metastreams Html" is a template engine based on generators, and a sequel to Slowfoot.
+# It is also known as "DynamicHtml" or "Seecr Html".
+#
+# Copyright (C) 2023 Seecr (Seek You Too B.V.) https://seecr.nl
+#
+# This file is part of "Metastreams Html"
+#
+# "Metastreams Html" is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# "Metastreams Html" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "Metastreams Html"; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+## end license ##
+
+""" Measures the time it takes to import a module in a fresh interpreter, based on
+    'python -X importtime', and fails when it exceeds a budget:
+
+        python -m metastreams.html.importtime --budget 150
+
+    The module is imported the way applications do, so without METASTREAMS_HTML_TESTS,
+    which imports all modules for their tests.
+"""
+
+import os
+import sys
+import subprocess
+
+__all__ = ['import_time']
+
+
+budget = .150   # seconds for importing metastreams.html, asserted by a test below
+
+# reported when loaded; the template engine (_tag) itself needs weightless and autotest
+heavy_dependencies = ('aiohttp', 'aionotify', 'argon2', 'autotest', 'weightless')
+engine_dependencies = ['autotest', 'weightless']
+
+
+def parse_importtime(output):
+    """ Returns [(module, self_us, cumulative_us)] for top level imports """
+    result = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if name.startswith('  ') or not self_us.strip().isdigit():
+            continue  # nested import or header
+        result.append((name.strip(), int(self_us), int(cumulative_us)))
+    return result
+
+
+def import_time(modname='metastreams.html', optimize=False):
+    """ Imports modname in a fresh interpreter; returns (seconds, top level imports, heavy dependencies loaded) """
+    check = f"import sys; print(','.join(m for m in {heavy_dependencies!r} if m in sys.modules))"
+    cmd = [sys.executable] + (['-O'] if optimize else []) + ['-X', 'importtime', '-c', f"import {modname}; {check}"]
+    env = {k: v for k, v in os.environ.items() if k != 'METASTREAMS_HTML_TESTS'}
+    p = subprocess.run(cmd, capture_output=True, text=True, check=True, env=env)
+    imports = parse_importtime(p.stderr)
+    return sum(c for _, _, c in imports) / 1e6, imports, [m for m in p.stdout.strip().split(',') if m]
+
+
+import autotest
+test = autotest.get_tester(__name__)
+
+
+@test
+def parse_importtime_output():
+    output = """import time: self [us] | cumulative | imported package
+import time:        81 |         81 |   _io
+import time:       120 |        201 | io
+import time:        35 |         35 |     a.b
+import time:       564 |      59982 | metastreams.html
+"""
+    test.eq([('io', 120, 201), ('metastreams.html', 564, 59982)], parse_importtime(output))
+
+
+@test
+def no_heavy_dependencies_for_template_engine():
+    seconds, imports, heavy = import_time('metastreams.html')
+    test.eq(engine_dependencies, heavy)
+    test.truth(seconds > 0)
+
+@test
+def import_within_budget():
+    # best of three, as a busy machine slows down any single run
+    seconds = min(import_time('metastreams.html', optimize=True)[0] for _ in range(3))
+    test.lt(seconds, budget)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--module', help='Module to import', default='metastreams.html')
+    parser.add_argument('--budget', help='Maximum import time in milliseconds', type=float, default=budget * 1000)
+    parser.add_argument('--top', help='Number of slowest imports to show', type=int, default=10)
+    args = parser.parse_args()
+
+    seconds, imports, heavy = import_time(args.module)
+    for name, self_us, cumulative_us in sorted(imports, key=lambda i: i[2], reverse=True)[:args.top]:
+        print(f"{cumulative_us/1000:8.1f} ms  {name}")
+    print(f"{seconds*1000:8.1f} ms  total, budget {args.budget:.0f} ms")
+    if heavy:
+        print(f"heavy dependencies loaded: {', '.join(heavy)}")
+    if seconds * 1000 > args.budget:
+        print("import time exceeds budget", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,521 @@
+## begin license ##
+#
+# "Metastreams Html" is a template engine based on generators, and a sequel to Slowfoot.
+# It is also known as "DynamicHtml" or "Seecr Html".
+#
+# Copyright (C) 2023 Seecr (Seek You Too B.V.) https://seecr.nl
+#
+# This file is part of "Metastreams Html"
+#
+# "Metastreams Html" is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# "Metastreams Html" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "Metastreams Html"; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+## end license ##
+
+""" Bundles an ES module and the modules it imports into one file with a source map, to
+    avoid the waterfall of imports on a cold page load. Either at build time:
+
+        python -m metastreams.html.jsbundle [--strip-tests] usr-share main.js
+
+    which writes main.bundle.js and main.bundle.js.map next to main.js (run precompress
+    afterwards for their compressed variants), or on first request by StaticFiles with
+    bundle_js=True.
+
+    Each module runs in its own function scope, in dependency order, so top level names
+    do not clash. Only static imports of relative specifiers are supported:
+    import {a, b as c} from "./x.js", import * as x from "./x.js" and import "./x.js",
+    with exports as export function/class/const/let/var and export {a, b as c}. Imported
+    names are copies, so a module reassigning an exported let or var cannot be bundled.
+    Modules are kept in one registry for all bundles on a page and run once. A dynamic
+    import('/static/x.js') loads x.bundle.js instead (x.js when that fails), so that x
+    shares the modules already loaded rather than importing second copies of them;
+    relative specifiers in import() resolve against the bundle, not the module.
+    With strip_tests, top level test(...) registrations, up to their closing parenthesis,
+    and the get_tester() they use are left out.
+"""
+
+import re
+import json
+import posixpath
+from pathlib import Path
+from collections import namedtuple
+
+__all__ = ['bundle']
+
+
+Bundle = namedtuple('Bundle', ['code', 'source_map', 'sources'])
+
+BUNDLE_SUFFIX = '.bundle.js'
+
+IMPORT = re.compile(r'''^import\s*(?:\{(?P<names>[^}]*)\}|\*\s*as\s+(?P<namespace>[\w$]+))\s*from\s*(?P<q>['"])(?P<specifier>[^'"]+)(?P=q)[ \t]*;?[ \t]*$''', re.M)
+SIDE_EFFECT_IMPORT = re.compile(r'''^import\s*(?P<q>['"])(?P<specifier>[^'"]+)(?P=q)[ \t]*;?[ \t]*$''', re.M)
+EXPORT_DECLARATION = re.compile(r'^export\s+(?=(?:async\s+)?function\b\s*\*?\s*(?P<function>[\w$]+)|class\s+(?P<class>[\w$]+)|(?:const|let|var)\s+(?P<variable>[\w$]+))', re.M)
+EXPORT_LIST = re.compile(r'^export\s*\{(?P<names>[^}]*)\}[ \t]*;?[ \t]*$', re.M)
+UNSUPPORTED = re.compile(r'^(?:import|export)\b(?!\s*\()', re.M)
+TESTER = re.compile(r'^(?:let|const|var)\s+test\s*=\s*get_tester\([^)]*\)[ \t]*;?[ \t]*$', re.M)
+TEST = re.compile(r'^test\(', re.M)
+END_OF_STATEMENT = re.compile(r'[ \t]*;?[ \t]*$', re.M)
+DYNAMIC_IMPORT = re.compile(r'(?<![\w$.])import(?=\s*\()')
+LET_OR_VAR = re.compile(r'^(?:export\s+)?(?:let|var)\s+(?P<name>[\w$]+)(?P<initialized>\s*=(?!=))?', re.M)
+REGEX_MAY_FOLLOW = set('(,=:[!&|?{};+-*%<>~^')
+
+PROLOGUE = [
+    'const __modules = globalThis.__metastreams_modules ??= {};',
+    "const __import = specifier => import(`${specifier}`.replace(/(?<!\\.bundle)\\.js$/, '.bundle.js')).catch(() => import(specifier));",
+]
+
+REMOVED = '\0'      # marks lines left out of the bundle
+BASE64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+
+def bundle(entry, locate, strip_tests=False):
+    """ Bundle of the module entry (a name like 'js/main.js'); locate(name) gives the Path
+        of a module or None. Raises ValueError for missing modules or unsupported syntax. """
+    order, modules = [], {}
+
+    def visit(name, importers):
+        if name in modules:
+            return
+        if name in importers:
+            raise ValueError(f"Import cycle: {' -> '.join(importers + (name,))}")
+        if (path := locate(name)) is None:
+            raise ValueError(f"Module {name!r} not found" + (f", imported by {importers[-1]!r}" if importers else ""))
+        source = path.read_text()
+        lines, dependencies = _transform(name, source, strip_tests)
+        for dependency in dependencies:
+            visit(dependency, importers + (name,))
+        modules[name] = (source, lines)
+        order.append(name)
+
+    visit(entry, ())
+    directory = posixpath.dirname(entry)
+    map_name = posixpath.basename(entry[:-len('.js')] + BUNDLE_SUFFIX + '.map')
+    output = [(line, None) for line in PROLOGUE]
+    for name in order:
+        source, lines = modules[name]
+        output.append((f'// {name}', None))
+        output.append((f'__modules[{json.dumps(name)}] ??= (function () {{', None))
+        output.extend(lines)
+        output.append(('})();', None))
+    if exports := _exports(modules[entry][0]):
+        names = ', '.join(exported for exported, _ in exports)
+        output.append((f"export const {{{names}}} = __modules[{json.dumps(entry)}];", None))
+    output.append((f'//# sourceMappingURL={map_name}', None))
+
+    sources = {name: i for i, name in enumerate(order)}
+    source_map = {
+        'version': 3,
+        'file': posixpath.basename(entry[:-len('.js')] + BUNDLE_SUFFIX),
+        'sources': [posixpath.relpath(name, directory or '.') for name in order],
+        'sourcesContent': [modules[name][0] for name in order],
+        'names': [],
+        'mappings': _mappings([origin and (sources[origin[0]], origin[1]) for _, origin in output]),
+    }
+    return Bundle('\n'.join(line for line, _ in output) + '\n', json.dumps(source_map), order)
+
+
+def _transform(name, source, strip_tests):
+    """ Lines of the function body for module name, each with (name, line number), and the
+        modules it imports """
+    dependencies = []
+
+    def resolve(specifier):
+        if not specifier.startswith(('./', '../')):
+            raise ValueError(f"{name}: only relative imports can be bundled, not {specifier!r}")
+        dependency = posixpath.normpath(posixpath.join(posixpath.dirname(name), specifier))
+        if dependency.startswith('../'):
+            raise ValueError(f"{name}: {specifier!r} is outside the static directory")
+        dependencies.append(dependency)
+        return json.dumps(dependency)
+
+    def same_lines(match, replacement):
+        return replacement + '\n' * match[0].count('\n')
+
+    def removed(match):
+        return _removed(match[0])
+
+    def import_(match):
+        if strip_tests and match['names'] is not None and _names(match['names']) == [('get_tester', 'get_tester')]:
+            return removed(match)
+        module = f'__modules[{resolve(match["specifier"])}]'
+        if match['namespace'] is not None:
+            return same_lines(match, f'const {match["namespace"]} = {module};')
+        names = ', '.join(exported if exported == local else f'{exported}: {local}'
+                for exported, local in _names(match['names']))
+        return same_lines(match, f'const {{{names}}} = {module};')
+
+    def side_effect_import(match):
+        resolve(match['specifier'])
+        return removed(match)
+
+    text = source
+    if strip_tests:
+        text = _strip_tests(name, TESTER.sub(removed, text))
+    text = IMPORT.sub(import_, text)
+    text = SIDE_EFFECT_IMPORT.sub(side_effect_import, text)
+    text = EXPORT_LIST.sub(removed, text)
+    text = EXPORT_DECLARATION.sub('', text)
+    if unsupported := UNSUPPORTED.search(text):
+        line = text.count('\n', 0, unsupported.start()) + 1
+        raise ValueError(f"{name}:{line}: unsupported import or export")
+    text = DYNAMIC_IMPORT.sub('__import', text)
+    exports = _exports(source)
+    _check_not_reassigned(name, source, {local for _, local in exports})
+
+    lines = [(line, (name, lineno)) for lineno, line in enumerate(text.split('\n'))
+            if line != REMOVED]
+    if exports:
+        entries = ', '.join(exported if exported == local else f'{exported}: {local}' for exported, local in exports)
+        lines.append((f"return {{{entries}}};", None))
+    return lines, dependencies
+
+
+def _removed(text):
+    return '\n'.join(REMOVED for _ in range(text.count('\n') + 1))
+
+
+def _strip_tests(name, text):
+    """ text without the top level test(...) calls, each up to its closing parenthesis """
+    parts, position = [], 0
+    for match in TEST.finditer(text):
+        if match.start() < position:
+            continue    # test( within a test
+        end = _closing(text, match.end() - 1)
+        if end is None or (statement := END_OF_STATEMENT.match(text, end)) is None:
+            line = text.count('\n', 0, match.start()) + 1
+            raise ValueError(f"{name}:{line}: cannot find where this test ends")
+        parts.append(text[position:match.start()])
+        parts.append(_removed(text[match.start():statement.end()]))
+        position = statement.end()
+    parts.append(text[position:])
+    return ''.join(parts)
+
+
+def _closing(text, start):
+    """ Index after the bracket that closes the one at start, or None; strings, template
+        literals, comments and (by the usual heuristic) regular expressions are skipped """
+    depth, i, previous = 0, start, '('
+    while i < len(text):
+        c = text[i]
+        if c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        elif c in '"\'`':
+            i = _skip(text, i + 1, c)
+        elif text.startswith('//', i):
+            i = text.find('\n', i) - 1
+        elif text.startswith('/*', i):
+            i = text.find('*/', i) + 1
+        elif c == '/' and previous in REGEX_MAY_FOLLOW:
+            i = _skip(text, i + 1, '/')
+        if i < 0:
+            return None
+        if not text[i].isspace():
+            previous = text[i]
+        i += 1
+    return None
+
+
+def _skip(text, i, quote):
+    """ Index of the quote ending a string or regular expression starting at i, or -1 """
+    in_class = False
+    while i < len(text):
+        c = text[i]
+        if c == '\\':
+            i += 1
+        elif quote == '/' and c in '[]':
+            in_class = c == '['
+        elif c == quote and not in_class:
+            return i
+        elif c == '\n' and quote != '`':
+            return -1
+        i += 1
+    return -1
+
+
+def _check_not_reassigned(name, source, exported):
+    """ Refuses modules that assign to an exported let or var after its declaration, as
+        importers of the bundle would not see the new value """
+    for match in LET_OR_VAR.finditer(source):
+        if (local := match['name']) not in exported:
+            continue
+        assignments = re.findall(rf'(?<![\w$.]){re.escape(local)}\s*(?:\*\*|<<|>>>?|&&|\|\||\?\?|[-+*/%&|^])?=(?![=>])'
+                rf'|(?:\+\+|--)\s*{re.escape(local)}(?![\w$])|(?<![\w$.]){re.escape(local)}\s*(?:\+\+|--)', source)
+        if len(assignments) > (1 if match['initialized'] else 0):
+            raise ValueError(f"{name}: exported {local!r} is reassigned, which importers of a bundle would not see")
+
+
+def _names(names):
+    """ (exported, local) pairs of 'a, b as c' """
+    pairs = []
+    for each in names.split(','):
+        if each := each.strip():
+            exported, _, local = each.partition(' as ')
+            pairs.append((exported.strip(), local.strip() or exported.strip()))
+    return pairs
+
+
+def _exports(source):
+    """ (exported, local) pairs of the exports of a module """
+    exports = []
+    for match in EXPORT_DECLARATION.finditer(source):
+        name = match['function'] or match['class'] or match['variable']
+        exports.append((name, name))
+    for match in EXPORT_LIST.finditer(source):
+        exports.extend((exported, local) for local, exported in _names(match['names']))
+    return exports
+
+
+def _mappings(origins):
+    """ Source map v3 mappings for one segment at column 0 per generated line; origins has
+        (source index, line number) or None per generated line """
+    segments, previous_source, previous_line = [], 0, 0
+    for origin in origins:
+        if origin is None:
+            segments.append('')
+            continue
+        source, line = origin
+        segments.append(_vlq(0) + _vlq(source - previous_source) + _vlq(line - previous_line) + _vlq(0))
+        previous_source, previous_line = source, line
+    return ';'.join(segments)
+
+
+def _vlq(value):
+    value = (-value << 1) | 1 if value < 0 else value << 1
+    encoded = ''
+    while True:
+        digit, value = value & 31, value >> 5
+        encoded += BASE64[digit | (32 if value else 0)]
+        if not value:
+            return encoded
+
+
+def write_bundle(static_dir, entry, strip_tests=False):
+    """ Writes entry.bundle.js and its source map in static_dir, unless they are newer than
+        all sources; returns whether it wrote them. """
+    static_dir = Path(static_dir)
+    target = static_dir / (entry[:-len('.js')] + BUNDLE_SUFFIX)
+    target_map = target.with_name(target.name + '.map')
+    locate = lambda name: path if (path := static_dir / name).is_file() else None
+    built = bundle(entry, locate, strip_tests=strip_tests)
+    if target.is_file() and target_map.is_file() and target.read_text() == built.code:
+        return False
+    for path, content in ((target_map, built.source_map), (target, built.code)):
+        tmp = path.with_name(path.name + '~')
+        tmp.write_text(content)
+        tmp.rename(path)
+    return True
+
+
+import autotest
+test = autotest.get_tester(__name__)
+
+
+def _locate_in(directory):
+    return lambda name: path if (path := directory / name).is_file() else None
+
+
+def _decode(mappings):
+    """ (source, line) or None per generated line """
+    values, source, line = [], 0, 0
+    for segment in mappings.split(';'):
+        if not segment:
+            values.append(None)
+            continue
+        numbers, value, shift = [], 0, 0
+        for char in segment:
+            digit = BASE64.index(char)
+            value += (digit & 31) << shift
+            shift += 5
+            if not digit & 32:
+                numbers.append(-(value >> 1) if value & 1 else value >> 1)
+                value, shift = 0, 0
+        source, line = source + numbers[1], line + numbers[2]
+        values.append((source, line))
+    return values
+
+
+@test
+def vlq():
+    test.eq('A', _vlq(0))
+    test.eq('C', _vlq(1))
+    test.eq('D', _vlq(-1))
+    test.eq('gB', _vlq(16))
+    test.eq('2H', _vlq(123))
+    test.eq([None, (0, 0), (0, 5), (1, 2), None], _decode(_mappings([None, (0, 0), (0, 5), (1, 2), None])))
+
+
+@test
+def bundle_modules(tmp_path):
+    (tmp_path / 'lib').mkdir()
+    (tmp_path / 'lib' / 'a.js').write_text('export function a() { return 1; }\nexport const A = 2;\n')
+    (tmp_path / 'lib' / 'b.js').write_text('import {a, A as AA} from "./a.js";\nlet x = 3;\nexport {x as b};\nexport class B {}\n')
+    (tmp_path / 'main.js').write_text('import {b} from "./lib/b.js"\nimport * as a from "./lib/a.js";\nimport "./lib/b.js";\nconsole.log(b, a.A);\n')
+    built = bundle('main.js', _locate_in(tmp_path))
+    test.eq(['lib/a.js', 'lib/b.js', 'main.js'], built.sources)
+    test.eq('\n'.join(PROLOGUE) + '''
+// lib/a.js
+__modules["lib/a.js"] ??= (function () {
+function a() { return 1; }
+const A = 2;
+
+return {a, A};
+})();
+// lib/b.js
+__modules["lib/b.js"] ??= (function () {
+const {a, A: AA} = __modules["lib/a.js"];
+let x = 3;
+class B {}
+
+return {B, b: x};
+})();
+// main.js
+__modules["main.js"] ??= (function () {
+const {b} = __modules["lib/b.js"];
+const a = __modules["lib/a.js"];
+console.log(b, a.A);
+
+})();
+//# sourceMappingURL=main.bundle.js.map
+''', built.code)
+    source_map = json.loads(built.source_map)
+    test.eq('main.bundle.js', source_map['file'])
+    test.eq(['lib/a.js', 'lib/b.js', 'main.js'], source_map['sources'])
+    origins = _decode(source_map['mappings'])
+    lines = built.code.split('\n')
+    test.eq('let x = 3;', lines[12])
+    test.eq((1, 1), origins[12])
+    test.eq('console.log(b, a.A);', lines[21])
+    test.eq((2, 3), origins[21])
+
+    test.eq(['lib/a.js', 'lib/b.js'], bundle('lib/b.js', _locate_in(tmp_path)).sources)
+    test.eq(['a.js', 'b.js'], json.loads(bundle('lib/b.js', _locate_in(tmp_path)).source_map)['sources'])
+    test.truth('export const {B, b} = __modules["lib/b.js"];' in bundle('lib/b.js', _locate_in(tmp_path)).code)
+
+
+@test
+def bundle_errors(tmp_path):
+    def error(text):
+        (tmp_path / 'main.js').write_text(text)
+        try:
+            bundle('main.js', _locate_in(tmp_path))
+            test.fail()
+        except ValueError as e:
+            return str(e)
+    test.eq("Module 'nope.js' not found, imported by 'main.js'", error('import {a} from "./nope.js"'))
+    test.eq("main.js: only relative imports can be bundled, not '/static/a.js'", error('import {a} from "/static/a.js"'))
+    test.eq("main.js:2: unsupported import or export", error('let a = 1;\nexport default a;'))
+    test.eq("main.js:1: unsupported import or export", error('import a from "./a.js"'))
+    test.eq("Import cycle: main.js -> main.js", error('import {a} from "./main.js"'))
+    test.eq("main.js: exported 'n' is reassigned, which importers of a bundle would not see",
+            error('export let n = 0;\nexport function inc() { n += 1; }'))
+    test.eq("main.js: exported 'n' is reassigned, which importers of a bundle would not see",
+            error('let n;\nfunction inc() { n++; }\nexport {n as count};'))
+    (tmp_path / 'main.js').write_text('export let n = 0;\nexport const m = n + 1;\nlet k = 1;\nk = 2;\n')
+    test.eq(['main.js'], bundle('main.js', _locate_in(tmp_path)).sources)
+
+
+@test
+def dynamic_imports_share_modules(tmp_path):
+    (tmp_path / 'shared.js').write_text('export const state = {};\n')
+    (tmp_path / 'plugin.js').write_text('import {state} from "./shared.js";\nexport function f() { return state; }\n')
+    (tmp_path / 'main.js').write_text('import {state} from "./shared.js";\n'
+            'import(\'/static/\' + "plugin" + \'.js\').then(m => m.f());\nlet o = {import: 1}; o.import(2);\n')
+    main = bundle('main.js', _locate_in(tmp_path))
+    test.eq(['shared.js', 'main.js'], main.sources)
+    test.contains(main.code, 'globalThis.__metastreams_modules ??= {}')
+    test.contains(main.code, '__import(\'/static/\' + "plugin" + \'.js\').then(m => m.f());')
+    test.contains(main.code, 'let o = {import: 1}; o.import(2);')
+    test.contains(main.code, '__modules["shared.js"] ??= (function () {')
+    plugin = bundle('plugin.js', _locate_in(tmp_path))
+    test.contains(plugin.code, '__modules["shared.js"] ??= (function () {')    # evaluated once, by whichever comes first
+    test.contains(plugin.code, 'export const {f} = __modules["plugin.js"];')
+
+
+@test
+def strip_tests(tmp_path):
+    (tmp_path / 'autotest.js').write_text('export function get_tester(name) {}\n')
+    (tmp_path / 'main.js').write_text('''import {get_tester} from "./autotest.js"
+let test = get_tester("main");
+
+export function f() {
+    return 1;
+}
+
+test(function f_test() {
+    test.eq(1, f());
+})
+
+test(async function nested_test() {
+    let p = new Promise((resolve) => {
+    resolve(")");
+})
+    test.eq(")", await p); // )
+    /* ) */ test.eq(1, [1, 2].map(x => x / 1 /* ) */).filter(x => /\)/.test(`${x})`))[0]);
+});
+
+f();
+''')
+    built = bundle('main.js', _locate_in(tmp_path))
+    test.eq(['autotest.js', 'main.js'], built.sources)
+    test.truth('f_test' in built.code)
+    stripped = bundle('main.js', _locate_in(tmp_path), strip_tests=True)
+    test.eq(['main.js'], stripped.sources)
+    test.eq(False, 'test' in stripped.code)
+    lines, origins = stripped.code.split('\n'), _decode(json.loads(stripped.source_map)['mappings'])
+    test.eq('f();', lines[lines.index('f();')])
+    test.eq((0, 19), origins[lines.index('f();')])
+    (tmp_path / 'main.js').write_text('let test = 1;\ntest(function t() {\n')
+    try:
+        bundle('main.js', _locate_in(tmp_path), strip_tests=True)
+        test.fail()
+    except ValueError as e:
+        test.eq("main.js:2: cannot find where this test ends", str(e))
+
+
+@test
+def bundle_usr_share():
+    from .paths import usr_share_path
+    built = bundle('main.js', _locate_in(usr_share_path))
+    test.eq(['autotest.js', 'aproba.js', 'callpy.js', 'main.js'], built.sources)
+    stripped = bundle('main.js', _locate_in(usr_share_path), strip_tests=True)
+    test.eq(['aproba.js', 'callpy.js', 'main.js'], stripped.sources)
+    test.eq(False, 'get_tester' in stripped.code)
+
+
+@test
+def write_bundle_only_when_changed(tmp_path):
+    (tmp_path / 'main.js').write_text('export const a = 1;\n')
+    test.eq(True, write_bundle(tmp_path, 'main.js'))
+    test.truth((tmp_path / 'main.bundle.js').is_file())
+    test.eq('main.bundle.js', json.loads((tmp_path / 'main.bundle.js.map').read_text())['file'])
+    test.eq(False, write_bundle(tmp_path, 'main.js'))
+    (tmp_path / 'main.js').write_text('export const a = 2;\n')
+    test.eq(True, write_bundle(tmp_path, 'main.js'))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('static_dir', help='Directory the modules are in')
+    parser.add_argument('entries', help='Entry modules, relative to static_dir', nargs='+')
+    parser.add_argument('--strip-tests', help='Leave out autotest test registrations', action='store_true')
+    args = parser.parse_args()
+
+    for entry in args.entries:
+        written = write_bundle(args.static_dir, entry, strip_tests=args.strip_tests)
+        print(f"{entry}: {'written' if written else 'unchanged'}")
@@ -0,0 +1,235 @@
+## begin license ##
+#
+# "Metastreams Html" is a template engine based on generators, and a sequel to Slowfoot.
+# It is also known as "DynamicHtml" or "Seecr Html".
+#
+# Copyright (C) 2023 Seecr (Seek You Too B.V.) https://seecr.nl
+#
+# This file is part of "Metastreams Html"
+#
+# "Metastreams Html" is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# "Metastreams Html" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "Metastreams Html"; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+## end license ##
+
+import time
+import asyncio
+from math import ceil
+from collections import OrderedDict
+
+from aiohttp.web import HTTPTooManyRequests
+
+
+class LoginThrottle:
+    """ Limits password verifications, which cost a lot of CPU on purpose.
+        - a token bucket per client ip and per (ip, username): burst attempts, then one per
+          1/rate seconds
+        - a token bucket per username as a cap on guessing one password from many ips, by
+          default ten times as generous (user_rate, user_burst)
+        - after a failed attempt an (ip, username) pair waits backoff seconds, doubling per
+          failure up to max_backoff; others can still log in as that user, and from that ip
+        - at most max_concurrent verifications at a time
+        Throttled attempts get a 429 with Retry-After straight away. With remote_header the
+        client ip is taken from that header (set by a reverse proxy) instead of the connection.
+        Without a known client ip (e.g. on a unix socket) only the username is throttled, as
+        all clients would share one bucket otherwise, and there is no backoff.
+        The state is kept in memory per process: with several worker processes each one
+        allows these limits, so divide rate and burst by the number of workers.
+    """
+    def __init__(self, rate=.1, burst=10, backoff=1.0, max_backoff=60.0, max_concurrent=16,
+            max_keys=100000, remote_header=None, user_rate=None, user_burst=None):
+        self._rate = rate
+        self._burst = burst
+        self._user_rate = rate * 10 if user_rate is None else user_rate
+        self._user_burst = burst * 10 if user_burst is None else user_burst
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._max_concurrent = max_concurrent
+        self._max_keys = max_keys
+        self._remote_header = remote_header
+        self._keys = OrderedDict()  # key -> [tokens, updated, failures, blocked_until], least recently used first
+        self._active = 0
+        self._clock = time.monotonic
+
+    def client_ip(self, request):
+        if self._remote_header is not None and (value := request.headers.get(self._remote_header)):
+            return value.rsplit(',', 1)[-1].strip()
+        return request.remote
+
+    async def validate(self, request, username, validate):
+        """ Returns await validate(), which returns None for a failed login, unless throttled """
+        now = self._clock()
+        buckets = [(('user', username), self._user_rate, self._user_burst)]
+        if ip := self.client_ip(request):
+            buckets.append((('ip', ip), self._rate, self._burst))
+            buckets.append((('pair', ip, username), self._rate, self._burst))     # last: backs off
+        states = [(self._state(key, now, rate, burst), rate) for key, rate, burst in buckets]
+        if (wait := max(self._wait(state, rate, now) for state, rate in states)) > 0:
+            raise self._too_many(wait)
+        if self._active >= self._max_concurrent:
+            raise self._too_many(1)
+        for state, _ in states:
+            state[0] -= 1
+        self._active += 1
+        try:
+            result = await validate()
+        finally:
+            self._active -= 1
+        if ip:
+            pair = states[-1][0]
+            if result is None:
+                pair[2] += 1
+                pair[3] = self._clock() + min(self._backoff * 2 ** (pair[2] - 1), self._max_backoff)
+            else:
+                pair[2] = 0
+        return result
+
+    def stats(self):
+        return dict(active=self._active, keys=len(self._keys))
+
+    def _state(self, key, now, rate, burst):
+        if (state := self._keys.get(key)) is None:
+            state = self._keys[key] = [burst, now, 0, 0]
+            while len(self._keys) > self._max_keys:
+                self._keys.popitem(last=False)
+        else:
+            self._keys.move_to_end(key)
+            state[0] = min(burst, state[0] + (now - state[1]) * rate)
+            state[1] = now
+        return state
+
+    @staticmethod
+    def _wait(state, rate, now):
+        return max(state[3] - now, (1 - state[0]) / rate)
+
+    @staticmethod
+    def _too_many(wait):
+        return HTTPTooManyRequests(headers={'Retry-After': str(ceil(wait))})
+
+
+import autotest
+test = autotest.get_tester(__name__)
+
+
+class MockRequest:
+    def __init__(self, remote='1.2.3.4', headers=None):
+        self.remote = remote
+        self.headers = headers or {}
+
+
+async def attempt(throttle, username, result, request=None):
+    async def validate():
+        return result
+    try:
+        return await throttle.validate(request or MockRequest(), username, validate)
+    except HTTPTooManyRequests as e:
+        return int(e.headers['Retry-After'])
+
+
+@test
+async def token_bucket_per_ip_and_username():
+    throttle = LoginThrottle(rate=.5, burst=2)
+    throttle._clock = lambda: 100
+    test.eq('aap', await attempt(throttle, 'aap', 'aap'))
+    test.eq('aap', await attempt(throttle, 'aap', 'aap'))
+    test.eq(2, await attempt(throttle, 'aap', 'aap'))
+    test.eq(2, await attempt(throttle, 'noot', 'noot'))     # same ip
+    test.eq('noot', await attempt(throttle, 'noot', 'noot', MockRequest('4.3.2.1')))
+    throttle._clock = lambda: 102
+    test.eq('aap', await attempt(throttle, 'aap', 'aap'))
+    test.eq(dict(active=0, keys=7), throttle.stats())     # user, ip and pair keys
+
+    throttle = LoginThrottle(rate=.5, burst=2, user_rate=.1, user_burst=3)
+    throttle._clock = lambda: 100
+    for ip in ['1.1.1.1', '2.2.2.2', '3.3.3.3']:
+        test.eq(None, await attempt(throttle, 'aap', None, MockRequest(ip)))
+    test.eq(10, await attempt(throttle, 'aap', 'aap', MockRequest('4.4.4.4')))     # cap per username
+
+
+@test
+async def exponential_backoff_after_failures():
+    throttle = LoginThrottle(burst=100, backoff=1, max_backoff=4)
+    now = 100
+    throttle._clock = lambda: now
+    test.eq(None, await attempt(throttle, 'aap', None))
+    test.eq(1, await attempt(throttle, 'aap', None))
+    now += 1
+    test.eq(None, await attempt(throttle, 'aap', None))
+    test.eq(2, await attempt(throttle, 'aap', None))
+    now += 2
+    test.eq(None, await attempt(throttle, 'aap', None))
+    now += 4
+    test.eq(None, await attempt(throttle, 'aap', None))
+    test.eq(4, await attempt(throttle, 'aap', None))    # max_backoff
+    now += 4
+    test.eq('aap', await attempt(throttle, 'aap', 'aap'))
+    test.eq(None, await attempt(throttle, 'aap', None))
+    test.eq(1, await attempt(throttle, 'aap', None))
+    # only this ip waits for this username: no locking out a user, nor other users behind a NAT
+    test.eq('aap', await attempt(throttle, 'aap', 'aap', MockRequest('4.3.2.1')))
+    test.eq('noot', await attempt(throttle, 'noot', 'noot'))
+
+
+@test
+async def backoff_from_when_validation_ended():
+    throttle = LoginThrottle(backoff=2)
+    now = 100
+    throttle._clock = lambda: now
+    async def slow_failure():
+        nonlocal now
+        now += 5
+    test.eq(None, await throttle.validate(MockRequest(), 'aap', slow_failure))
+    now += 1
+    test.eq(1, await attempt(throttle, 'aap', None))
+
+
+@test
+async def quick_429_when_too_many_concurrent():
+    throttle = LoginThrottle(max_concurrent=1)
+    done = asyncio.Event()
+    async def slow():
+        await done.wait()
+        return 'aap'
+    first = asyncio.create_task(throttle.validate(MockRequest(), 'aap', slow))
+    await asyncio.sleep(0)
+    test.eq(dict(active=1, keys=3), throttle.stats())
+    test.eq(1, await attempt(throttle, 'noot', 'noot', MockRequest('4.3.2.1')))
+    done.set()
+    test.eq('aap', await first)
+
+
+@test
+def client_ip_from_proxy_header():
+    test.eq('1.2.3.4', LoginThrottle().client_ip(MockRequest(headers={'X-Forwarded-For': '6.6.6.6'})))
+    throttle = LoginThrottle(remote_header='X-Forwarded-For')
+    test.eq('5.5.5.5', throttle.client_ip(MockRequest(headers={'X-Forwarded-For': '6.6.6.6, 5.5.5.5'})))
+    test.eq('1.2.3.4', throttle.client_ip(MockRequest()))
+
+
+@test
+async def no_ip_bucket_for_unknown_client():
+    throttle = LoginThrottle(burst=1)
+    throttle._clock = lambda: 100
+    test.eq(None, await attempt(throttle, 'aap', None, MockRequest(remote='')))
+    test.eq('noot', await attempt(throttle, 'noot', 'noot', MockRequest(remote='')))
+    test.eq('mies', await attempt(throttle, 'mies', 'mies', MockRequest(remote=None)))
+    test.eq([('user', 'aap'), ('user', 'noot'), ('user', 'mies')], list(throttle._keys))
+
+
+@test
+async def forget_least_recently_used_keys():
+    throttle = LoginThrottle(max_keys=3)
+    for name in ['aap', 'noot', 'mies']:
+        await attempt(throttle, name, name)
+    test.eq([('user', 'mies'), ('ip', '1.2.3.4'), ('pair', '1.2.3.4', 'mies')], list(throttle._keys))
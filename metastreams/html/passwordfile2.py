@@ -23,32 +23,52 @@
 #
 ## end license ##
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from json import load, dump
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError, InvalidHash
-from os import chmod, rename
-from os.path import isfile
+from os import chmod, rename, stat, cpu_count
 from stat import S_IWRITE, S_IREAD
 from pathlib import Path
 
 ph = PasswordHasher()
 
 class PasswordFile2(object):
-    def __init__(self, filepath, user_resolve=None):
+    def __init__(self, filepath, user_resolve=None, hashing_workers=None):
         if isinstance(filepath, str):
             filepath = Path(filepath)
         if filepath.is_dir():
             filepath /= "passwd"
         self._storage = _Storage(filepath.as_posix())
         self._user_resolve = user_resolve
+        # argon2 releases the GIL, so threads hash in parallel; each needs memory_cost KiB
+        self._hashing_workers = hashing_workers or min(4, cpu_count() or 1)
+        self._hashing_pool = None
+        self._hashing_pending = 0
 
     def addUser(self, username, password):
         if self.hasUser(username):
             raise ValueError('User already exists.')
-        self._storage.set(username, ph.hash(password))
+        self._storage.set(username, self._storage.hasher().hash(password))
         if self._user_resolve is not None:
             self._user_resolve.add_user(username)
 
+    def importUsers(self, users):
+        """ Adds users and sets passwords of existing ones from a mapping or (username, password)
+            pairs, hashing in the hashing pool and writing the file once. Returns the new usernames. """
+        users = dict(users)
+        added = [username for username in users if not self.hasUser(username)]
+        hashes = self._pool().map(self._storage.hasher().hash, users.values())
+        self._storage.update(dict(zip(users, hashes)))
+        if self._user_resolve is not None and added:
+            if hasattr(self._user_resolve, 'add_users'):
+                self._user_resolve.add_users(added)
+            else:
+                for username in added:
+                    self._user_resolve.add_user(username)
+        return added
+
     def removeUser(self, username):
         self._storage.remove(username)
         if self._user_resolve is not None:
@@ -58,7 +78,7 @@ class PasswordFile2(object):
         hashed = self._storage.get(username)
         try:
             result = hashed is not None and ph.verify(hashed, password)
-            if result and ph.check_needs_rehash(hashed):
+            if result and self._storage.hasher().check_needs_rehash(hashed):
                 self.setPassword(username, password)
             return result
         except VerifyMismatchError:
@@ -69,13 +89,59 @@ class PasswordFile2(object):
     def setPassword(self, username, password):
         if not self.hasUser(username):
             raise ValueError('User does not exist.')
-        self._storage.set(username, ph.hash(password))
+        self._storage.set(username, self._storage.hasher().hash(password))
+
+    def setHashParameters(self, time_cost, memory_cost, parallelism):
+        """ Argon2 parameters for new hashes, kept in the file. Existing users are
+            rehashed with them on their next successful login. """
+        if not (time_cost >= 1 and parallelism >= 1 and memory_cost >= 8 * parallelism):
+            raise ValueError('Invalid argon2 parameters.')
+        self._storage.setHashParameters(dict(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism))
+
+    def hashParameters(self):
+        hasher = self._storage.hasher()
+        return dict(time_cost=hasher.time_cost, memory_cost=hasher.memory_cost, parallelism=hasher.parallelism)
+
+    async def validateUserAsync(self, username, password):
+        """ As validateUser, but hashing runs in a thread pool, keeping the event loop free """
+        hashed = self._storage.get(username)
+        try:
+            result = hashed is not None and await self._hashing(ph.verify, hashed, password)
+            if result and self._storage.hasher().check_needs_rehash(hashed):
+                await self.setPasswordAsync(username, password)
+            return result
+        except VerifyMismatchError:
+            return False
+        except InvalidHash:
+            raise ValueError(f'Unexpected hash for user {username}, check file!')
+
+    async def setPasswordAsync(self, username, password):
+        if not self.hasUser(username):
+            raise ValueError('User does not exist.')
+        self._storage.set(username, await self._hashing(self._storage.hasher().hash, password))
+
+    def hashing_stats(self):
+        """ Hashes being computed (active) and waiting for a worker (queued) """
+        pending, workers = self._hashing_pending, self._hashing_workers
+        return dict(active=min(pending, workers), queued=max(0, pending - workers), workers=workers)
+
+    def _pool(self):
+        if self._hashing_pool is None:
+            self._hashing_pool = ThreadPoolExecutor(self._hashing_workers, thread_name_prefix='hashing')
+        return self._hashing_pool
+
+    async def _hashing(self, f, *args):
+        self._hashing_pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool(), f, *args)
+        finally:
+            self._hashing_pending -= 1
 
     def listUsernames(self):
         return self._storage.listkeys()
 
     def hasUser(self, username):
-        return username in self._storage.listkeys()
+        return self._storage.has(username)
     
     def resolve_user(self, username):
         if self._user_resolve is None:
@@ -83,47 +149,84 @@ class PasswordFile2(object):
         return self._user_resolve.resolve_user(username)
 
 class _Storage(object):
+    """ Keeps the parsed file in memory. Every access stats the file and parses it
+        again only when another process (or an editor) changed it. """
     version = 3
     def __init__(self, filepath):
         self._filepath = filepath
+        self._data = None
+        self._signature = None
+        self._hasher = ph
         self._loadUsers()
 
     def set(self, username, hashed):
-        d = self._loadUsers()
-        d[username] = hashed
-        self._storeUsers(d)
+        users = dict(self._loadUsers())
+        users[username] = hashed
+        self._storeUsers(users)
+
+    def update(self, hashes):
+        users = dict(self._loadUsers())
+        users.update(hashes)
+        self._storeUsers(users)
 
     def remove(self, username):
-        d = self._loadUsers()
-        d.pop(username, None)
-        self._storeUsers(d)
+        users = dict(self._loadUsers())
+        users.pop(username, None)
+        self._storeUsers(users)
 
     def get(self, username):
         return self._loadUsers().get(username)
 
+    def has(self, username):
+        return username in self._loadUsers()
+
     def listkeys(self):
         return list(sorted(self._loadUsers().keys()))
 
+    def hasher(self):
+        self._loadUsers()
+        return self._hasher
+
+    def setHashParameters(self, parameters):
+        self._loadUsers()
+        self._storeData(dict(self._data or {'version': self.version, 'users': {}}, hash_parameters=parameters))
+
+    def _fileSignature(self):
+        try:
+            st = stat(self._filepath)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
     def _loadUsers(self):
-        if not isfile(self._filepath):
+        signature = self._fileSignature()
+        if signature is None:
+            self._data, self._signature, self._hasher = None, None, ph
             return {}
-        with open(self._filepath, 'r') as fp:
-            data = load(fp)
+        if signature != self._signature:
+            with open(self._filepath, 'r') as fp:
+                data = load(fp)
             if not data.get('version') == self.version:
                 raise ValueError("Unexpected version")
-            return data['users']
+            self._setData(data)
+            self._signature = signature
+        return self._data['users']
 
     def _storeUsers(self, users):
-        if not isfile(self._filepath):
-            with open(self._filepath, 'w') as fp:
-                dump({'version': self.version, 'users':{}}, fp)
-        with open(self._filepath, 'r') as fp:
-            data = load(fp)
-            data['users'] = users
-            with open(self._filepath+'~', 'w') as wfp:
-                dump(data, wfp)
+        self._storeData(dict(self._data or {'version': self.version}, users=users))
+
+    def _storeData(self, data):
+        with open(self._filepath+'~', 'w') as wfp:
+            dump(data, wfp)
         rename(self._filepath+'~', self._filepath)
         chmod(self._filepath, S_IREAD | S_IWRITE)
+        self._setData(data)
+        self._signature = self._fileSignature()
+
+    def _setData(self, data):
+        if (parameters := data.get('hash_parameters')) != (self._data or {}).get('hash_parameters'):
+            self._hasher = PasswordHasher(**parameters) if parameters else ph
+        self._data = data
 
 __all__ = ['PasswordFile2']
 
@@ -191,6 +294,112 @@ def test_resolve_user(tmp_path):
     user = pf.resolve_user("aap")
     test.eq({'name': 'aap', 'admin': False}, user)
 
+@test
+def test_reload_when_changed_by_other(tmp_path):
+    pf1 = PasswordFile2(tmp_path / "passwd")
+    pf2 = PasswordFile2(tmp_path / "passwd")
+    pf1.addUser("aap", "noot")
+    test.truth(pf2.hasUser("aap"))
+    pf2.addUser("mies", "wim")
+    test.eq(['aap', 'mies'], pf1.listUsernames())
+    pf1.removeUser("aap")
+    test.truth(pf2.validateUser("mies", "wim"))
+    test.eq(['mies'], pf2.listUsernames())
+
+@test
+def test_parse_only_when_changed(tmp_path):
+    pf = PasswordFile2(tmp_path / "passwd")
+    pf.addUser("aap", "noot")
+    users = pf._storage._loadUsers()
+    test.truth(pf.hasUser("aap"))
+    test.truth(users is pf._storage._loadUsers())
+    (tmp_path / "passwd").write_text('{"version": 3, "users": {}, "other": 42}')
+    test.truth(not pf.hasUser("aap"))
+    pf.addUser("mies", "wim")
+    with open(tmp_path / "passwd") as fp:
+        test.eq({"version": 3, "users": {"mies": pf._storage.get("mies")}, "other": 42}, load(fp))
+
+@test
+async def test_validate_user_async(tmp_path):
+    pf = PasswordFile2(tmp_path / "passwd", hashing_workers=2)
+    pf.addUser("aap", "noot")
+    test.eq(dict(active=0, queued=0, workers=2), pf.hashing_stats())
+    checks = [asyncio.create_task(pf.validateUserAsync("aap", p)) for p in ["noot", "mies", "noot"]]
+    await asyncio.sleep(0)
+    test.eq(dict(active=2, queued=1, workers=2), pf.hashing_stats())
+    test.eq([True, False, True], await asyncio.gather(*checks))
+    test.eq(dict(active=0, queued=0, workers=2), pf.hashing_stats())
+    test.eq(False, await pf.validateUserAsync("mies", "noot"))
+    await pf.setPasswordAsync("aap", "mies")
+    test.truth(await pf.validateUserAsync("aap", "mies"))
+    try:
+        await pf.setPasswordAsync("mies", "noot")
+        test.fail()
+    except ValueError as e:
+        test.eq('User does not exist.', str(e))
+
+@test
+async def test_rehash_async(tmp_path):
+    pf = PasswordFile2(tmp_path / "passwd")
+    pf._storage.set("aap", PasswordHasher(time_cost=1).hash("noot"))
+    old = pf._storage.get("aap")
+    test.truth(await pf.validateUserAsync("aap", "noot"))
+    test.ne(old, pf._storage.get("aap"))
+    test.truth(not ph.check_needs_rehash(pf._storage.get("aap")))
+
+@test
+def test_hash_parameters_migrate_users(tmp_path):
+    pf = PasswordFile2(tmp_path / "passwd")
+    pf.addUser("aap", "noot")
+    test.eq(dict(time_cost=ph.time_cost, memory_cost=ph.memory_cost, parallelism=ph.parallelism), pf.hashParameters())
+    pf.setHashParameters(time_cost=1, memory_cost=1024, parallelism=1)
+    pf2 = PasswordFile2(tmp_path / "passwd")
+    test.eq(dict(time_cost=1, memory_cost=1024, parallelism=1), pf2.hashParameters())
+    test.truth(pf2.validateUser("aap", "noot"))
+    test.contains(pf._storage.get("aap"), "$m=1024,t=1,p=1$")
+    pf.addUser("mies", "wim")
+    test.contains(pf._storage.get("mies"), "$m=1024,t=1,p=1$")
+    test.truth(not pf.validateUser("mies", "noot"))
+    try:
+        pf.setHashParameters(time_cost=0, memory_cost=1024, parallelism=1)
+        test.fail()
+    except ValueError as e:
+        test.eq('Invalid argon2 parameters.', str(e))
+    test.eq(1, pf.hashParameters()['time_cost'])
+
+@test
+def test_import_users(tmp_path):
+    calls = []
+    class Users:
+        def add_users(self, usernames):
+            calls.append(usernames)
+    pf = PasswordFile2(tmp_path / "passwd", hashing_workers=2)
+    pf._storage.hasher = lambda: PasswordHasher(time_cost=1, memory_cost=64, parallelism=1)
+    pf.addUser("aap", "noot")
+    pf._user_resolve = Users()
+    writes = []
+    storeData = pf._storage._storeData
+    pf._storage._storeData = lambda data: writes.append(data) or storeData(data)
+    test.eq(['user0', 'user1', 'user2'], pf.importUsers({'aap': 'mies', **{f'user{i}': f'secret{i}' for i in range(3)}}))
+    test.eq(1, len(writes))
+    test.eq([['user0', 'user1', 'user2']], calls)
+    test.eq(['aap', 'user0', 'user1', 'user2'], PasswordFile2(tmp_path / "passwd").listUsernames())
+    test.truth(pf.validateUser("aap", "mies"))
+    test.truth(pf.validateUser("user2", "secret2"))
+    test.eq([], pf.importUsers([("user1", "other")]))
+    test.truth(pf.validateUser("user1", "other"))
+    test.eq([], pf.importUsers({}))
+
+@test
+def test_import_users_resolve_one_by_one(tmp_path):
+    calls = []
+    class Users:
+        def add_user(self, username):
+            calls.append(username)
+    pf = PasswordFile2(tmp_path / "passwd", user_resolve=Users())
+    pf.importUsers([("aap", "noot"), ("mies", "wim")])
+    test.eq(["aap", "mies"], calls)
+
 @test
 def test_filename_password_file(tmp_path):
     pf = PasswordFile2(tmp_path / "passwd")
@@ -0,0 +1,318 @@
+## begin license ##
+#
+# "Metastreams Html" is a template engine based on generators, and a sequel to Slowfoot.
+# It is also known as "DynamicHtml" or "Seecr Html".
+#
+# Copyright (C) 2023 Seecr (Seek You Too B.V.) https://seecr.nl
+#
+# This file is part of "Metastreams Html"
+#
+# "Metastreams Html" is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# "Metastreams Html" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "Metastreams Html"; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+## end license ##
+
+import gc
+import time
+import heapq
+import pickle
+import asyncio
+import logging
+from os import rename
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .sessionstore import Session, SessionStore, timestamp
+
+logger = logging.getLogger(__name__)
+
+
+class PersistentSessionStore(SessionStore):
+    """ A SessionStore that survives restarts. Changed and removed sessions are appended
+        to a log file on flush(), at most every snapshot_interval seconds, and on close();
+        on an event loop a timer flushes changes left when the interval has passed. When
+        the log holds much more than the live sessions it is compacted into a fresh
+        snapshot (temp file + rename), written in a thread when on an event loop. On
+        startup the log is replayed, which restores 100k sessions in about half a second.
+        A log is for one process only; use SqliteSessionStore for multiple workers.
+    """
+    def __init__(self, path, snapshot_interval=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self._path = str(path)
+        self._snapshot_interval = snapshot_interval
+        self._next_write = 0
+        self._dirty = {}    # identifier -> session, or None when removed
+        self._records = 0
+        self._log = None
+        self._timer = None
+        self._compacting = None     # (future, number of records) while a snapshot is written
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='session-log')
+        self._closed = False
+        gc_enabled = gc.isenabled()
+        gc.disable()    # loading creates many objects but no garbage
+        try:
+            damaged = self._load()
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if damaged or self._records > 2 * len(self._sessions) + 1000:
+            self._compact(in_thread=False)
+        else:
+            self._log = open(self._path, 'ab')
+
+    def flush(self):
+        if not self._dirty or self._closed or self._compacting is not None:
+            return  # changes made while compacting are appended to the new log
+        if (now := time.monotonic()) < self._next_write:
+            self._schedule_flush()
+            return
+        self._next_write = now + self._snapshot_interval
+        self._append()
+        if self._records > 2 * len(self._sessions) + 1000:
+            self._compact()
+
+    def close(self):
+        if self._closed:
+            return
+        if self._compacting is not None:
+            wait([self._compacting[0]])
+            self._compacted(*self._compacting)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._dirty:
+            self._append()  # a long log is compacted on the next start
+        self._log.close()
+        self._executor.shutdown()
+        self._closed = True
+
+    def _store(self, session):
+        super()._store(session)
+        self._dirty[session.identifier] = session
+        self._schedule_flush()
+
+    def _remove(self, identifier):
+        super()._remove(identifier)
+        self._dirty[identifier] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._timer is None and not self._closed:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return  # no loop: written on next flush()
+            self._timer = loop.call_later(max(0, self._next_write - time.monotonic()), self._timed_flush)
+
+    def _timed_flush(self):
+        self._timer = None
+        self.flush()
+
+    def _append(self):
+        dirty, self._dirty = self._dirty, {}
+        records = [(i, None, None, None) if s is None else (i, s.last_access, s._data, s.size) for i, s in dirty.items()]
+        pickle.dump(records, self._log, protocol=pickle.HIGHEST_PROTOCOL)
+        self._log.flush()
+        self._records += len(records)
+
+    def _compact(self, in_thread=True):
+        """ Writes the live sessions to a new log, in a thread when on an event loop;
+            the data is copied first as sessions keep changing meanwhile. """
+        records = [(i, s.last_access, dict(s._data), s.size) for i, s in self._sessions.items()]
+        future = self._executor.submit(self._write_snapshot, records)
+        self._compacting = future, len(records)
+        try:
+            loop = asyncio.get_running_loop() if in_thread else None
+        except RuntimeError:
+            loop = None
+        if loop is None:
+            wait([future])
+            self._compacted(future, len(records))
+        else:
+            future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._compacted, f, len(records)))
+
+    def _write_snapshot(self, records):
+        with open(self._path + '~', 'wb') as fp:
+            pickle.dump(records, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _compacted(self, future, count):
+        if self._compacting is None or self._compacting[0] is not future:
+            return  # already done by close()
+        self._compacting = None
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Compacting session log {self._path} failed, keeping it: {e!r}")
+        else:
+            rename(self._path + '~', self._path)
+            if self._log is not None:
+                self._log.close()
+            self._log = open(self._path, 'ab')
+            self._records = count
+        if self._log is None:
+            self._log = open(self._path, 'ab')
+        self.flush()
+
+    def _load(self):
+        """ Replays the log; returns True when it must be rewritten """
+        stored = {}
+        try:
+            with open(self._path, 'rb') as fp:
+                while True:
+                    records = pickle.load(fp)
+                    self._records += len(records)
+                    for record in records:
+                        stored.pop(record[0], None)     # keep the most recently written last
+                        if record[2] is not None:
+                            stored[record[0]] = record
+        except FileNotFoundError:
+            return True
+        except EOFError:
+            damaged = False
+        except Exception as e:
+            logger.warning(f"Ignoring incomplete end of session log {self._path}: {e!r}")
+            damaged = True
+        now = timestamp()
+        for identifier, last_access, data, size in stored.values():
+            if last_access + self._ttl < now:
+                continue
+            session = Session(identifier, self._ttl, on_change=self._store)
+            session._restore(last_access, data, size)
+            session._stored_size = session._size
+            self._bytes += session._size
+            self._sessions[identifier] = session
+            self._expiry.append((last_access + self._ttl, identifier))
+        heapq.heapify(self._expiry)
+        self._evict()
+        return damaged
+
+
+import autotest
+test = autotest.get_tester(__name__)
+
+
+@test
+def restore_sessions(tmp_path):
+    store = PersistentSessionStore(tmp_path/'sessions')
+    one, two = store.new_session(), store.new_session()
+    one['user'] = 'aap'
+    two['user'] = 'noot'
+    store.flush()
+    one['user'] = 'mies'
+    store.close()
+
+    store = PersistentSessionStore(tmp_path/'sessions')
+    test.eq([two.identifier, one.identifier], list(store._sessions))    # in order of last change
+    test.eq('mies', store.get_session(one.identifier)['user'])
+    test.eq('noot', store.get_session(two.identifier)['user'])
+    test.eq(one.size + two.size, store.stats()['bytes'])
+    test.truth(store.get_session(one.identifier) in store)
+
+
+@test
+def snapshots_are_periodic_and_incremental(tmp_path):
+    store = PersistentSessionStore(tmp_path/'sessions', snapshot_interval=60)
+    session = store.new_session()
+    session['user'] = 'aap'
+    store.flush()
+    size = (tmp_path/'sessions').stat().st_size
+    session['user'] = 'noot'
+    store.flush()   # within interval
+    test.eq(size, (tmp_path/'sessions').stat().st_size)
+    test.eq('aap', PersistentSessionStore(tmp_path/'sessions').get_session(session.identifier)['user'])
+
+
+@test
+def removed_and_expired_sessions_are_not_restored(tmp_path):
+    store = PersistentSessionStore(tmp_path/'sessions', snapshot_interval=0, max_sessions=1, ttl=.1)
+    one = store.new_session()
+    two = store.new_session()   # evicts one
+    store.flush()
+    store = PersistentSessionStore(tmp_path/'sessions', ttl=.1)
+    test.eq([two.identifier], list(store._sessions))
+    time.sleep(.11)
+    store = PersistentSessionStore(tmp_path/'sessions', ttl=.1)
+    test.eq(0, len(store))
+
+
+@test
+def compact_log(tmp_path):
+    store = PersistentSessionStore(tmp_path/'sessions', snapshot_interval=0)
+    session = store.new_session()
+    for i in range(1003):
+        session['count'] = i
+        store.flush()
+    store.close()   # waits for compaction when running in a thread
+    test.eq(1, store._records)
+    test.eq(1002, PersistentSessionStore(tmp_path/'sessions').get_session(session.identifier)['count'])
+
+
+@test
+async def compact_log_in_thread(tmp_path):
+    store = PersistentSessionStore(tmp_path/'sessions', snapshot_interval=0)
+    session = store.new_session()
+    for i in range(1003):
+        session['count'] = i
+        store.flush()
+    test.truth(store._compacting is not None)
+    session['count'] = 'late'   # after the snapshot was taken
+    store.flush()
+    while store._compacting is not None:
+        await asyncio.sleep(.01)
+    test.eq(2, store._records)
+    test.eq('late', PersistentSessionStore(tmp_path/'sessions').get_session(session.identifier)['count'])
+    store.close()
+
+
+@test
+async def flush_left_changes_on_a_timer(tmp_path):
+    store = PersistentSessionStore(tmp_path/'sessions', snapshot_interval=.05)
+    session = store.new_session()
+    session['user'] = 'aap'
+    await asyncio.sleep(.01)
+    test.eq('aap', PersistentSessionStore(tmp_path/'sessions').get_session(session.identifier)['user'])
+    session['user'] = 'noot'
+    store.flush()   # within interval
+    test.eq('aap', PersistentSessionStore(tmp_path/'sessions').get_session(session.identifier)['user'])
+    await asyncio.sleep(.1)
+    test.eq('noot', PersistentSessionStore(tmp_path/'sessions').get_session(session.identifier)['user'])
+    store.close()
+
+
+@test
+def flush_after_close(tmp_path):
+    store = PersistentSessionStore(tmp_path/'sessions')
+    session = store.new_session()
+    store.close()
+    session['user'] = 'aap'
+    store.flush()
+    store.close()
+    test.eq({}, PersistentSessionStore(tmp_path/'sessions').get_session(session.identifier)._data)
+
+
+@test
+def ignore_incomplete_log(tmp_path):
+    store = PersistentSessionStore(tmp_path/'sessions', snapshot_interval=0)
+    session = store.new_session()
+    session['user'] = 'aap'
+    store.flush()
+    with open(tmp_path/'sessions', 'ab') as fp:
+        fp.write(pickle.dumps([('x', 1.0, {}, 600)])[:-3])
+    with test.stderr as err:
+        store = PersistentSessionStore(tmp_path/'sessions')
+    test.contains(err.getvalue(), 'Ignoring incomplete end of session log')
+    test.eq('aap', store.get_session(session.identifier)['user'])
+    test.eq(1, len(store))
+    store.get_session(session.identifier)['user'] = 'noot'
+    store.close()
+    test.eq('noot', PersistentSessionStore(tmp_path/'sessions').get_session(session.identifier)['user'])
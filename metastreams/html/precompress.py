@@ -0,0 +1,141 @@
+## begin license ##
+#
+# "Metastreams Html" is a template engine based on generators, and a sequel to Slowfoot.
+# It is also known as "DynamicHtml" or "Seecr Html".
+#
+# Copyright (C) 2023 Seecr (Seek You Too B.V.) https://seecr.nl
+#
+# This file is part of "Metastreams Html"
+#
+# "Metastreams Html" is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# "Metastreams Html" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "Metastreams Html"; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+## end license ##
+
+""" Writes precompressed variants (foo.js.gz, and foo.js.br when the brotli module is
+    available) next to static files, for static_handler to serve to clients that accept
+    them. Run it at packaging time over usr-share and the app's static dirs:
+
+        python -m metastreams.html.precompress usr-share /path/to/app/static
+
+    Variants get the mtime of their original, so unchanged files are skipped on the next
+    run and variants of files changed afterwards are recognised as stale.
+"""
+
+import os
+import gzip
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .static_handler import content_type
+
+__all__ = ['precompress']
+
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'application/xml',
+        'application/xhtml+xml', 'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon')
+MIN_SIZE = 256
+MIN_SAVING = .1
+
+
+def compressors():
+    yield '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        yield '.br', lambda data: brotli.compress(data, quality=11)
+
+
+def compressible(path):
+    return path.suffix not in ('.gz', '.br') and content_type(path).startswith(COMPRESSIBLE)
+
+
+def precompress(static_dir):
+    """ Writes the missing or outdated variants below static_dir; returns the written paths """
+    written = []
+    for path in sorted(Path(static_dir).rglob('*')):
+        if not path.is_file() or not compressible(path):
+            continue
+        st = path.stat()
+        if st.st_size < MIN_SIZE:
+            continue
+        data = None
+        for suffix, compress in compressors():
+            variant = path.with_name(path.name + suffix)
+            if variant.is_file() and variant.stat().st_mtime_ns == st.st_mtime_ns:
+                continue
+            data = path.read_bytes() if data is None else data
+            if len(compressed := compress(data)) > len(data) * (1 - MIN_SAVING):
+                variant.unlink(missing_ok=True)    # not worth it; drop an older one
+                continue
+            tmp = variant.with_name(variant.name + '~')
+            tmp.write_bytes(compressed)
+            os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            tmp.rename(variant)
+            written.append(variant)
+    return written
+
+
+import autotest
+test = autotest.get_tester(__name__)
+
+
+@test
+def precompress_text_files(tmp_path):
+    (tmp_path / 'js').mkdir()
+    (tmp_path / 'js' / 'main.js').write_text('let a = 1;\n' * 100)
+    (tmp_path / 'small.css').write_text('body {}')
+    (tmp_path / 'image.png').write_bytes(b'\x89PNG' * 100)
+    (tmp_path / 'random.txt').write_bytes(os.urandom(1000))
+    written = precompress(tmp_path)
+    main_gz = tmp_path / 'js' / 'main.js.gz'
+    test.contains(written, main_gz)
+    test.eq(b'let a = 1;\n' * 100, gzip.decompress(main_gz.read_bytes()))
+    test.eq((tmp_path / 'js' / 'main.js').stat().st_mtime_ns, main_gz.stat().st_mtime_ns)
+    test.eq(brotli is not None, (tmp_path / 'js' / 'main.js.br').is_file())
+    test.eq(False, (tmp_path / 'small.css.gz').exists())
+    test.eq(False, (tmp_path / 'image.png.gz').exists())
+    test.eq(False, (tmp_path / 'random.txt.gz').exists())
+    test.eq(False, (tmp_path / 'js' / 'main.js.gz.gz').exists())
+
+@test
+def precompress_only_changed_files(tmp_path):
+    (tmp_path / 'a.js').write_text('let a = 1;\n' * 100)
+    (tmp_path / 'b.js').write_text('let b = 2;\n' * 100)
+    test.eq(2 * len(list(compressors())), len(precompress(tmp_path)))
+    test.eq([], precompress(tmp_path))
+    (tmp_path / 'b.js').write_text('let b = 3;\n' * 100)
+    os.utime(tmp_path / 'b.js', ns=(0, 1700000000_000000000))
+    test.eq([tmp_path / 'b.js.gz'], [p for p in precompress(tmp_path) if p.suffix == '.gz'])
+    test.eq(b'let b = 3;\n' * 100, gzip.decompress((tmp_path / 'b.js.gz').read_bytes()))
+
+@test
+def precompress_usr_share():
+    from .paths import usr_share_path
+    test.truth(all(compressible(p) for p in usr_share_path.glob('*.js')))
+    test.eq(False, compressible(usr_share_path / 'img/seecr-triangles.png'))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from .paths import usr_share_path
+    parser = ArgumentParser()
+    parser.add_argument('static_dirs', help=f'Directories to precompress (default {usr_share_path})', nargs='*')
+    args = parser.parse_args()
+
+    for static_dir in args.static_dirs or [usr_share_path]:
+        written = precompress(static_dir)
+        print(f"{static_dir}: {len(written)} variants written")
@@ -0,0 +1,141 @@
+## begin license ##
+#
+# "Metastreams Html" is a template engine based on generators, and a sequel to Slowfoot.
+# It is also known as "DynamicHtml" or "Seecr Html".
+#
+# Copyright (C) 2023 Seecr (Seek You Too B.V.) https://seecr.nl
+#
+# This file is part of "Metastreams Html"
+#
+# "Metastreams Html" is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# "Metastreams Html" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "Metastreams Html"; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+## end license ##
+
+""" Preloads of a page, sent as Link headers (and optionally as 103 Early Hints) so the
+    browser fetches assets while the page is still being rendered. page.render registers
+    its stylesheets and scripts; templates declare more with a module level
+
+        preloads = ['/static/img/header.jpg', ('/static/fonts/x.woff2', 'font')]
+
+    or call preload(response, url) before their first output.
+"""
+
+from pathlib import PurePosixPath
+from urllib.parse import urlsplit
+
+__all__ = ['preload']
+
+
+PRELOADS = 'metastreams.preloads'
+
+AS_BY_SUFFIX = {
+    '.css': 'style',
+    '.js': 'script',
+    '.woff': 'font', '.woff2': 'font', '.ttf': 'font', '.otf': 'font',
+    '.png': 'image', '.jpg': 'image', '.jpeg': 'image', '.gif': 'image', '.svg': 'image', '.webp': 'image', '.avif': 'image',
+}
+
+
+def link_value(url, as_=None, rel='preload', crossorigin=None):
+    """ Link header value for url; as_ follows from its suffix when not given """
+    if any(c in url for c in '\r\n<>'):
+        raise ValueError(f"Invalid preload URL: {url!r}")
+    if as_ is None and rel == 'preload':
+        as_ = AS_BY_SUFFIX.get(PurePosixPath(urlsplit(url).path).suffix.lower())
+    value = f'<{url}>; rel={rel}'
+    if as_ is not None:
+        value += f'; as={as_}'
+    if crossorigin is not None or as_ == 'font':    # fonts are always fetched in cors mode
+        value += f'; crossorigin={crossorigin or "anonymous"}'
+    return value
+
+
+def preload(response, url, as_=None, rel='preload', crossorigin=None):
+    """ Registers url for preloading with the response; effective until it is prepared """
+    if response is None:
+        return
+    values = response.setdefault(PRELOADS, [])
+    if (value := link_value(url, as_=as_, rel=rel, crossorigin=crossorigin)) not in values:
+        values.append(value)
+
+
+def declare(response, declared):
+    """ Registers the preloads a template declares: URLs or (url, as) tuples """
+    for each in declared:
+        url, as_ = (each, None) if isinstance(each, str) else each
+        preload(response, url, as_)
+
+
+def preloads(response):
+    return list(response.get(PRELOADS, ())) if response is not None else []
+
+
+def early_hints(request, values):
+    """ Writes a 103 Early Hints response ahead of the real one, for HTTP/1.1 clients.
+        aiohttp has no API for interim responses, so it is written to the transport
+        directly; this must happen before the response is prepared. """
+    if not values or request.version < (1, 1) or (transport := request.transport) is None \
+            or transport.is_closing():
+        return False
+    transport.write(b'HTTP/1.1 103 Early Hints\r\n' +
+            b''.join(b'Link: ' + value.encode() + b'\r\n' for value in values) + b'\r\n')
+    return True
+
+
+import autotest
+test = autotest.get_tester(__name__)
+
+
+@test
+def link_values():
+    test.eq('</static/common.css>; rel=preload; as=style', link_value('/static/common.css'))
+    test.eq('</static/main.js>; rel=modulepreload', link_value('/static/main.js', rel='modulepreload'))
+    test.eq('<https://cdn/x.js>; rel=preload; as=script; crossorigin=anonymous', link_value('https://cdn/x.js', crossorigin='anonymous'))
+    test.eq('</f.woff2?v=1>; rel=preload; as=font; crossorigin=anonymous', link_value('/f.woff2?v=1'))
+    test.eq('</data>; rel=preload; as=fetch', link_value('/data', 'fetch'))
+    test.eq('</other>; rel=preload', link_value('/other'))
+    try:
+        link_value('/x.js>; rel=stylesheet, <\r\nSet-Cookie: a')
+        test.fail()
+    except ValueError:
+        pass
+
+@test
+def register_preloads():
+    response = {}
+    preload(response, '/static/common.css')
+    declare(response, ['/static/img.png', ('/static/data.json', 'fetch'), '/static/common.css'])
+    test.eq(['</static/common.css>; rel=preload; as=style', '</static/img.png>; rel=preload; as=image',
+        '</static/data.json>; rel=preload; as=fetch'], preloads(response))
+    preload(None, '/static/common.css')
+    test.eq([], preloads(None))
+
+@test
+def write_early_hints():
+    from aiohttp import HttpVersion10, HttpVersion11
+    class Transport:
+        data = b''
+        def is_closing(self):
+            return False
+        def write(self, data):
+            self.data += data
+    class Request:
+        version = HttpVersion11
+        transport = Transport()
+    test.truth(early_hints(Request, ['</a.css>; rel=preload; as=style', '</b.js>; rel=modulepreload']))
+    test.eq(b'HTTP/1.1 103 Early Hints\r\nLink: </a.css>; rel=preload; as=style\r\nLink: </b.js>; rel=modulepreload\r\n\r\n', Request.transport.data)
+    test.eq(False, early_hints(Request, []))
+    Request.version = HttpVersion10
+    test.eq(False, early_hints(Request, ['</a.css>; rel=preload; as=style']))
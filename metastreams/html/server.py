@@ -23,9 +23,16 @@
 #
 ## end license ##
 
+import os
+import re
 import sys
+import time
+import signal
+import socket
 import asyncio
 import pathlib
+import logging
+import aiohttp
 from aiohttp import web as aiohttp_web
 from aiohttp.test_utils import TestClient, TestServer
 from .dynamichtml import DynamicHtml, TemplateImporter
@@ -37,34 +44,134 @@ from .paths import usr_share_path
 
 __all__ = ['create_server_app']
 
-async def create_server_app(module_names, index, context=None, static_dirs=(), static_path="/static", enable_sessions=True, session_cookie_name="METASTREAMS_SESSION", additional_routes=None):
+async def create_server_app(module_names, index, context=None, static_dirs=(), static_path="/static", enable_sessions=True, session_cookie_name="METASTREAMS_SESSION", additional_routes=None, session_store=None, static_cache_control=None, bundle_js=False, strip_js_tests=False, early_hints=False, inline_css=None, login_throttle=None):
     loop = asyncio.get_event_loop()
 
     # this is untested
     im = await TemplateImporter.install()
+    static_dirs += (usr_share_path,)
+    static = static_handler(static_dirs, static_path, cache_control=static_cache_control,
+            bundle_js=bundle_js, strip_js_tests=strip_js_tests)
+    # page.render uses it for URLs that can be cached for ever
+    context = dict(context or {})
+    context.setdefault('asset_manifest', static.asset_manifest)
+    if inline_css is not None:
+        context.setdefault('inline_css', inline_css)
+    if login_throttle is not None:
+        context.setdefault('login_throttle', login_throttle)
     dHtml = DynamicHtml(module_names, default=index, context=context)
 
     app = aiohttp_web.Application()
     routes = additional_routes or []
-    static_dirs += (usr_share_path,)
-    routes.append(aiohttp_web.get(static_path + '/{tail:.+}', static_handler(static_dirs, static_path)))
-    routes.append(aiohttp_web.get('/favicon.ico', static_handler(static_dirs, '')))
+    routes.append(aiohttp_web.get(static_path + '/{tail:.+}', static))
+    routes.append(aiohttp_web.get('/favicon.ico', static_handler(static_dirs, '', static_files=static.static_files)))
     routes.append(aiohttp_web.route(
         '*', '/{tail:.*}',
         dynamic_handler(dHtml,
             enable_sessions=enable_sessions,
-            session_cookie_name=session_cookie_name)))
+            session_cookie_name=session_cookie_name,
+            session_store=session_store,
+            early_hints=early_hints)))
     app.add_routes(routes)
+    async def start_static_files(app):
+        await static.static_files.start()
+    app.on_startup.append(start_static_files)
+    async def close_static_files(app):
+        await static.static_files.aclose()
+    app.on_cleanup.append(close_static_files)
+    if session_store is not None:
+        async def close_session_store(app):
+            session_store.close()
+        app.on_cleanup.append(close_session_store)
     return app
 
 
-async def create_server(port, *args, **kwargs):
+async def create_server(port, *args, unix_path=None, sock=None, backlog=128, keepalive_timeout=75.0,
+        reuse_port=None, shutdown_timeout=60.0, **kwargs):
     app = await create_server_app(*args, **kwargs)
 
-    runner = aiohttp_web.AppRunner(app)
+    runner = aiohttp_web.AppRunner(app, keepalive_timeout=keepalive_timeout)
     await runner.setup()
-    site = aiohttp_web.TCPSite(runner, port=port)
+    if sock is not None:
+        site = aiohttp_web.SockSite(runner, sock, backlog=backlog, shutdown_timeout=shutdown_timeout)
+    elif unix_path is not None:
+        site = aiohttp_web.UnixSite(runner, unix_path, backlog=backlog, shutdown_timeout=shutdown_timeout)
+    else:
+        site = aiohttp_web.TCPSite(runner, port=port, backlog=backlog, reuse_port=reuse_port, shutdown_timeout=shutdown_timeout)
     await site.start()
+    return runner
+
+
+async def serve(port, *args, **kwargs):
+    """ Runs the server until SIGTERM or SIGINT, then stops accepting connections and
+        waits (at most shutdown_timeout) for running requests to finish. """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    runner = await create_server(port, *args, **kwargs)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+def run_workers(workers, port, *args, unix_path=None, backlog=128, per_worker=None, **kwargs):
+    """ Pre-fork mode: runs the server in 'workers' processes and restarts those that die.
+        On TCP each worker binds the port itself with SO_REUSEPORT, so the kernel spreads
+        connections; a unix socket is bound once here and inherited by the workers.
+        SIGTERM or SIGINT lets all workers drain and then returns.
+        Objects in kwargs are created before the fork, so each worker gets a copy: what
+        keeps state, like a session store or a login throttle, is better made by
+        per_worker(), which returns more kwargs and is called in each worker. """
+    sock = None
+    if unix_path is not None:
+        if os.path.exists(unix_path):
+            os.unlink(unix_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(unix_path)
+        sock.listen(backlog)
+    children = {}
+    stopping = False
+
+    def start_worker():
+        if (pid := os.fork()) == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            exitcode = 0
+            try:
+                worker_kwargs = dict(kwargs, **per_worker()) if per_worker is not None else kwargs
+                asyncio.run(serve(port, *args, sock=sock, backlog=backlog, reuse_port=True, **worker_kwargs))
+            except BaseException as e:
+                logging.exception(f"Worker {os.getpid()} failed", exc_info=e)
+                exitcode = 1
+            finally:
+                os._exit(exitcode)
+        children[pid] = time.monotonic()
+        logging.info(f"Started worker {pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        start_worker()
+    while children:
+        pid, status = os.wait()
+        if (started := children.pop(pid, None)) is None or stopping:
+            continue
+        logging.warning(f"Worker {pid} exited with {os.waitstatus_to_exitcode(status)}, restarting.")
+        if time.monotonic() - started < 1:
+            time.sleep(1)   # don't spin when workers die at startup
+        start_worker()
+    if sock is not None:
+        sock.close()
+        os.unlink(unix_path)
+
 
 import autotest
 test = autotest.get_tester(__name__)
@@ -72,6 +179,26 @@ test = autotest.get_tester(__name__)
 from .dynamichtml import guarded_path
 test.fixture(guarded_path)
 
+
+@test
+async def test_unix_socket(guarded_path):
+    keep_meta = sys.meta_path.copy()
+    unix_path = (guarded_path/'server.sock').as_posix()
+    try:
+        runner = await create_server(None, '', "index", unix_path=unix_path, keepalive_timeout=1.0)
+        try:
+            connector = aiohttp.UnixConnector(path=unix_path)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                async with session.get('http://localhost/static/main.js') as result:
+                    test.eq(200, result.status)
+                    test.contains(await result.text(), "import {call_js_all} from")
+        finally:
+            await runner.cleanup()
+    finally:
+        for p in sys.meta_path:
+            if p not in keep_meta:
+                sys.meta_path.remove(p)
+
 @test
 async def test_additional_routes(guarded_path):
     keep_meta = sys.meta_path.copy()
@@ -119,3 +246,160 @@ async def test_static_dirs(guarded_path):
 
         result = await client.get('/static/main.js') # there is a main.js in the directory thats added by default
         test.eq('I am main', await result.text())
+        result = await client.get('/favicon.ico')
+        test.eq(200, result.status)
+        static_files = {route.handler.static_files for route in app.router.routes() if hasattr(route.handler, 'static_files')}
+        test.eq(1, len(static_files))
+        static_files = static_files.pop()
+        test.truth(static_files._task is not None)
+    test.eq(None, static_files._task)     # closed on cleanup
+    test.truth(static_files._watcher.closed)
+
+@test
+async def test_hashed_asset_urls(guarded_path):
+    keep_meta = sys.meta_path.copy()
+    (guarded_path/'pages').mkdir()
+    (guarded_path/'pages'/'index.sf').write_text("""
+from metastreams.html.stdsflib import page
+def main(tag, **kwargs):
+    with page.render(tag, **kwargs):
+        yield "hello"
+""")
+    try:
+        app = await create_server_app('pages', 'index')
+        async with TestClient(TestServer(app)) as client:
+            html = await (await client.get('/index')).text()
+            test.truth(re.search(r'href="/static/common\.[0-9a-f]{12}\.css"', html))
+            main_js = re.search(r'src="(/static/main\.[0-9a-f]{12}\.js)"', html)[1]
+            result = await client.get(main_js)
+            test.eq(200, result.status)
+            test.eq('public, max-age=31536000, immutable', result.headers['Cache-Control'])
+            test.contains(await result.text(), "import {call_js_all} from")
+    finally:
+        for p in sys.meta_path:
+            if p not in keep_meta:
+                sys.meta_path.remove(p)
+
+@test
+async def test_bundled_javascript(guarded_path):
+    keep_meta = sys.meta_path.copy()
+    (guarded_path/'pages').mkdir()
+    (guarded_path/'pages'/'index.sf').write_text("""
+from metastreams.html.stdsflib import page
+def main(tag, **kwargs):
+    with page.render(tag, **kwargs):
+        yield "hello"
+""")
+    try:
+        app = await create_server_app('pages', 'index', bundle_js=True, strip_js_tests=True)
+        async with TestClient(TestServer(app)) as client:
+            html = await (await client.get('/index')).text()
+            main_js = re.search(r'src="(/static/main\.bundle\.[0-9a-f]{12}\.js)"', html)[1]
+            code = await (await client.get(main_js)).text()
+            test.contains(code, '__modules["callpy.js"]')
+            test.eq(False, 'get_tester' in code)
+            result = await client.get('/static/main.bundle.js.map')
+            test.eq(['aproba.js', 'callpy.js', 'main.js'], (await result.json())['sources'])
+    finally:
+        for p in sys.meta_path:
+            if p not in keep_meta:
+                sys.meta_path.remove(p)
+
+@test
+async def test_preload_links_and_early_hints(guarded_path):
+    keep_meta = sys.meta_path.copy()
+    (guarded_path/'pages').mkdir()
+    (guarded_path/'pages'/'index.sf').write_text("""
+from metastreams.html.stdsflib import page
+preloads = ['/static/img/seecr-triangles.png']
+def main(tag, **kwargs):
+    with page.render(tag, **kwargs):
+        yield "hello"
+""")
+    async def get(port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /index HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        data = await reader.read()
+        writer.close()
+        return data.decode()
+    try:
+        app = await create_server_app('pages', 'index', early_hints=True)
+        async with TestServer(app) as server:
+            first = await get(server.port)
+            test.truth(first.startswith('HTTP/1.1 103 Early Hints\r\nLink: </static/img/seecr-triangles.png>; rel=preload; as=image\r\n\r\nHTTP/1.1 200 OK'))
+            headers = first.split('\r\n\r\n')[1]
+            test.truth(re.search(r'Link: .*</static/main\.[0-9a-f]{12}\.js>; rel=modulepreload', headers))
+            test.truth(re.search(r'Link: .*</static/common\.[0-9a-f]{12}\.css>; rel=preload; as=style', headers))
+            test.contains(headers, '<https://code.jquery.com/jquery-3.6.0.min.js>; rel=preload; as=script; crossorigin=anonymous')
+            second = await get(server.port)
+            hints = second.split('\r\n\r\n')[0]
+            test.truth(re.search(r'Link: </static/main\.[0-9a-f]{12}\.js>; rel=modulepreload', hints))
+            test.contains(second, 'hello')
+    finally:
+        for p in sys.meta_path:
+            if p not in keep_meta:
+                sys.meta_path.remove(p)
+
+@test
+async def test_inline_css(guarded_path):
+    keep_meta = sys.meta_path.copy()
+    (guarded_path/'pages').mkdir()
+    (guarded_path/'pages'/'index.sf').write_text("""
+from metastreams.html.stdsflib import page
+def main(tag, **kwargs):
+    with page.render(tag, stylesheets=['app.css'], **kwargs):
+        yield "hello"
+""")
+    (guarded_path/'static').mkdir()
+    (guarded_path/'static'/'app.css').write_text("p { margin: 0 }\n" * 1000)
+    try:
+        app = await create_server_app('pages', 'index', static_dirs=(guarded_path/'static',), inline_css=4096)
+        async with TestClient(TestServer(app)) as client:
+            result = await client.get('/index')
+            html = await result.text()
+            test.contains(html, '<style>' + (usr_share_path/'common.css').read_text() + '</style>')
+            test.truth(re.search(r'<link href="/static/app\.[0-9a-f]{12}\.css" rel="stylesheet" type="text/css">', html))
+            test.eq(False, 'common' in result.headers['Link'])
+            test.truth(html.index('<style>') < html.index('/static/app.'))
+    finally:
+        for p in sys.meta_path:
+            if p not in keep_meta:
+                sys.meta_path.remove(p)
+
+@test
+async def test_workers_drain_on_sigterm(guarded_path):
+    (guarded_path/'pages').mkdir()
+    (guarded_path/'pages'/'slow.sf').write_text("""
+import asyncio
+async def main(context, **kwargs):
+    await asyncio.sleep(.5)
+    yield f"slept in {context.pid}"
+""")
+    unix_path = (guarded_path/'server.sock').as_posix()
+    script = "import os, sys; from metastreams.html.server import run_workers; " \
+            "run_workers(2, None, 'pages', 'index', unix_path=sys.argv[1], per_worker=lambda: dict(context={'pid': os.getpid()}))"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    proc = await asyncio.create_subprocess_exec(sys.executable, '-O', '-c', script, unix_path, cwd=guarded_path, env=env)
+    try:
+        for _ in range(100):
+            if os.path.exists(unix_path):
+                break
+            await asyncio.sleep(.1)
+        async with aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=unix_path)) as session:
+            async def get(path='/slow'):
+                async with session.get('http://localhost' + path) as result:
+                    return result.status, await result.text()
+            test.eq(200, (await get('/static/main.js'))[0])   # serving
+            requests = [asyncio.ensure_future(get()) for _ in range(4)]
+            await asyncio.sleep(.3)
+            proc.send_signal(signal.SIGTERM)
+            for status, text in await asyncio.gather(*requests):
+                test.eq(200, status)
+                test.truth(text.startswith("slept in "))
+                test.ne(str(proc.pid), text[len("slept in "):])     # made in the worker
+        test.eq(0, await asyncio.wait_for(proc.wait(), 10))
+        test.eq(False, os.path.exists(unix_path))
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
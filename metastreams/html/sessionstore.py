@@ -23,23 +23,56 @@
 #
 ## end license ##
 
+import sys
 import uuid
+import heapq
 import datetime
+from collections import OrderedDict
 
 def timestamp():
     return datetime.datetime.now().timestamp()
 
+def approximate_size(obj, depth=8):
+    """ Memory used by obj including what it contains, roughly """
+    size = sys.getsizeof(obj)
+    if depth:
+        if isinstance(obj, dict):
+            size += sum(approximate_size(k, depth-1) + approximate_size(v, depth-1) for k, v in obj.items())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            size += sum(approximate_size(v, depth-1) for v in obj)
+    return size
+
+SESSION_OVERHEAD = 512   # Session, its identifier and its entries in a SessionStore, roughly
+
+_missing = object()
+
 class Session:
-    def __init__(self, identifier, ttl):
+    __slots__ = ('_identifier', '_last_access', '_ttl', '_data', '_on_change', '_size', '_stored_size')
+
+    def __init__(self, identifier, ttl, on_change=None):
         self._identifier = identifier
         self._last_access = timestamp()
         self._ttl = ttl
         self._data = {}
+        self._on_change = on_change
+        self._size = SESSION_OVERHEAD
+        self._stored_size = 0   # size as accounted for by the store
+
+    def _restore(self, last_access, data, size=None):
+        self._last_access = last_access
+        self._data = data
+        self._size = size or SESSION_OVERHEAD + sum(approximate_size(k) + approximate_size(v) for k, v in data.items())
 
     @property
     def identifier(self):
         return self._identifier
 
+    def _assign_identifier(self):
+        """ A new session gets its identifier when it is first stored. """
+        if self._identifier is None:
+            self._identifier = str(uuid.uuid4())
+        return self._identifier
+
     def is_expired(self, now=None):
         return self._last_access + self._ttl < (now or timestamp())
 
@@ -47,15 +80,31 @@ class Session:
     def last_access(self):
         return self._last_access
 
+    @property
+    def size(self):
+        return self._size
+
     def get(self, *args, **kwargs):
         return self._data.get(*args, **kwargs)
 
-    def pop(self, *args, **kwargs):
-        return self._data.pop(*args, **kwargs)
+    def pop(self, key, *args):
+        if (value := self._data.pop(key, _missing)) is _missing:
+            return self._data.pop(key, *args)
+        self._size -= approximate_size(key) + approximate_size(value)
+        self._changed()
+        return value
 
-    def __setitem__(self, *args, **kwargs):
+    def __setitem__(self, key, value):
         self._last_access = timestamp()
-        return self._data.__setitem__(*args, **kwargs)
+        if (old := self._data.get(key, _missing)) is not _missing:
+            self._size -= approximate_size(key) + approximate_size(old)
+        self._data[key] = value
+        self._size += approximate_size(key) + approximate_size(value)
+        self._changed()
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change(self)
 
     def __getitem__(self, *args, **kwargs):
         return self._data.__getitem__(*args, **kwargs)
@@ -68,19 +117,92 @@ class Session:
 
 
 class SessionStore:
-    def __init__(self, ttl=2 * 60 * 60):
-        self._sessions = {}
+    """ Keeps sessions in memory. With max_sessions and/or max_bytes (approximately)
+        the least recently used sessions are evicted to stay within these limits. """
+    def __init__(self, ttl=2 * 60 * 60, sweep_limit=100, max_sessions=None, max_bytes=None):
+        self._sessions = OrderedDict()  # least recently used first
+        self._expiry = []   # heap of (expires, identifier), possibly outdated by later access
         self._ttl = ttl
+        self._sweep_limit = sweep_limit
+        self._max_sessions = max_sessions
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._evictions = 0
 
     def get_session(self, identifier):
+        """ Returns the session for identifier or else a new one, which gets an identifier
+            and is stored only once something is stored in it. Expired sessions are swept
+            here, at most sweep_limit per call. """
         now = timestamp()
-        self._sessions = {k: v for k, v in self._sessions.items() if not v.is_expired(now)}
-        return self._sessions.get(identifier, self.new_session())
+        self._sweep(now)
+        if (session := self._sessions.get(identifier)) is not None:
+            if not session.is_expired(now):
+                self._sessions.move_to_end(identifier)
+                return session
+            self._remove(identifier)
+        return Session(None, self._ttl, on_change=self._store)
 
     def new_session(self):
-        identifier = str(uuid.uuid4())
-        self._sessions[identifier] = Session(identifier, self._ttl)
-        return self._sessions[identifier]
+        session = Session(None, self._ttl, on_change=self._store)
+        self._store(session)
+        return session
+
+    def stats(self):
+        return dict(count=len(self._sessions), bytes=self._bytes, evictions=self._evictions)
+
+    def _store(self, session):
+        identifier = session._assign_identifier()
+        if identifier in self._sessions:
+            self._sessions.move_to_end(identifier)
+        else:
+            self._sessions[identifier] = session
+            heapq.heappush(self._expiry, (session.last_access + self._ttl, identifier))
+        self._bytes += session._size - session._stored_size
+        session._stored_size = session._size
+        self._evict()
+
+    def _remove(self, identifier):
+        session = self._sessions.pop(identifier)
+        self._bytes -= session._stored_size
+        session._stored_size = 0
+
+    def _evict(self):
+        sessions = self._sessions
+        while len(sessions) > 1 and (
+                self._max_sessions is not None and len(sessions) > self._max_sessions or
+                self._max_bytes is not None and self._bytes > self._max_bytes):
+            self._remove(next(iter(sessions)))
+            self._evictions += 1
+        if len(self._expiry) > 2 * len(sessions) + 1024:
+            # drop entries of evicted sessions
+            self._expiry = [(s.last_access + self._ttl, i) for i, s in sessions.items()]
+            heapq.heapify(self._expiry)
+
+    def _sweep(self, now):
+        """ Removes at most sweep_limit expired sessions, taking O(log n) each. Sessions
+            accessed since they were pushed go back on the heap with their new expiry. """
+        expiry = self._expiry
+        for _ in range(self._sweep_limit):
+            if not expiry or expiry[0][0] >= now:
+                return
+            _, identifier = heapq.heappop(expiry)
+            if (session := self._sessions.get(identifier)) is None:
+                continue
+            if session.is_expired(now):
+                self._remove(identifier)
+            else:
+                heapq.heappush(expiry, (session.last_access + self._ttl, identifier))
+
+    def flush(self):
+        """ Writes changed sessions to a backend; sessions here live in memory only. """
+        pass
+
+    def close(self):
+        """ Writes what is left on shutdown. """
+        self.flush()
+
+    def __contains__(self, session):
+        return session.identifier in self._sessions
 
     def __len__(self):
         return len(self._sessions)
@@ -96,8 +218,15 @@ def test_session_new_session_if_unknown():
 
     test.eq(0, len(session_store))
     session = session_store.get_session("some identifier")
-    test.eq(1, len(session_store))
+    test.eq(None, session.identifier)   # assigned on first write
+    test.eq(0, len(session_store))
+    test.truth(session not in session_store)
 
+    session['key'] = 'value'
+    test.ne(None, session.identifier)
+    test.ne("some identifier", session.identifier)
+    test.eq(1, len(session_store))
+    test.truth(session in session_store)
     test.eq(id(session), id(session_store.get_session(session.identifier)))
 
 @test
@@ -119,6 +248,32 @@ def test_sessions_expire():
     session_revisited = session_store.get_session(session.identifier)
     test.ne(id(session), id(session_revisited))
 
+@test
+def test_known_session_creates_no_new_session():
+    session_store = SessionStore()
+    session = session_store.new_session()
+    for _ in range(3):
+        test.eq(id(session), id(session_store.get_session(session.identifier)))
+    test.eq(1, len(session_store))
+
+@test
+def test_sweep_expired_sessions():
+    session_store = SessionStore(ttl=.1, sweep_limit=2)
+    import time
+    sessions = []
+    for _ in range(3):
+        sessions.append(session_store.new_session())
+        time.sleep(.001)    # expire in order of creation
+    time.sleep(.05)
+    sessions[0]['data'] = 42    # keeps it alive
+    time.sleep(.06)
+    session_store.get_session(None)
+    test.eq(2, len(session_store)) # sweep stops at limit
+    test.eq({sessions[0].identifier, sessions[2].identifier}, set(session_store._sessions))
+    session_store.get_session(None)
+    test.eq({sessions[0].identifier}, set(session_store._sessions))
+    test.eq(1, len(session_store._expiry))
+
 @test
 def test_session_access_keeps_them_alive():
     session_store = SessionStore(ttl=.1)
@@ -156,3 +311,45 @@ def test_len_session():
     session['key'] = 'value'
     test.eq(1, len(session))
 
+
+@test
+def test_evict_least_recently_used():
+    session_store = SessionStore(max_sessions=2)
+    one, two = session_store.new_session(), session_store.new_session()
+    session_store.get_session(one.identifier)
+    three = session_store.new_session()
+    test.eq([one.identifier, three.identifier], list(session_store._sessions))
+    test.truth(two not in session_store)
+    test.eq(1, session_store.stats()['evictions'])
+
+@test
+def test_evict_on_size():
+    session_store = SessionStore(max_bytes=3 * SESSION_OVERHEAD)
+    one, two = session_store.new_session(), session_store.new_session()
+    test.eq(dict(count=2, bytes=2 * SESSION_OVERHEAD, evictions=0), session_store.stats())
+    two['data'] = 'x' * 1000
+    test.eq(1, len(session_store))
+    test.truth(two in session_store)
+    test.eq(two.size, session_store.stats()['bytes'])
+    two.pop('data')
+    test.eq(SESSION_OVERHEAD, session_store.stats()['bytes'])
+
+@test
+def test_session_size():
+    session = Session('id', ttl=10)
+    test.eq(SESSION_OVERHEAD, session.size)
+    session['key'] = 'value'
+    size = session.size
+    test.truth(size > SESSION_OVERHEAD)
+    session['key'] = 'other'
+    test.eq(size, session.size)
+    session['user'] = {'name': 'aap', 'roles': ['admin', 'user']}
+    test.truth(session.size > size + 100)
+    session.pop('user')
+    session.pop('nothing', None)
+    test.eq(size, session.size)
+    try:
+        session.anything = 1
+        test.fail()
+    except AttributeError:
+        pass
@@ -59,6 +59,10 @@ class TemplateImporter:
     def __init__(self):
         self._watcher = aionotify.Watcher()
         self._path2modname = {}
+        # templates loaded before we were installed (like builtins) must be watched too
+        for qname, mod in list(sys.modules.items()):
+            if (origin := getattr(getattr(mod, '__spec__', None), 'origin', None)) and origin.endswith('.sf'):
+                self.watch_parent_dir(qname, Path(origin))
 
 
     def watch_parent_dir(self, qname, sffile):
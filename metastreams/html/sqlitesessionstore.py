@@ -0,0 +1,300 @@
+## begin license ##
+#
+# "Metastreams Html" is a template engine based on generators, and a sequel to Slowfoot.
+# It is also known as "DynamicHtml" or "Seecr Html".
+#
+# Copyright (C) 2023 Seecr (Seek You Too B.V.) https://seecr.nl
+#
+# This file is part of "Metastreams Html"
+#
+# "Metastreams Html" is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# "Metastreams Html" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "Metastreams Html"; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+## end license ##
+
+import os
+import time
+import uuid
+import pickle
+import sqlite3
+import asyncio
+
+from .sessionstore import Session, SessionStore, timestamp
+
+
+class SqliteSessionStore(SessionStore):
+    """ Keeps sessions in an SQLite database so that worker processes share them.
+        Each worker caches sessions and reloads one when another worker changed it; a
+        cached session is checked for that at most every check_interval seconds, so a
+        change by another worker can take that long to show. Changes are written behind:
+        collected on Session.__setitem__/pop and written on flush(), which runs soon
+        after a change and at the end of a request.
+        The database is opened on first use, so a store can be created before forking.
+        Writes wait at most busy_timeout seconds for other workers, as they run on the
+        event loop; when the database stays locked they are retried later.
+        Session data is pickled, so whoever can write the database can run code in the
+        workers: it is created readable for its owner only and must be kept that way.
+    """
+    def __init__(self, path, ttl=2 * 60 * 60, purge_interval=60, busy_timeout=.05, retry_interval=.1,
+            check_interval=1.0):
+        super().__init__(ttl=ttl)
+        self._path = str(path)
+        self._db = None
+        self._busy_timeout = busy_timeout
+        self._retry_interval = retry_interval
+        self._purge_interval = purge_interval
+        self._next_purge = 0
+        self._check_interval = check_interval
+        self._versions = {}
+        self._checked = {}  # identifier -> when its cached version is to be checked again
+        self._dirty = {}
+        self._flush_scheduled = False
+
+    def _connect(self):
+        if self._db is None:
+            os.close(os.open(self._path, os.O_CREAT | os.O_WRONLY, 0o600))    # sqlite uses its mode for -wal, -shm
+            self._db = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS sessions "
+                    "(identifier TEXT PRIMARY KEY, expires REAL, version TEXT, data BLOB)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+            self._db.execute(f"PRAGMA busy_timeout={int(self._busy_timeout * 1000)}")
+        return self._db
+
+    def get_session(self, identifier):
+        db = self._connect()
+        now = timestamp()
+        if now > self._next_purge:
+            self._purge(now)
+        if identifier:
+            if identifier in self._dirty:
+                return self._dirty[identifier]
+            if (session := self._sessions.get(identifier)) is not None and not session.is_expired(now) \
+                    and time.monotonic() < self._checked.get(identifier, 0):
+                return session
+            row = db.execute("SELECT version FROM sessions WHERE identifier=? AND expires>=?", (identifier, now)).fetchone()
+            if row is not None:
+                if row[0] == self._versions.get(identifier):
+                    self._checked[identifier] = time.monotonic() + self._check_interval
+                    return self._sessions[identifier]
+                if (session := self._load(identifier)) is not None:
+                    return session
+        return Session(None, self._ttl, on_change=self._changed)
+
+    def new_session(self):
+        session = Session(None, self._ttl, on_change=self._changed)
+        self._changed(session)
+        return session
+
+    def flush(self):
+        self._flush_scheduled = False
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        rows = [(identifier, session.last_access + self._ttl, uuid.uuid4().hex, pickle.dumps(session._data))
+                for identifier, session in dirty.items()]
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)", rows)
+            db.execute("COMMIT")
+        except sqlite3.OperationalError as e:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            for identifier, session in dirty.items():
+                self._dirty.setdefault(identifier, session)
+            if not _locked(e):
+                raise
+            self._schedule_flush(self._retry_interval)
+            return
+        checked = time.monotonic() + self._check_interval
+        for identifier, expires, version, data in rows:
+            self._versions[identifier] = version
+            self._checked[identifier] = checked
+
+    def close(self):
+        if self._dirty:
+            self._connect().execute("PRAGMA busy_timeout=5000")   # last chance, no loop to wait for
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _load(self, identifier):
+        row = self._db.execute("SELECT expires, version, data FROM sessions WHERE identifier=?", (identifier,)).fetchone()
+        if row is None:
+            return None
+        expires, version, data = row
+        session = Session(identifier, self._ttl, on_change=self._changed)
+        session._restore(expires - self._ttl, pickle.loads(data))
+        self._sessions[identifier] = session
+        self._versions[identifier] = version
+        self._checked[identifier] = time.monotonic() + self._check_interval
+        return session
+
+    def _changed(self, session):
+        identifier = session._assign_identifier()
+        self._sessions[identifier] = session
+        self._dirty[identifier] = session
+        self._schedule_flush()
+
+    def _schedule_flush(self, delay=0):
+        if not self._flush_scheduled:
+            try:
+                loop = asyncio.get_running_loop()
+                if delay:
+                    loop.call_later(delay, self.flush)
+                else:
+                    loop.call_soon(self.flush)
+                self._flush_scheduled = True
+            except RuntimeError:
+                pass  # no loop: written on next flush()
+
+    def _purge(self, now):
+        self._next_purge = now + self._purge_interval
+        try:
+            self._db.execute("DELETE FROM sessions WHERE expires<?", (now,))
+        except sqlite3.OperationalError as e:
+            if not _locked(e):
+                raise
+            return  # next time
+        for identifier in [i for i, s in self._sessions.items() if s.is_expired(now) and i not in self._dirty]:
+            del self._sessions[identifier]
+            self._versions.pop(identifier, None)
+            self._checked.pop(identifier, None)
+
+    def stats(self):
+        return dict(count=len(self), cached=len(self._sessions), dirty=len(self._dirty))
+
+    def __len__(self):
+        """ Sessions in the database; changes not flushed yet are not counted """
+        return self._connect().execute("SELECT count(*) FROM sessions WHERE expires>=?", (timestamp(),)).fetchone()[0]
+
+
+def _locked(e):
+    return 'locked' in str(e) or 'busy' in str(e)
+
+
+import autotest
+test = autotest.get_tester(__name__)
+
+
+@test
+def share_sessions_between_stores(tmp_path):
+    worker1 = SqliteSessionStore(tmp_path/'sessions.db')
+    worker2 = SqliteSessionStore(tmp_path/'sessions.db')
+    session = worker1.new_session()
+    session['user'] = 'aap'
+    test.eq(None, worker2.get_session(session.identifier).get('user'))  # not yet flushed
+    test.eq(0, len(worker1))
+    worker1.flush()
+    session2 = worker2.get_session(session.identifier)
+    test.eq(session.identifier, session2.identifier)
+    test.eq('aap', session2['user'])
+    test.eq(1, len(worker2))
+    test.eq(dict(count=1, cached=1, dirty=0), worker2.stats())
+    test.eq(0o600, (tmp_path/'sessions.db').stat().st_mode & 0o777)
+
+
+@test
+def read_through_cache(tmp_path):
+    worker1 = SqliteSessionStore(tmp_path/'sessions.db', check_interval=0)
+    worker2 = SqliteSessionStore(tmp_path/'sessions.db', check_interval=0)
+    session = worker1.new_session()
+    worker1.flush()
+    test.eq(id(session), id(worker1.get_session(session.identifier)))
+    session2 = worker2.get_session(session.identifier)
+    test.eq(id(session2), id(worker2.get_session(session.identifier)))
+
+    session2['user'] = 'noot'
+    worker2.flush()
+    session1 = worker1.get_session(session.identifier)
+    test.ne(id(session), id(session1))
+    test.eq('noot', session1['user'])
+
+    session1.pop('user')
+    worker1.flush()
+    test.eq(None, worker2.get_session(session.identifier).get('user'))
+
+
+@test
+def check_cached_sessions_once_per_interval(tmp_path):
+    worker1 = SqliteSessionStore(tmp_path/'sessions.db', check_interval=.1)
+    worker2 = SqliteSessionStore(tmp_path/'sessions.db')
+    session = worker1.new_session()
+    worker1.flush()
+    worker1.get_session(session.identifier)     # purges
+    statements = []
+    worker1._db.set_trace_callback(statements.append)
+    for _ in range(3):
+        test.eq(id(session), id(worker1.get_session(session.identifier)))
+    test.eq([], statements)
+    worker2.get_session(session.identifier)['user'] = 'noot'
+    worker2.flush()
+    test.eq(None, worker1.get_session(session.identifier).get('user'))
+    time.sleep(.1)
+    test.eq('noot', worker1.get_session(session.identifier).get('user'))
+    test.eq(2, len(statements))     # version, then session
+
+
+@test
+async def write_behind_soon_after_change(tmp_path):
+    worker1 = SqliteSessionStore(tmp_path/'sessions.db')
+    worker2 = SqliteSessionStore(tmp_path/'sessions.db')
+    session = worker1.new_session()
+    session['user'] = 'mies'
+    await asyncio.sleep(0)
+    test.eq('mies', worker2.get_session(session.identifier).get('user'))
+
+
+@test
+def sqlite_sessions_expire(tmp_path):
+    store = SqliteSessionStore(tmp_path/'sessions.db', ttl=.1)
+    session = store.new_session()
+    store.flush()
+    import time
+    time.sleep(.11)
+    test.eq(None, store.get_session(session.identifier).identifier)
+    test.eq(0, len(store))
+
+
+@test
+async def retry_writes_while_locked(tmp_path):
+    import time
+    store = SqliteSessionStore(tmp_path/'sessions.db', retry_interval=.01)
+    test.eq(0, len(store))
+    session = store.new_session()
+    session['user'] = 'aap'
+    lock = sqlite3.connect(tmp_path/'sessions.db', isolation_level=None)
+    lock.execute("BEGIN IMMEDIATE")
+    t0 = time.monotonic()
+    store.flush()
+    test.truth(time.monotonic() - t0 < 1)
+    test.eq({session.identifier}, set(store._dirty))
+    test.truth(store._flush_scheduled)
+    test.eq(session, store.get_session(session.identifier))
+    lock.execute("ROLLBACK")
+    await asyncio.sleep(.05)
+    test.eq({}, store._dirty)
+    test.eq('aap', SqliteSessionStore(tmp_path/'sessions.db').get_session(session.identifier)['user'])
+
+
+@test
+def close_writes_changes(tmp_path):
+    store = SqliteSessionStore(tmp_path/'sessions.db')
+    session = store.new_session()
+    session['user'] = 'aap'
+    store.close()
+    test.eq('aap', SqliteSessionStore(tmp_path/'sessions.db').get_session(session.identifier)['user'])
@@ -23,9 +23,25 @@
 #
 ## end license ##
 
+import os
+import re
+import json
+import asyncio
+import hashlib
+import itertools
+import aionotify
 from pathlib import Path
+from collections import OrderedDict, namedtuple
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urljoin
 from aiohttp import web as aiohttp_web
 
+from . import jsbundle
+from .vendor import URL_REFERENCE
+
+import logging
+logger = logging.getLogger(__name__)
+
 import mimetypes
 mimetypes.init()
 # Override defaults (for redhat systems)
@@ -49,43 +65,628 @@ def content_type(filename):
     return type_
 
 
-def static_handler(static_dirs, static_path):
+StaticFile = namedtuple('StaticFile', ['path', 'etag', 'mtime', 'size', 'headers', 'body', 'encodings'])
+
+# precompressed variants next to a file, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# hashed names of static files: main.js -> main.1a2b3c4d5e6f.js
+HASHED_NAME = re.compile(r'^(?P<base>.+)\.(?P<digest>[0-9a-f]{12})(?P<suffix>\.[^./]+)?$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+WATCH_FLAGS = aionotify.Flags.MODIFY | aionotify.Flags.ATTRIB | aionotify.Flags.MOVED_FROM | \
+        aionotify.Flags.MOVED_TO | aionotify.Flags.CREATE | aionotify.Flags.DELETE
+
+
+class StaticFiles:
+    """ Serves files from static_dirs, the first directory having a file wins. An index maps
+        each requested file to its path; it is built by start(), or else on first use, and kept
+        current by inotify on all (sub)directories, so a lookup is a dict access and no path
+        outside static_dirs can ever be found. With watch=False (e.g. for an export) it is
+        built once and not kept current. Files are stat-ed and read in a thread; those up to
+        max_cached_file_size are kept in memory, the least recently used dropped beyond
+        max_cache_bytes, until inotify reports a change. Precompressed variants (foo.js.br,
+        foo.js.gz) next to a file are listed in StaticFile.encodings. Content digests for
+        hashed names are computed on first use and forgotten when the file changes.
+        With bundle_js, foo.bundle.js and its source map foo.bundle.js.map are built from
+        foo.js on first use, see jsbundle, and rebuilt after one of their sources changed;
+        their compressed variants are made in memory too, in a thread, when first asked for.
+        cache_control is a Cache-Control value for all directories or a dict per directory.
+    """
+    def __init__(self, static_dirs, cache_control=None, max_cache_bytes=64 * 2**20, max_cached_file_size=256 * 2**10,
+            bundle_js=False, strip_js_tests=False, watch=True):
+        if not isinstance(cache_control, dict):
+            cache_control = {static_dir: cache_control for static_dir in static_dirs}
+        cache_control = {Path(static_dir): value for static_dir, value in cache_control.items()}
+        self._static_dirs = [(Path(static_dir), cache_control.get(Path(static_dir))) for static_dir in static_dirs]
+        self._max_cache_bytes = max_cache_bytes
+        self._max_cached_file_size = max_cached_file_size
+        self._index = None  # requested file -> (path, cache control)
+        self._cache = OrderedDict()  # requested file -> StaticFile, least recently used first
+        self._cache_bytes = 0
+        self._digests = {}  # requested file -> digest of its content
+        self._bundle_js = bundle_js
+        self._strip_js_tests = strip_js_tests
+        self._bundles = {}  # entry module -> jsbundle.Bundle
+        self._changes = 0
+        self._watcher = None
+        self._watched = {}  # alias -> paths of a watched directory, more than one when symlinked
+        self._aliases = {}  # real path of a watched directory -> alias
+        self._watch_dirs = watch
+        self._task = None   # watches the static dirs
+        self._indexed = None    # done when the watching task built the index
+
+    async def start(self):
+        """ Sets up the inotify watches and builds the index, off the event loop; for a server
+            to do before serving. Otherwise the first use builds the index, on the loop. """
+        if not self._watch_dirs:
+            if self._index is None:
+                index = await asyncio.get_running_loop().run_in_executor(None, self._new_index)
+                if self._index is None:
+                    self._set_index(index)
+            return
+        if self._task is None:
+            self._watch()
+        await asyncio.shield(self._indexed)
+
+    async def get(self, requested_file):
+        if self._index is None:
+            self._start()
+        if (static_file := self._cache.get(requested_file)) is not None:
+            self._cache.move_to_end(requested_file)
+            return static_file
+        if (found := self._index.get(requested_file)) is None:
+            if (static_file := await self._load_bundle(requested_file)) is not None:
+                self._store(requested_file, static_file)
+            return static_file
+        path, cache_control = found
+        encodings = tuple(encoding for encoding, suffix in ENCODINGS
+                if (variant := self._index.get(requested_file + suffix)) is not None and variant[0].parent == path.parent)
+        changes = self._changes
+        static_file = await asyncio.get_running_loop().run_in_executor(None, self._load, path, cache_control, encodings)
+        if static_file is not None and changes == self._changes:
+            self._store(requested_file, static_file)
+        return static_file
+
+    def has(self, requested_file):
+        if self._index is None:
+            self._start()
+        return requested_file in self._index
+
+    def digest(self, requested_file):
+        """ Digest of the content of requested_file. Synchronous, for use while rendering;
+            the file is read only the first time after it changed. """
+        if self._index is None:
+            self._start()
+        if (digest := self._digests.get(requested_file)) is None:
+            if (found := self._index.get(requested_file)) is None:
+                if (body := self._bundle_body(requested_file)) is None:
+                    return None
+            else:
+                try:
+                    body = found[0].read_bytes()
+                except OSError:
+                    return None
+            digest = self._digests[requested_file] = hashlib.sha256(body).hexdigest()[:12]
+        return digest
+
+    def read(self, requested_file):
+        """ Content of requested_file, synchronously; for small files used while rendering """
+        if (static_file := self._cache.get(requested_file)) is not None and static_file.body is not None:
+            return static_file.body
+        if self._index is None:
+            self._start()
+        if (found := self._index.get(requested_file)) is None:
+            return self._bundle_body(requested_file)
+        try:
+            return found[0].read_bytes()
+        except OSError:
+            return None
+
+    def bundled(self, requested_file):
+        """ Name of the bundle of requested_file when bundling JavaScript, else requested_file """
+        if self._index is None:
+            self._start()
+        if not self._bundle_js or not requested_file.endswith('.js') or requested_file.endswith(jsbundle.BUNDLE_SUFFIX) \
+                or requested_file not in self._index:
+            return requested_file
+        name = requested_file[:-len('.js')] + jsbundle.BUNDLE_SUFFIX
+        try:
+            self._bundle_body(name)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Not bundling {requested_file}: {e}")
+            return requested_file
+        return name
+
+    def hashed(self, requested_file):
+        """ Name of requested_file with the digest of its content in it """
+        if (digest := self.digest(requested_file)) is None:
+            return None
+        base, dot, suffix = requested_file.rpartition('.')
+        if not dot or '/' in suffix:
+            return f'{requested_file}.{digest}'
+        return f'{base}.{digest}.{suffix}'
+
+    def close(self):
+        """ Stops watching; a next use starts again """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._watcher is not None and not self._watcher.closed:
+            self._watcher.close()
+        self._index = None
+
+    async def aclose(self):
+        """ Closes and waits for the watcher task to end """
+        task = self._task
+        self.close()
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _load(self, path, cache_control, encodings=()):
+        try:
+            st = path.stat()
+            body = path.read_bytes() if st.st_size <= self._max_cached_file_size else None
+        except OSError:
+            return None
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        headers = {
+            'Content-Type': content_type(path),
+            'ETag': etag,
+            'Last-Modified': formatdate(st.st_mtime, usegmt=True),
+            'Accept-Ranges': 'bytes',
+        }
+        if cache_control is not None:
+            headers['Cache-Control'] = cache_control
+        if encodings:
+            headers['Vary'] = 'Accept-Encoding'
+        return StaticFile(path, etag, st.st_mtime, st.st_size, headers, body, encodings)
+
+    def _bundle_body(self, requested_file):
+        """ Content of foo.bundle.js or foo.bundle.js.map when bundling foo.js, else None.
+            Built synchronously, like digests; the modules are small and this happens only
+            once after they change. """
+        if not self._bundle_js:
+            return None
+        for suffix, field in ((jsbundle.BUNDLE_SUFFIX, 'code'), (jsbundle.BUNDLE_SUFFIX + '.map', 'source_map')):
+            if requested_file.endswith(suffix):
+                entry = requested_file[:-len(suffix)] + '.js'
+                break
+        else:
+            return None
+        if (built := self._bundles.get(entry)) is None:
+            if entry not in self._index:
+                return None
+            locate = lambda name: found[0] if (found := self._index.get(name)) is not None else None
+            built = self._bundles[entry] = jsbundle.bundle(entry, locate, strip_tests=self._strip_js_tests)
+        return getattr(built, field).encode()
+
+    async def _load_bundle(self, requested_file):
+        for encoding, suffix in ENCODINGS:
+            if requested_file.endswith(jsbundle.BUNDLE_SUFFIX + suffix) or \
+                    requested_file.endswith(jsbundle.BUNDLE_SUFFIX + '.map' + suffix):
+                return await self._compress_bundle(requested_file[:-len(suffix)], encoding, suffix)
+        if (body := self._bundle_body(requested_file)) is None:
+            return None
+        entry = requested_file[:requested_file.rindex(jsbundle.BUNDLE_SUFFIX)] + '.js'
+        path, cache_control = self._index[entry]
+        mtime = max(self._index[source][0].stat().st_mtime for source in self._bundles[entry].sources)
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        headers = {
+            'Content-Type': 'application/javascript' if requested_file.endswith('.js') else 'application/json',
+            'ETag': etag,
+            'Last-Modified': formatdate(mtime, usegmt=True),
+            'Accept-Ranges': 'bytes',
+        }
+        if cache_control is not None:
+            headers['Cache-Control'] = cache_control
+        from .precompress import compressors
+        suffixes = dict(compressors())
+        encodings = tuple(encoding for encoding, suffix in ENCODINGS if suffix in suffixes)
+        if encodings:
+            headers['Vary'] = 'Accept-Encoding'
+        return StaticFile(None, etag, mtime, len(body), headers, body, encodings)
+
+    async def _compress_bundle(self, requested_file, encoding, suffix):
+        if (static_file := await self.get(requested_file)) is None or encoding not in static_file.encodings:
+            return None
+        from .precompress import compressors
+        changes = self._changes
+        body = await asyncio.get_running_loop().run_in_executor(None, dict(compressors())[suffix], static_file.body)
+        if changes != self._changes:
+            return None     # a source changed meanwhile; the client asks again
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        return static_file._replace(etag=etag, size=len(body), headers=dict(static_file.headers, ETag=etag),
+                body=body, encodings=())
+
+    def _store(self, requested_file, static_file):
+        self._cache[requested_file] = static_file
+        self._cache_bytes += len(static_file.body or b'')
+        while self._cache_bytes > self._max_cache_bytes:
+            self._drop(next(iter(self._cache)))
+
+    def _drop(self, requested_file):
+        if (static_file := self._cache.pop(requested_file, None)) is not None:
+            self._cache_bytes -= len(static_file.body or b'')
+
+    def _new_index(self):
+        index = {}
+        for static_dir, cache_control in reversed(self._static_dirs):
+            for requested_file in _files_below(static_dir, static_dir):
+                index[requested_file] = (static_dir / requested_file, cache_control)
+        return index
+
+    def _build_index(self):
+        self._set_index(self._new_index())
+
+    def _set_index(self, index):
+        self._index = index
+        self._cache.clear()
+        self._cache_bytes = 0
+        self._digests.clear()
+        self._bundles.clear()
+
+    def _resolve(self, requested_file):
+        self._drop(requested_file)
+        self._digests.pop(requested_file, None)
+        for entry, built in list(self._bundles.items()):
+            if requested_file in built.sources:
+                del self._bundles[entry]
+                name = entry[:-len('.js')] + jsbundle.BUNDLE_SUFFIX
+                for each in (name, name + '.map'):
+                    for variant in (each, *(each + suffix for _, suffix in ENCODINGS)):
+                        self._drop(variant)
+                        self._digests.pop(variant, None)
+        for _, suffix in ENCODINGS:
+            if requested_file.endswith(suffix):
+                self._drop(requested_file[:-len(suffix)])    # its encodings changed
+        for static_dir, cache_control in self._static_dirs:
+            if (path := static_dir / requested_file).is_file():
+                self._index[requested_file] = (path, cache_control)
+                return
+        self._index.pop(requested_file, None)
+
+    def _start(self):
+        """ Builds the index on first use, when start() was not awaited """
+        if self._watch_dirs and self._task is None:
+            self._watch()
+        if self._index is None:
+            self._build_index()
+
+    def _watch(self, rebuild=False):
+        loop = asyncio.get_running_loop()
+        self._indexed = loop.create_future()
+        self._task = loop.create_task(self._watching(rebuild))
+        self._task.add_done_callback(self._watching_stopped)
+
+    async def _watching(self, rebuild):
+        loop = asyncio.get_running_loop()
+        try:
+            self._watcher = aionotify.Watcher()
+            self._watched.clear()
+            self._aliases.clear()
+            self._alias = itertools.count(1)    # unique, since a directory can be removed and created again
+            await self._watcher.setup(loop)
+            index = await loop.run_in_executor(None, self._scan)
+            if self._index is None or rebuild:
+                self._set_index(index)
+            else:
+                self._reconcile(index)  # built on first use meanwhile
+        except asyncio.CancelledError:
+            self._indexed.cancel()
+            raise
+        except Exception as e:
+            self._indexed.set_exception(e)
+            raise
+        self._indexed.set_result(None)
+        await self._run()
+
+    def _watching_stopped(self, task):
+        if task is not self._task or task.cancelled():
+            return  # closed
+        self._task = None
+        logger.error(f"Watching static files stopped ({task.exception()!r}), restarting in {self._restart_delay}s")
+        asyncio.get_running_loop().call_later(self._restart_delay, self._restart)
+
+    _restart_delay = 1.0
+
+    def _restart(self):
+        if self._task is None and self._index is not None:
+            self._watch(rebuild=True)   # changes went unnoticed meanwhile
+
+    def _scan(self):
+        """ Adds watches and then builds the index, so that no change goes unnoticed """
+        for static_dir, _ in self._static_dirs:
+            self._watch_tree(static_dir)
+        return self._new_index()
+
+    def _reconcile(self, index):
+        for requested_file in set(self._index) | set(index):
+            if self._index.get(requested_file) != index.get(requested_file):
+                self._resolve(requested_file)
+
+    def _watch_tree(self, directory):
+        for dirpath, dirnames, filenames in _walk(directory):
+            path, real = Path(dirpath), os.path.realpath(dirpath)
+            if (alias := self._aliases.get(real)) is not None:
+                # inotify has one watch per directory: its events come for all paths it is seen at
+                if path not in self._watched[alias]:
+                    self._watched[alias].append(path)
+                continue
+            alias = str(next(self._alias))
+            try:
+                self._watcher.watch(dirpath, WATCH_FLAGS, alias=alias)
+            except OSError as e:
+                logger.warning(f"Not watching {dirpath}, changes below it go unnoticed: {e}")
+                continue
+            self._aliases[real] = alias
+            self._watched[alias] = [path]
+
+    async def _run(self):
+        while (event := await self._watcher.get_event()) is not None:
+            self._changes += 1
+            if event.flags & aionotify.Flags.Q_OVERFLOW:
+                self._build_index()
+                continue
+            if (directories := self._watched.get(event.alias)) is None:
+                continue
+            if event.flags & aionotify.Flags.IGNORED:
+                del self._watched[event.alias]
+                self._aliases = {real: alias for real, alias in self._aliases.items() if alias != event.alias}
+                continue
+            for directory in list(directories):
+                path = directory / event.name
+                # a symlink to a directory comes without ISDIR
+                is_dir = event.flags & aionotify.Flags.ISDIR or path.is_dir()
+                if is_dir and event.flags & (aionotify.Flags.CREATE | aionotify.Flags.MOVED_TO):
+                    self._watch_tree(path)
+                self._changed(path, is_dir)
+
+    def _changed(self, path, is_dir):
+        for static_dir, _ in self._static_dirs:
+            if path.is_relative_to(static_dir):
+                requested_file = path.relative_to(static_dir).as_posix()
+                if not is_dir and (requested_file in self._index or path.is_symlink() or path.exists()):
+                    self._resolve(requested_file)
+                    continue
+                # a directory, or a removed symlink to one, which comes without ISDIR
+                affected = {f for f in self._index if f.startswith(requested_file + '/')}
+                affected.add(requested_file)
+                for other_dir, _ in self._static_dirs:
+                    affected.update(_files_below(other_dir / requested_file, other_dir))
+                for each in affected:
+                    self._resolve(each)
+
+
+def _walk(directory):
+    """ os.walk following symlinks to directories, except those to a directory above, which
+        would make a cycle """
+    above = {}     # directory -> real paths of the directories above it
+    for dirpath, dirnames, filenames in os.walk(directory, followlinks=True):
+        reals = above.pop(dirpath, frozenset()) | {os.path.realpath(dirpath)}
+        dirnames[:] = [name for name in dirnames if os.path.realpath(os.path.join(dirpath, name)) not in reals]
+        for name in dirnames:
+            above[os.path.join(dirpath, name)] = reals
+        yield dirpath, dirnames, filenames
+
+
+def _files_below(directory, static_dir):
+    """ Requested files (relative to static_dir) of the regular files in directory and below """
+    for dirpath, dirnames, filenames in _walk(directory):
+        base = Path(dirpath)
+        for name in filenames:
+            if (path := base / name).is_file():
+                yield path.relative_to(static_dir).as_posix()
+
+
+class AssetManifest:
+    """ Maps names of static files to URLs with a digest of their content, to be served with
+        Cache-Control: immutable. Names not found keep their plain URL. """
+    def __init__(self, static_files, static_path):
+        self._static_files = static_files
+        self._static_path = static_path
+        self._inlined = {}  # name -> (digest, css or None)
+
+    def has(self, name):
+        return self._static_files.has(name)
+
+    def url(self, name):
+        name = self._static_files.bundled(name)
+        return f'{self._static_path}/{self._static_files.hashed(name) or name}'
+
+    def inline(self, name, max_size):
+        """ Content of stylesheet name for a <style> element when it has at most max_size
+            bytes, with relative url()s made absolute. Kept with the digest of the file, so
+            it is prepared again after the file changed. """
+        if (digest := self._static_files.digest(name)) is None:
+            return None
+        if (cached := self._inlined.get(name)) is None or cached[0] != digest:
+            css = None
+            if (body := self._static_files.read(name)) is not None:
+                try:
+                    css = body.decode()
+                except UnicodeDecodeError:
+                    pass
+            if css is not None and '</style' not in css.lower():
+                base = f'{self._static_path}/{name}'
+                css = URL_REFERENCE.sub(lambda m: m[0] if m['url'].startswith(('data:', '#')) else
+                        f'url({m["q"]}{urljoin(base, m["url"])}{m["q"]})', css)
+            else:
+                css = None
+            cached = self._inlined[name] = (digest, css)
+        css = cached[1]
+        return css if css is not None and len(css.encode()) <= max_size else None
+
+
+def unhashed(requested_file):
+    """ (name, digest) for a hashed name, or None """
+    if (match := HASHED_NAME.match(requested_file)) is None:
+        return None
+    return match['base'] + (match['suffix'] or ''), match['digest']
+
+
+def not_modified(request, static_file):
+    if (etags := request.headers.get('If-None-Match')) is not None:
+        return etags.strip() == '*' or static_file.etag in (e.strip().removeprefix('W/') for e in etags.split(','))
+    if (since := request.headers.get('If-Modified-Since')) is not None:
+        try:
+            return int(static_file.mtime) <= parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            pass
+    return False
+
+
+def accepted_encoding(request, encodings):
+    """ The encoding in encodings the client prefers, by q-value and then by our order """
+    if not encodings or (value := request.headers.get('Accept-Encoding')) is None:
+        return None
+    qualities = {}
+    for each in value.split(','):
+        coding, _, params = each.partition(';')
+        q = 1.0
+        if (param := params.strip()).startswith('q='):
+            try:
+                q = float(param[2:])
+            except ValueError:
+                q = 0
+        qualities[coding.strip().lower()] = q
+    wildcard = qualities.get('*', 0)
+    best = max(encodings, key=lambda e: qualities.get(e, wildcard))
+    return best if qualities.get(best, wildcard) > 0 else None
+
+
+async def select_variant(request, static_files, requested_file, static_file):
+    """ The precompressed variant the client accepts, unless it is older than the file itself """
+    if (encoding := accepted_encoding(request, static_file.encodings)) is None:
+        return static_file
+    suffix = dict(ENCODINGS)[encoding]
+    if (variant := await static_files.get(requested_file + suffix)) is None or variant.mtime < static_file.mtime:
+        return static_file
+    headers = dict(variant.headers, **{'Content-Type': static_file.headers['Content-Type'],
+            'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
+    if (cache_control := static_file.headers.get('Cache-Control')) is not None:
+        headers['Cache-Control'] = cache_control
+    return variant._replace(headers=headers)
+
+
+def requested_range(request, static_file):
+    """ Returns (start, stop) for a single byte Range, or None for the whole file, also
+        when If-Range does not match. Multiple ranges are answered with the whole file. """
+    if (value := request.headers.get('Range')) is None:
+        return None
+    if (if_range := request.headers.get('If-Range')) is not None:
+        if if_range.startswith(('"', 'W/')):
+            if if_range != static_file.etag:
+                return None
+        else:
+            try:
+                if int(static_file.mtime) > parsedate_to_datetime(if_range).timestamp():
+                    return None
+            except (TypeError, ValueError):
+                return None
+    unit, _, byte_range = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in byte_range:
+        return None
+    first, _, last = byte_range.strip().partition('-')
+    size = static_file.size
+    try:
+        if first:
+            start, stop = int(first), min(int(last) + 1, size) if last else size
+            if stop <= start and start < size:
+                return None     # invalid, last before first
+        else:
+            start, stop = max(0, size - int(last)), size
+    except ValueError:
+        return None
+    if start >= stop:
+        raise aiohttp_web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{size}'})
+    return start, stop
+
+
+async def send_file(request, response, fp, offset, count):
+    """ Zero-copy with loop.sendfile, which itself falls back to reading in a thread
+        (TLS for instance). Without a transport (mocks) the payload writer is used. """
+    loop = asyncio.get_running_loop()
+    writer = await response.prepare(request)
+    if request.method != 'HEAD':
+        if (transport := getattr(request, 'transport', None)) is not None:
+            await loop.sendfile(transport, fp, offset, count)
+        else:
+            await loop.run_in_executor(None, fp.seek, offset)
+            while count > 0 and (data := await loop.run_in_executor(None, fp.read, min(count, 256 * 1024))):
+                await writer.write(data)
+                count -= len(data)
+    await response.write_eof()
+
+
+async def send(request, response):
+    await response.prepare(request)
+    await response.write_eof()
+    return response
+
+
+def static_handler(static_dirs, static_path, cache_control=None, bundle_js=False, strip_js_tests=False,
+        static_files=None):
+    """ Serves static_dirs at static_path; given static_files (a StaticFiles), serves that instead """
+    if static_files is None:
+        static_files = StaticFiles(static_dirs, cache_control=cache_control, bundle_js=bundle_js,
+                strip_js_tests=strip_js_tests)
 
     async def _handler(request):
         if not (requested_path := request.path).startswith(static_path):
             raise aiohttp_web.HTTPNotFound()
 
         requested_file = requested_path[len(static_path + '/'):]
-        matches = [fname for static_dir in static_dirs if (fname := Path(static_dir) / requested_file).is_file()]
-        if len(matches) == 0:
+        immutable = False
+        if (static_file := await static_files.get(requested_file)) is None and \
+                (name_digest := unhashed(requested_file)) is not None:
+            requested_file, digest = name_digest
+            if (static_file := await static_files.get(requested_file)) is not None:
+                # an outdated digest gets the current content, but not for ever
+                immutable = digest == static_files.digest(requested_file)
+        if static_file is None:
             raise aiohttp_web.HTTPNotFound()
-        fname = matches[0]
-
-        mimeType = content_type(fname)
-        fname = str(fname)
-        response = aiohttp_web.StreamResponse(
-            status=200,
-            reason='OK',
-            headers={'Content-Type': mimeType},
-        )
-        await response.prepare(request)
-
-        with open(fname, 'rb') as fp:
-            while True:
-                data = fp.read(1024)
-                if len(data) == 0:
-                    break
-                await response.write(data)
-        await response.write_eof()
+        static_file = await select_variant(request, static_files, requested_file, static_file)
+        if immutable:
+            static_file = static_file._replace(headers=dict(static_file.headers, **{'Cache-Control': IMMUTABLE}))
+
+        if not_modified(request, static_file):
+            headers = {k: v for k, v in static_file.headers.items() if k not in ('Content-Type', 'Accept-Ranges')}
+            return await send(request, aiohttp_web.Response(status=304, headers=headers))
+
+        status, headers, start, stop = 200, static_file.headers, 0, static_file.size
+        if (byte_range := requested_range(request, static_file)) is not None:
+            start, stop = byte_range
+            status, headers = 206, dict(headers, **{'Content-Range': f'bytes {start}-{stop - 1}/{static_file.size}'})
+
+        if static_file.body is not None:
+            body = static_file.body if status == 200 else static_file.body[start:stop]
+            return await send(request, aiohttp_web.Response(status=status, body=body, headers=headers))
+
+        loop = asyncio.get_running_loop()
+        try:
+            fp = await loop.run_in_executor(None, open, static_file.path, 'rb')
+        except OSError:
+            raise aiohttp_web.HTTPNotFound()
+        try:
+            response = aiohttp_web.StreamResponse(status=status, headers=headers)
+            response.content_length = stop - start
+            await send_file(request, response, fp, start, stop - start)
+        finally:
+            await loop.run_in_executor(None, fp.close)
         return response
+    _handler.static_files = static_files
+    _handler.asset_manifest = AssetManifest(static_files, static_path)
     return _handler
 
 import autotest
 test = autotest.get_tester(__name__)
 from aiohttp.http import HttpVersion10
 
+from multidict import CIMultiDict
+
 class MockRequest:
-    def __init__(self, path):
+    def __init__(self, path, headers=None):
         class Writer:
             def __init__(self):
                 self.length = ""
@@ -99,12 +700,25 @@ class MockRequest:
             async def write_eof(self, a):
                 self.content += a
         self.path = path
+        self.method = self._method = "GET"
+        self.headers = CIMultiDict(headers or {})
         self._payload_writer = Writer()
         self.keep_alive = False
         self.version = HttpVersion10
     async def _prepare_hook(*a, **kw):
        pass
 
+async def inotified(files, since=None, timeout=2):
+    """ Waits for the watcher of files to run and, given the number of changes it returned
+        before, for the events of what changed since. Returns the number of changes. """
+    await asyncio.wait_for(files.start(), timeout)
+    deadline = asyncio.get_running_loop().time() + timeout
+    while since is not None and files._changes <= since:
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError(f"inotify gave no events within {timeout}s")
+        await asyncio.sleep(.001)
+    return files._changes
+
 @test
 async def no_file_for_static_handler(tmp_path):
     handler = static_handler((tmp_path,), "/static")
@@ -132,7 +746,7 @@ async def serve_file(tmp_path):
     request = MockRequest(path="/static/test-file.txt")
     response = await handler(request)
 
-    test.eq({"Content-Type", "Date", "Server"}, set(dict(response.headers).keys()))
+    test.eq({"Content-Type", "Content-Length", "Date", "Server", "ETag", "Last-Modified", "Accept-Ranges"}, set(dict(response.headers).keys()))
     test.eq(b"These are the contents", request._payload_writer.content)
 
     request = MockRequest(path="/static/sub/other.txt")
@@ -157,8 +771,460 @@ async def test_multiple_static_directories(tmp_path):
 
     test.eq(b"Hello World", request._payload_writer.content)
 
+    since = await inotified(handler.static_files)
     (dir_a / "file.txt").write_text("Goodbye World")
+    await inotified(handler.static_files, since)
     request = MockRequest(path="/static/file.txt")
     response = await handler(request)
 
     test.eq(b"Goodbye World", request._payload_writer.content)
+
+
+@test
+async def not_modified_with_etag_or_date(tmp_path):
+    handler = static_handler((tmp_path,), "/static")
+    (tmp_path / "main.js").write_text("let a = 1;")
+    os.utime(tmp_path / "main.js", (1700000000, 1700000000))
+    response = await handler(MockRequest(path="/static/main.js"))
+    etag = response.headers['ETag']
+    test.eq('Tue, 14 Nov 2023 22:13:20 GMT', response.headers['Last-Modified'])
+    test.eq(200, response.status)
+
+    for headers in [{'If-None-Match': etag}, {'If-None-Match': f'"other", W/{etag}'}, {'If-None-Match': '*'},
+            {'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:20 GMT'}]:
+        request = MockRequest(path="/static/main.js", headers=headers)
+        response = await handler(request)
+        test.eq(304, response.status)
+        test.eq(etag, response.headers['ETag'])
+        test.eq(b"", request._payload_writer.content)
+
+    for headers in [{'If-None-Match': '"other"'}, {'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:19 GMT'},
+            {'If-Modified-Since': 'garbage'}, {'If-None-Match': '"other"', 'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:20 GMT'}]:
+        request = MockRequest(path="/static/main.js", headers=headers)
+        test.eq(200, (await handler(request)).status)
+        test.eq(b"let a = 1;", request._payload_writer.content)
+    handler.static_files.close()
+
+@test
+async def cache_control_per_directory(tmp_path):
+    (dir_a := tmp_path / "a").mkdir()
+    (dir_b := tmp_path / "b").mkdir()
+    (dir_a / "a.css").write_text("a")
+    (dir_b / "b.css").write_text("b")
+    handler = static_handler([dir_a, dir_b], "/static", cache_control={dir_a: 'public, max-age=3600'})
+    test.eq('public, max-age=3600', (await handler(MockRequest(path="/static/a.css"))).headers['Cache-Control'])
+    test.eq(None, (await handler(MockRequest(path="/static/b.css"))).headers.get('Cache-Control'))
+    handler = static_handler([dir_a, dir_b], "/static", cache_control='no-cache')
+    test.eq('no-cache', (await handler(MockRequest(path="/static/b.css"))).headers['Cache-Control'])
+    handler.static_files.close()
+
+@test
+async def cache_small_files_until_changed(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "small.txt").write_text("small")
+    (tmp_path / "large.txt").write_text("large")
+    files = StaticFiles([tmp_path], max_cached_file_size=5, max_cache_bytes=10)
+    test.eq(b"small", (await files.get("sub/small.txt")).body)
+    since = await inotified(files)
+    test.truth((await files.get("sub/small.txt")) is (await files.get("sub/small.txt")))
+    (tmp_path / "sub" / "small.txt").write_text("other")
+    since = await inotified(files, since)
+    test.eq(b"other", (await files.get("sub/small.txt")).body)
+
+    (tmp_path / "sub").rename(tmp_path / "moved")
+    since = await inotified(files, since)
+    test.eq(None, await files.get("sub/small.txt"))
+    test.eq(b"other", (await files.get("moved/small.txt")).body)
+    (tmp_path / "moved" / "new.txt").write_text("new")
+    since = await inotified(files, since)
+    test.eq(b"new", (await files.get("moved/new.txt")).body)
+    test.eq(8, files._cache_bytes)
+    (tmp_path / "moved" / "new.txt").write_text("newer")
+    since = await inotified(files, since)
+    test.eq(b"newer", (await files.get("moved/new.txt")).body)
+
+    (tmp_path / "large.txt").write_text("larger")
+    await inotified(files, since)   # or its event drops it after loading
+    test.eq(None, (await files.get("large.txt")).body)
+    await files.get("sub")
+    test.eq(None, await files.get("sub"))
+    test.eq(['moved/small.txt', 'moved/new.txt', 'large.txt'], list(files._cache))     # no body for large.txt
+    test.eq(10, files._cache_bytes)
+    files.close()
+
+@test
+async def index_of_static_dirs(tmp_path):
+    (dir_a := tmp_path / "a").mkdir()
+    (dir_b := tmp_path / "b").mkdir()
+    (dir_b / "js").mkdir()
+    (dir_b / "js" / "main.js").write_text("b")
+    (tmp_path / "secret.txt").write_text("secret")
+    files = StaticFiles([dir_a, dir_b])
+    test.eq(b"b", (await files.get("js/main.js")).body)
+    test.eq({'js/main.js'}, set(files._index))
+    for requested in ["../secret.txt", "js/../../secret.txt", "/etc/passwd", "js", "", "js/"]:
+        test.eq(None, await files.get(requested))
+    since = await inotified(files)
+
+    (dir_a / "js").mkdir()
+    since = await inotified(files, since)
+    (dir_a / "js" / "main.js").write_text("a")    # shadows b
+    since = await inotified(files, since)
+    test.eq(b"a", (await files.get("js/main.js")).body)
+    (dir_a / "js" / "main.js").unlink()
+    since = await inotified(files, since)
+    test.eq(b"b", (await files.get("js/main.js")).body)
+
+    (tmp_path / "c").mkdir()
+    (tmp_path / "c" / "main.js").write_text("c")
+    (tmp_path / "c").rename(dir_a / "js2")
+    since = await inotified(files, since)
+    test.eq(b"c", (await files.get("js2/main.js")).body)
+    (dir_b / "js").rename(tmp_path / "gone")
+    await inotified(files, since)
+    test.eq(None, await files.get("js/main.js"))
+    test.eq({'js2/main.js'}, set(files._index))
+    files.close()
+
+@test
+async def follow_symlinked_directories(tmp_path):
+    (shared := tmp_path / "shared" / "lib").mkdir(parents=True)
+    (shared / "lib.js").write_text("lib")
+    (shared / "up").symlink_to("..")      # a cycle
+    (static := tmp_path / "static").mkdir()
+    (static / "lib").symlink_to("../shared/lib")
+    files = StaticFiles([static])
+    test.eq(b"lib", (await files.get("lib/lib.js")).body)
+    test.eq({'lib/lib.js'}, set(files._index))
+    since = await inotified(files)
+
+    (shared / "lib.js").write_text("changed")
+    since = await inotified(files, since)
+    test.eq(b"changed", (await files.get("lib/lib.js")).body)
+    (static / "more").symlink_to("../shared/lib")
+    since = await inotified(files, since)
+    test.eq(b"changed", (await files.get("more/lib.js")).body)
+    (shared / "lib.js").write_text("again")
+    since = await inotified(files, since)
+    test.eq(b"again", (await files.get("lib/lib.js")).body)
+    test.eq(b"again", (await files.get("more/lib.js")).body)
+    (static / "more").unlink()
+    await inotified(files, since)
+    test.eq(None, await files.get("more/lib.js"))
+    test.eq(b"again", (await files.get("lib/lib.js")).body)
+    files.close()
+
+@test
+async def index_built_once_and_kept_watched(tmp_path):
+    (tmp_path / "main.js").write_text("let a = 1;")
+    files = StaticFiles([tmp_path])
+    files._restart_delay = 0
+    await files.start()
+    test.eq({'main.js'}, set(files._index))
+    static_file = await files.get("main.js")
+    digest = files.digest("main.js")
+    await files.start()
+    test.truth(static_file is await files.get("main.js"))
+
+    files = StaticFiles([tmp_path])     # first use before start()
+    files._restart_delay = 0
+    static_file = await files.get("main.js")
+    test.eq(digest, files.digest("main.js"))
+    await files.start()
+    test.truth(static_file is await files.get("main.js"))
+    test.eq(digest, files._digests["main.js"])
+
+    task = files._task
+    with test.stderr:
+        files._watcher.close()      # the watcher dies
+        await asyncio.wait_for(asyncio.gather(task, return_exceptions=True), 1)
+        for _ in range(1000):
+            if files._task is not None:
+                break
+            await asyncio.sleep(.001)
+        test.truth(files._task is not None and files._task is not task)
+        since = await inotified(files)
+    (tmp_path / "main.js").write_text("let a = 2;")
+    await inotified(files, since)
+    test.eq(b"let a = 2;", (await files.get("main.js")).body)
+    await files.aclose()
+
+    files = StaticFiles([tmp_path], watch=False)
+    test.truth(files.has("main.js"))
+    test.eq(None, files._task)
+
+@test
+async def byte_ranges(tmp_path):
+    handler = static_handler((tmp_path,), "/static")
+    (tmp_path / "file.txt").write_text("0123456789")
+    etag = (await handler(MockRequest(path="/static/file.txt"))).headers['ETag']
+    for headers, status, content, content_range in [
+            ({'Range': 'bytes=2-4'}, 206, b"234", 'bytes 2-4/10'),
+            ({'Range': 'bytes=7-'}, 206, b"789", 'bytes 7-9/10'),
+            ({'Range': 'bytes=-3'}, 206, b"789", 'bytes 7-9/10'),
+            ({'Range': 'bytes=5-100'}, 206, b"56789", 'bytes 5-9/10'),
+            ({'Range': 'bytes=2-4', 'If-Range': etag}, 206, b"234", 'bytes 2-4/10'),
+            ({'Range': 'bytes=2-4', 'If-Range': '"other"'}, 200, b"0123456789", None),
+            ({'Range': 'bytes=2-4', 'If-Range': 'Tue, 14 Nov 2000 22:13:20 GMT'}, 200, b"0123456789", None),
+            ({'Range': 'bytes=0-1,4-5'}, 200, b"0123456789", None),
+            ({'Range': 'lines=1-2'}, 200, b"0123456789", None),
+            ({'Range': 'bytes=4-2'}, 200, b"0123456789", None),
+            ]:
+        request = MockRequest(path="/static/file.txt", headers=headers)
+        response = await handler(request)
+        test.eq((status, content, content_range),
+                (response.status, request._payload_writer.content, response.headers.get('Content-Range')))
+    try:
+        await handler(MockRequest(path="/static/file.txt", headers={'Range': 'bytes=10-'}))
+        test.fail()
+    except aiohttp_web.HTTPRequestRangeNotSatisfiable as e:
+        test.eq('bytes */10', e.headers['Content-Range'])
+    handler.static_files.close()
+
+@test
+async def large_files_without_transport(tmp_path):
+    handler = static_handler((tmp_path,), "/static")
+    data = os.urandom(300 * 1024)
+    (tmp_path / "large.bin").write_bytes(data)
+    request = MockRequest(path="/static/large.bin")
+    response = await handler(request)
+    test.eq(data, request._payload_writer.content)
+    request = MockRequest(path="/static/large.bin", headers={'Range': 'bytes=1000-'})
+    response = await handler(request)
+    test.eq(206, response.status)
+    test.eq(data[1000:], request._payload_writer.content)
+    handler.static_files.close()
+
+@test
+async def large_files_with_sendfile(tmp_path):
+    from aiohttp.test_utils import TestClient, TestServer
+    data = os.urandom(3 * 1024 * 1024)
+    (tmp_path / "large.bin").write_bytes(data)
+    handler = static_handler((tmp_path,), "/static")
+    app = aiohttp_web.Application()
+    app.router.add_get('/static/{tail:.+}', handler)
+    async with TestClient(TestServer(app)) as client:
+        response = await client.get('/static/large.bin')
+        test.eq(200, response.status)
+        test.eq(str(len(data)), response.headers['Content-Length'])
+        test.eq(data, await response.read())
+        response = await client.get('/static/large.bin', headers={'Range': 'bytes=100-199'})
+        test.eq(206, response.status)
+        test.eq(data[100:200], await response.read())
+        response = await client.head('/static/large.bin')
+        test.eq(200, response.status)
+        test.eq(b"", await response.read())
+    handler.static_files.close()
+
+@test
+def accept_encoding():
+    encodings = ('br', 'gzip')
+    request = lambda value: MockRequest("/", headers={'Accept-Encoding': value} if value is not None else {})
+    test.eq('br', accepted_encoding(request('gzip, deflate, br'), encodings))
+    test.eq('gzip', accepted_encoding(request('gzip, deflate'), encodings))
+    test.eq('gzip', accepted_encoding(request('br;q=0.5, gzip'), encodings))
+    test.eq('gzip', accepted_encoding(request('br;q=0, *'), encodings))
+    test.eq('gzip', accepted_encoding(request('gzip'), ('gzip',)))
+    test.eq(None, accepted_encoding(request('br'), ('gzip',)))
+    test.eq(None, accepted_encoding(request('identity'), encodings))
+    test.eq(None, accepted_encoding(request('gzip;q=0'), encodings))
+    test.eq(None, accepted_encoding(request(None), encodings))
+    test.eq(None, accepted_encoding(request('gzip'), ()))
+
+@test
+async def serve_precompressed_variants(tmp_path):
+    import gzip
+    handler = static_handler((tmp_path,), "/static", cache_control='no-cache')
+    (tmp_path / "main.js").write_text("let a = 1;")
+    (tmp_path / "main.js.gz").write_bytes(gzip.compress(b"let a = 1;"))
+    (tmp_path / "other.js").write_text("let b = 2;")
+    os.utime(tmp_path / "main.js", (1700000000, 1700000000))
+
+    request = MockRequest(path="/static/main.js", headers={'Accept-Encoding': 'gzip, br'})
+    response = await handler(request)
+    test.eq('gzip', response.headers['Content-Encoding'])
+    test.eq('Accept-Encoding', response.headers['Vary'])
+    test.eq('application/javascript', response.headers['Content-Type'])
+    test.eq('no-cache', response.headers['Cache-Control'])
+    test.eq(b"let a = 1;", gzip.decompress(request._payload_writer.content))
+    gz_etag = response.headers['ETag']
+
+    request = MockRequest(path="/static/main.js")
+    response = await handler(request)
+    test.eq(None, response.headers.get('Content-Encoding'))
+    test.eq('Accept-Encoding', response.headers['Vary'])
+    test.ne(gz_etag, response.headers['ETag'])
+    test.eq(b"let a = 1;", request._payload_writer.content)
+
+    response = await handler(MockRequest(path="/static/main.js", headers={'Accept-Encoding': 'gzip', 'If-None-Match': gz_etag}))
+    test.eq(304, response.status)
+
+    response = await handler(MockRequest(path="/static/other.js", headers={'Accept-Encoding': 'gzip'}))
+    test.eq(None, response.headers.get('Content-Encoding'))
+    test.eq(None, response.headers.get('Vary'))
+
+    since = await inotified(handler.static_files)
+    os.utime(tmp_path / "main.js", (1800000000, 1800000000))  # variant outdated
+    since = await inotified(handler.static_files, since)
+    request = MockRequest(path="/static/main.js", headers={'Accept-Encoding': 'gzip'})
+    response = await handler(request)
+    test.eq(None, response.headers.get('Content-Encoding'))
+    test.eq(b"let a = 1;", request._payload_writer.content)
+
+    (tmp_path / "other.js.gz").write_bytes(gzip.compress(b"let b = 2;"))
+    await inotified(handler.static_files, since)
+    response = await handler(MockRequest(path="/static/other.js", headers={'Accept-Encoding': 'gzip'}))
+    test.eq('gzip', response.headers['Content-Encoding'])
+    handler.static_files.close()
+
+@test
+async def hashed_names(tmp_path):
+    (tmp_path / "js").mkdir()
+    (tmp_path / "js" / "main.js").write_text("let a = 1;")
+    (tmp_path / "LICENSE").write_text("GPL")
+    files = StaticFiles([tmp_path])
+    digest = files.digest("js/main.js")
+    test.eq(hashlib.sha256(b"let a = 1;").hexdigest()[:12], digest)
+    test.eq(f"js/main.{digest}.js", files.hashed("js/main.js"))
+    test.eq(f"LICENSE.{files.digest('LICENSE')}", files.hashed("LICENSE"))
+    test.eq(None, files.hashed("nope.js"))
+    test.eq(("js/main.js", digest), unhashed(f"js/main.{digest}.js"))
+    test.eq(("LICENSE", "0123456789ab"), unhashed("LICENSE.0123456789ab"))
+    test.eq(None, unhashed("js/main.js"))
+    test.eq(None, unhashed("js/main.0123.js"))
+
+    manifest = AssetManifest(files, "/static")
+    test.eq(f"/static/js/main.{digest}.js", manifest.url("js/main.js"))
+    test.eq("/static/nope.js", manifest.url("nope.js"))
+    test.truth(manifest.has("js/main.js"))
+    test.eq(False, manifest.has("nope.js"))
+
+    since = await inotified(files)
+    (tmp_path / "js" / "main.js").write_text("let a = 2;")
+    await inotified(files, since)
+    test.eq(hashlib.sha256(b"let a = 2;").hexdigest()[:12], files.digest("js/main.js"))
+    files.close()
+
+@test
+async def serve_hashed_names_immutable(tmp_path):
+    import gzip
+    handler = static_handler((tmp_path,), "/static", cache_control='no-cache')
+    (tmp_path / "main.js").write_text("let a = 1;")
+    (tmp_path / "main.js.gz").write_bytes(gzip.compress(b"let a = 1;"))
+    url = handler.asset_manifest.url("main.js")
+    test.truth(url.startswith("/static/main.") and url != "/static/main.js")
+
+    request = MockRequest(path=url)
+    response = await handler(request)
+    test.eq(200, response.status)
+    test.eq(IMMUTABLE, response.headers['Cache-Control'])
+    test.eq('application/javascript', response.headers['Content-Type'])
+    test.eq(b"let a = 1;", request._payload_writer.content)
+
+    response = await handler(MockRequest(path=url, headers={'Accept-Encoding': 'gzip'}))
+    test.eq('gzip', response.headers['Content-Encoding'])
+    test.eq(IMMUTABLE, response.headers['Cache-Control'])
+
+    response = await handler(MockRequest(path="/static/main.js"))
+    test.eq('no-cache', response.headers['Cache-Control'])
+
+    response = await handler(MockRequest(path="/static/main.0123456789ab.js"))
+    test.eq(200, response.status)
+    test.eq('no-cache', response.headers['Cache-Control'])
+
+    try:
+        await handler(MockRequest(path="/static/other.0123456789ab.js"))
+        test.fail()
+    except aiohttp_web.HTTPNotFound:
+        pass
+
+    since = await inotified(handler.static_files)
+    (tmp_path / "main.js").write_text("let a = 2;")
+    await inotified(handler.static_files, since)
+    test.ne(url, handler.asset_manifest.url("main.js"))
+    handler.static_files.close()
+
+@test
+async def bundle_js_on_first_use(tmp_path):
+    (tmp_path / "lib.js").write_text("export const a = 1;\n")
+    (tmp_path / "main.js").write_text('import {a} from "./lib.js";\nconsole.log(a);\n')
+    files = StaticFiles([tmp_path], bundle_js=True)
+    test.eq("main.bundle.js", files.bundled("main.js"))
+    test.eq("nope.js", files.bundled("nope.js"))
+    test.eq("main.bundle.js", files.bundled("main.bundle.js"))
+    test.eq("main.js", StaticFiles([tmp_path]).bundled("main.js"))
+    test.eq(None, await StaticFiles([tmp_path]).get("main.bundle.js"))
+
+    bundle = await files.get("main.bundle.js")
+    test.contains(bundle.body.decode(), 'const {a} = __modules["lib.js"];')
+    test.eq('application/javascript', bundle.headers['Content-Type'])
+    source_map = await files.get("main.bundle.js.map")
+    test.eq(['lib.js', 'main.js'], json.loads(source_map.body)['sources'])
+    test.eq('application/json', source_map.headers['Content-Type'])
+    test.truth(bundle is await files.get("main.bundle.js"))
+    digest = files.digest("main.bundle.js")
+    test.eq(f"main.bundle.{digest}.js", files.hashed("main.bundle.js"))
+
+    since = await inotified(files)
+    (tmp_path / "lib.js").write_text("export const a = 2;\n")
+    since = await inotified(files, since)
+    test.contains((await files.get("main.bundle.js")).body.decode(), 'const a = 2;')
+    test.ne(digest, files.digest("main.bundle.js"))
+
+    (tmp_path / "lib.js").write_text("export default 2;\n")
+    await inotified(files, since)
+    with test.stderr:
+        test.eq("main.js", files.bundled("main.js"))
+    files.close()
+
+@test
+async def serve_hashed_bundle(tmp_path):
+    (tmp_path / "main.js").write_text('import {get_tester} from "./autotest.js"\nlet test = get_tester("m");\ntest(function t() {\n})\n')
+    (tmp_path / "autotest.js").write_text("export function get_tester() {}\n")
+    handler = static_handler((tmp_path,), "/static", bundle_js=True, strip_js_tests=True)
+    url = handler.asset_manifest.url("main.js")
+    test.truth(url.startswith("/static/main.bundle.") and url.endswith(".js"))
+    request = MockRequest(path=url)
+    response = await handler(request)
+    test.eq(IMMUTABLE, response.headers['Cache-Control'])
+    test.eq(False, b'test' in request._payload_writer.content)
+    test.contains(request._payload_writer.content.decode(), '//# sourceMappingURL=main.bundle.js.map')
+    bundle = request._payload_writer.content
+
+    import gzip
+    request = MockRequest(path=url, headers={'Accept-Encoding': 'gzip'})
+    response = await handler(request)
+    test.eq('gzip', response.headers['Content-Encoding'])
+    test.eq('Accept-Encoding', response.headers['Vary'])
+    test.eq('application/javascript', response.headers['Content-Type'])
+    test.eq(IMMUTABLE, response.headers['Cache-Control'])
+    test.eq(bundle, gzip.decompress(request._payload_writer.content))
+    request = MockRequest(path="/static/main.bundle.js.map", headers={'Accept-Encoding': 'gzip'})
+    response = await handler(request)
+    test.eq('gzip', response.headers['Content-Encoding'])
+    test.eq('main.bundle.js', json.loads(gzip.decompress(request._payload_writer.content))['file'])
+    test.eq(None, await handler.static_files.get("main.js.gz"))
+    handler.static_files.close()
+
+@test
+async def inline_stylesheets(tmp_path):
+    (tmp_path / "css").mkdir()
+    (tmp_path / "css" / "small.css").write_text("body { background: url('../img/bg.png') } i { background: url(data:image/png;base64,AA) }")
+    (tmp_path / "css" / "large.css").write_text("p { margin: 0 }\n" * 100)
+    (tmp_path / "css" / "evil.css").write_text("</style><script>alert(1)</script>")
+    files = StaticFiles([tmp_path])
+    manifest = AssetManifest(files, "/static")
+    test.eq("body { background: url('/static/img/bg.png') } i { background: url(data:image/png;base64,AA) }",
+            manifest.inline("css/small.css", 1024))
+    test.eq(None, manifest.inline("css/large.css", 1024))
+    test.eq("p { margin: 0 }\n" * 100, manifest.inline("css/large.css", 2048))
+    test.eq(None, manifest.inline("css/evil.css", 1024))
+    test.eq(None, manifest.inline("css/nope.css", 1024))
+    css = manifest.inline("css/small.css", 1024)
+    test.truth(css is manifest.inline("css/small.css", 1024))
+
+    since = await inotified(files)
+    (tmp_path / "css" / "small.css").write_text("body { color: red }")
+    await inotified(files, since)
+    test.eq("body { color: red }", manifest.inline("css/small.css", 1024))
+    files.close()
@@ -23,31 +23,50 @@
 #
 ## end license ##
 
+import os
 import sys
 import pathlib
-import importlib
+import importlib.util
+import importlib.machinery
 
 __all__ = ['builtins']
 
 
-def load(name):
-    importlib.machinery.SourceFileLoader(
-            f"{__name__}.{name}",
-            pathlib.Path(__file__).with_name(f"{name}.sf").as_posix()
-        ).load_module()
-
-
 # in order of dependency
 builtins = ['call_js', 'page', 'login', 'logout', 'prevnextctrl', 'jstests']
 assert all(sf.stem in builtins for sf in pathlib.Path(__file__).parent.glob("*.sf"))
 
 
-# load modules for the side effect of testing
-for bi in builtins:
-    load(bi)
+def load(name):
+    """ Imports builtin template 'name' once and keeps it in sys.modules. An installed
+        TemplateImporter is used when present, so the template is watched for changes. """
+    fullname = f"{__name__}.{name}"
+    if (mod := sys.modules.get(fullname)) is not None:
+        return mod
+    if (spec := importlib.util.find_spec(fullname)) is None:
+        for dependency in builtins[:builtins.index(name)]:
+            load(dependency)
+        spec = importlib.util.spec_from_loader(fullname, importlib.machinery.SourceFileLoader(
+            fullname, pathlib.Path(__file__).with_name(f"{name}.sf").as_posix()))
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[fullname] = mod
+    try:
+        spec.loader.exec_module(mod)
+    except BaseException:
+        del sys.modules[fullname]
+        raise
+    globals()[name] = mod
+    return mod
+
 
+def __getattr__(name):
+    # supports 'from metastreams.html.stdsflib import page' without loading all builtins
+    if name in builtins:
+        return load(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-# delete so they can be dynamically reloaded & watched later
-for bi in builtins:
-    del sys.modules[__name__ + '.' + bi]
 
+# load modules for the side effect of testing, only when asked to by the test run (see ..)
+if __debug__ and os.environ.get('METASTREAMS_HTML_TESTS'):
+    for bi in builtins:
+        load(bi)
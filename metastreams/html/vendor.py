@@ -0,0 +1,243 @@
+## begin license ##
+#
+# "Metastreams Html" is a template engine based on generators, and a sequel to Slowfoot.
+# It is also known as "DynamicHtml" or "Seecr Html".
+#
+# Copyright (C) 2023 Seecr (Seek You Too B.V.) https://seecr.nl
+#
+# This file is part of "Metastreams Html"
+#
+# "Metastreams Html" is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# "Metastreams Html" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "Metastreams Html"; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+## end license ##
+
+""" The CDN assets page.render uses, and a command to fetch them once into a static dir so
+    pages need no other origin (and work without internet):
+
+        python -m metastreams.html.vendor [--allow-unpinned] /path/to/static_dir
+
+    Files are stored below vendor/ by host and path of their URL, so relative url()s in
+    stylesheets keep working; absolute ones are fetched too and made relative. Files that
+    are there already are not fetched again. Downloads are verified against the pinned
+    integrity hashes. Files without one (including what stylesheets refer to) are refused
+    unless unpinned files are allowed; their computed hash is printed, for pinning.
+"""
+
+import re
+import hashlib
+import posixpath
+from base64 import b64encode
+from pathlib import Path, PurePosixPath
+from collections import namedtuple
+from urllib.parse import urlsplit, urljoin, urldefrag
+
+__all__ = ['STYLESHEETS', 'SCRIPTS']
+
+
+Asset = namedtuple('Asset', ['url', 'integrity', 'local'])
+
+
+def asset(url, integrity=None, suffix=''):
+    return Asset(url, integrity, local_name(url, suffix))
+
+
+def local_name(url, suffix=''):
+    """ Name of the vendored copy of url in a static dir """
+    parts = urlsplit(url)
+    name = f'vendor/{parts.netloc}{parts.path}'
+    return name if PurePosixPath(parts.path).suffix else name + suffix
+
+
+# in the order page.render includes them
+STYLESHEETS = [
+    asset("https://code.jquery.com/ui/1.13.2/themes/base/jquery-ui.css"),
+    asset("https://fonts.cdnfonts.com/css/open-sans", suffix='.css'),
+    asset("https://cdn.jsdelivr.net/npm/bootstrap@5.2.0-beta1/dist/css/bootstrap.min.css",
+        "sha384-0evHe/X+R7YkIZDRvuzKMRqM+OrBnVFBL6DOitfPri4tjfHxaWutUpFmBp4vmVor"),
+    asset("https://cdn.jsdelivr.net/npm/bootstrap-icons@1.9.1/font/bootstrap-icons.css"),
+]
+
+SCRIPTS = [
+    asset("https://code.jquery.com/jquery-3.6.0.min.js",
+        "sha256-/xUj+3OJU5yExlq6GSYGSHk7tPXikynS7ogEvDej/m4="),
+    asset("https://cdn.jsdelivr.net/npm/bootstrap@5.2.0-beta1/dist/js/bootstrap.bundle.min.js",
+        "sha384-pprn3073KE6tl6bjs2QrFaJGz5/SUsLqktiwsUTF55Jfv3qYSDhgCecCxMW52nD2"),
+    asset("https://code.jquery.com/ui/1.13.2/jquery-ui.js"),
+    asset("https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.6.0/highlight.min.js"),
+]
+
+URL_REFERENCE = re.compile(r'''url\(\s*(?P<q>['"]?)(?P<url>[^'")]+)(?P=q)\s*\)''')
+
+
+def integrity_of(data, algorithm='sha384'):
+    return f"{algorithm}-{b64encode(hashlib.new(algorithm, data).digest()).decode()}"
+
+
+def verify(data, integrity):
+    """ Whether data matches one of the hashes in the integrity attribute value """
+    for each in integrity.split():
+        algorithm, _, expected = each.partition('-')
+        if algorithm in ('sha256', 'sha384', 'sha512') and integrity_of(data, algorithm) == each:
+            return True
+    return False
+
+
+def fetch(url):
+    from urllib.request import urlopen, Request     # only when vendoring, not for page.sf
+    with urlopen(Request(url, headers={'User-Agent': 'metastreams-html vendor'}), timeout=30) as response:
+        return response.read()
+
+
+def vendor(static_dir, assets=None, fetch=fetch, log=print, allow_unpinned=False):
+    """ Fetches the assets (all by default) that are not in static_dir yet; returns the
+        names of the files written. Raises ValueError when an integrity check fails, or
+        for a file without integrity hash unless allow_unpinned. """
+    static_dir = Path(static_dir)
+    assets = (STYLESHEETS + SCRIPTS) if assets is None else assets
+    written = []
+    if not allow_unpinned and (unpinned := [each.url for each in assets if each.integrity is None]):
+        raise ValueError(f"not pinned by an integrity hash: {', '.join(unpinned)}")
+
+    def store(name, data):
+        path = static_dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '~')
+        tmp.write_bytes(data)
+        tmp.rename(path)
+        written.append(name)
+
+    def get(url, name, integrity=None):
+        if (static_dir / name).is_file():
+            return
+        data = fetch(url)
+        if integrity is None:
+            log(f"{url}: {integrity_of(data)}")
+            if not allow_unpinned:
+                raise ValueError(f"{url}: not pinned by an integrity hash")
+        elif not verify(data, integrity):
+            raise ValueError(f"{url}: integrity check failed")
+        if name.endswith('.css'):
+            data = stylesheet_references(url, name, data.decode(), get).encode()
+        store(name, data)
+
+    for each in assets:
+        get(each.url, each.local, each.integrity)
+    return written
+
+
+def stylesheet_references(url, name, css, get):
+    """ Fetches what css refers to with url(...) and returns css referring to the copies """
+    def reference(match):
+        if match['url'].startswith(('data:', '#')):
+            return match[0]
+        absolute = urldefrag(urljoin(url, match['url'])).url
+        target = local_name(absolute)
+        get(absolute, target)
+        relative = posixpath.relpath(target, posixpath.dirname(name))
+        if fragment := urlsplit(match['url']).fragment:
+            relative += '#' + fragment
+        return f'url({match["q"]}{relative}{match["q"]})'
+    return URL_REFERENCE.sub(reference, css)
+
+
+import autotest
+test = autotest.get_tester(__name__)
+
+
+@test
+def local_names():
+    test.eq('vendor/code.jquery.com/jquery-3.6.0.min.js', local_name('https://code.jquery.com/jquery-3.6.0.min.js'))
+    test.eq('vendor/fonts.cdnfonts.com/css/open-sans.css', local_name('https://fonts.cdnfonts.com/css/open-sans', '.css'))
+    test.eq('vendor/example.org/a/b.woff2', local_name('https://example.org/a/b.woff2?v=2#x'))
+    test.eq(8, len({each.local for each in STYLESHEETS + SCRIPTS}))
+
+@test
+def verify_integrity():
+    test.truth(verify(b'data', integrity_of(b'data')))
+    test.truth(verify(b'data', f"sha256-nope {integrity_of(b'data', 'sha512')}"))
+    test.eq(False, verify(b'data', integrity_of(b'other')))
+    test.eq(False, verify(b'data', ''))
+
+@test
+def vendor_assets(tmp_path):
+    files = {
+        'https://cdn.example/lib/1.0/lib.js': b'lib()',
+        'https://cdn.example/lib/1.0/css/lib.css':
+            b'@font-face{src:url("../fonts/lib.woff2?v=1") format("woff2"), url(https://fonts.example/f.woff#f)}'
+            b' .x{background:url(data:image/png;base64,AAAA)}',
+        'https://cdn.example/lib/1.0/fonts/lib.woff2?v=1': b'woff2',
+        'https://fonts.example/f.woff': b'woff',
+    }
+    fetched, logged = [], []
+    def fetch(url):
+        fetched.append(url)
+        return files[url]
+    assets = [
+        asset('https://cdn.example/lib/1.0/lib.js', integrity_of(b'lib()')),
+        asset('https://cdn.example/lib/1.0/css/lib.css'),
+    ]
+    try:
+        vendor(tmp_path, assets, fetch=fetch, log=logged.append)
+        test.fail()
+    except ValueError as e:
+        test.eq("not pinned by an integrity hash: https://cdn.example/lib/1.0/css/lib.css", str(e))
+    test.eq([], fetched)
+    pinned_css = [assets[0], asset(assets[1].url, integrity_of(files['https://cdn.example/lib/1.0/css/lib.css']))]
+    try:
+        vendor(tmp_path, pinned_css, fetch=fetch, log=logged.append)
+        test.fail()
+    except ValueError as e:
+        test.eq("https://cdn.example/lib/1.0/fonts/lib.woff2?v=1: not pinned by an integrity hash", str(e))
+    test.eq(False, (tmp_path / 'vendor/cdn.example/lib/1.0/css/lib.css').exists())
+    (tmp_path / 'vendor/cdn.example/lib/1.0/lib.js').unlink()
+    logged.clear()
+
+    written = vendor(tmp_path, assets, fetch=fetch, log=logged.append, allow_unpinned=True)
+    test.eq(['vendor/cdn.example/lib/1.0/lib.js', 'vendor/cdn.example/lib/1.0/fonts/lib.woff2',
+        'vendor/fonts.example/f.woff', 'vendor/cdn.example/lib/1.0/css/lib.css'], written)
+    test.eq(b'lib()', (tmp_path / 'vendor/cdn.example/lib/1.0/lib.js').read_bytes())
+    test.eq('@font-face{src:url("../fonts/lib.woff2") format("woff2"), url(../../../../fonts.example/f.woff#f)}'
+            ' .x{background:url(data:image/png;base64,AAAA)}',
+            (tmp_path / 'vendor/cdn.example/lib/1.0/css/lib.css').read_text())
+    test.eq(b'woff', (tmp_path / 'vendor/fonts.example/f.woff').read_bytes())
+    test.eq([f"https://cdn.example/lib/1.0/css/lib.css: {integrity_of(files['https://cdn.example/lib/1.0/css/lib.css'])}",
+        f"https://cdn.example/lib/1.0/fonts/lib.woff2?v=1: {integrity_of(b'woff2')}",
+        f"https://fonts.example/f.woff: {integrity_of(b'woff')}"], sorted(logged))
+
+    fetched.clear()
+    test.eq([], vendor(tmp_path, assets, fetch=fetch, log=logged.append, allow_unpinned=True))
+    test.eq([], fetched)
+
+    try:
+        vendor(tmp_path / 'other', [asset('https://cdn.example/lib/1.0/lib.js', integrity_of(b'other'))], fetch=fetch)
+        test.fail()
+    except ValueError as e:
+        test.eq("https://cdn.example/lib/1.0/lib.js: integrity check failed", str(e))
+    test.eq(False, (tmp_path / 'other' / 'vendor/cdn.example/lib/1.0/lib.js').exists())
+
+
+if __name__ == '__main__':
+    import sys
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('static_dir', help="Static directory of the application to store the assets in")
+    parser.add_argument('--allow-unpinned', help='Also fetch files without integrity hash (printed for pinning)', action='store_true')
+    args = parser.parse_args()
+
+    try:
+        written = vendor(args.static_dir, allow_unpinned=args.allow_unpinned)
+    except (OSError, ValueError) as e:
+        sys.exit(f"vendoring failed: {e}")
+    print(f"{args.static_dir}: {len(written)} files written")